@@ -8,9 +8,41 @@ binary file (no encoding applied)
 
 The JSON field should contain a 'key' value. A result will contain a 'key' value and either a hit or a miss.
 
+Clients may compress values. The codec used is given as 'codec' in the JSON of a set (or
+'codecs' for setmulti), saved with the value and returned in the JSON of a get hit (or as
+'codecs' from getmulti, with null for values which aren't compressed).
+
 Procedures provided are:
 get returns a JSON result {'key': keyvalue, hit: True or False} followed by newline followed by the key.
+  Hits include 'value_sha512' (the sha512 hexdigest of the value, as returned by set) and an ETag.
+  If the request has digest=<value_sha512> (or an If-None-Match header with the ETag) and the
+  value hasn't changed {'key': keyvalue, 'hit': True, 'notmodified': True} (or 304 Not
+  Modified) is returned without the value.
 set expects a JSON {'key': keyvalue } followed by a newline followed by the data to cache.
+
+Many keys can be read or written in one (POST) request. The values are concatenated in
+the binary part and 'sizes' gives the length of each value (0 for a miss).
+getmulti expects a JSON {'keys': [key1, key2, ...]} and returns
+  {'keys': [key1, ...], 'hits': [True, ...], 'sizes': [size1, ...]} followed by the values.
+setmulti expects a JSON {'keys': [key1, ...], 'sizes': [size1, ...]} followed by the values and returns
+  {'keys': [key1, ...], 'cached': [True, ...], 'value_sha512': [hexdigest1, ...]}.
+
+Values larger than the memcache item limit are split into CHUNKSIZE chunks, stored
+under chunkkey(key, i), with a manifest {'chunks': n, 'codec': codec, 'digest': sha512}
+stored under the key itself. The sha512 of each value is saved with it (see pack) so hits
+don't hash the value again. A value is a miss if any of its chunks has been evicted. Request bodies are
+read (and hashed) a chunk at a time and chunks are written to the response in order.
+
+A set or setmulti can include 'index': name to add its keys to the list of keys for
+name (cloudm uses the hash of the memoized function). Each key added is stored in its own
+memcache item, in the next of MAXINDEX numbered slots (a counter, incremented atomically, gives
+each request its slots), so adding is quick and concurrent requests don't lose each other's keys.
+The most recent MAXINDEX additions are kept.
+keys expects ?index=name and returns {'index': name, 'keys': [key1, ...]}.
+
+Leases let one client tell others that it is calculating the value for a key.
+lease expects a JSON {'key': keyvalue, 'ttl': seconds, 'owner': ownerid} and returns {'key': keyvalue, 'acquired': True or False}.
+release expects a JSON {'key': keyvalue, 'owner': ownerid} and returns {'key': keyvalue, 'released': True or False}.
 """
 
 from google.appengine.ext import webapp
@@ -22,18 +54,143 @@ import logging
 import hashlib
 
 
+# Cache-Control of hits, HTTP caches can keep them and serve them while they revalidate (with the ETag).
+HITCACHECONTROL = 'public, max-age=86400, stale-while-revalidate=86400'
+
+# Largest piece of a value stored in one memcache item (which is limited to 1MB including the key).
+CHUNKSIZE = 950 * 1000
+
+def chunkkey(key, i):
+    """Memcache key for chunk i of a value stored in chunks."""
+    return '%s:chunk:%d' % (key, i)
+
+def store(key, read, size, codec=None):
+    """Store the value of size bytes read by read(n) under key.
+    Returns (cached, sha512 hexdigest of value)."""
+    digest = hashlib.sha512()
+    if size <= CHUNKSIZE:
+        value = read(size)
+        digest.update(value)
+        if len(value) != size: # The request was cut short, don't store part of the value.
+            logging.warning('Request for %s ended %d bytes early' % (key, size - len(value)))
+            return False, digest.hexdigest()
+        return memcache.set(key, pack(value, codec, digest.hexdigest())), digest.hexdigest()
+    nchunks = 0
+    cached = True
+    while size > 0:
+        chunk = read(min(CHUNKSIZE, size))
+        if not chunk: # The request was cut short, don't store part of the value.
+            logging.warning('Request for %s ended %d bytes early' % (key, size))
+            return False, digest.hexdigest()
+        digest.update(chunk)
+        cached = memcache.set(chunkkey(key, nchunks), chunk) and cached
+        size -= len(chunk)
+        nchunks += 1
+    # The manifest is written last so readers never see an incomplete value.
+    cached = cached and memcache.set(key, {'chunks' : nchunks, 'codec' : codec, 'digest' : digest.hexdigest()})
+    return cached, digest.hexdigest()
+
+def fetch(key, stored):
+    """Returns (list of chunks, codec, sha512 hexdigest) of the value stored under key, or
+    (None, None, None) on a miss. The digest is None for values saved without one."""
+    if stored is None:
+        return None, None, None
+    if isinstance(stored, dict): # Manifest of a chunked value.
+        keys = [chunkkey(key, i) for i in range(stored['chunks'])]
+        chunks = memcache.get_multi(keys)
+        if len(chunks) != len(keys):
+            logging.info('Chunk of %s has been evicted' % key)
+            return None, None, None
+        return [chunks[k] for k in keys], stored['codec'], stored.get('digest')
+    value, codec, digest = unpack(stored)
+    return [value], codec, digest
+
+# Most keys kept in an index.
+MAXINDEX = 100000
+# Slots of an index read with one get_multi.
+INDEXBATCH = 1000
+
+def countkey(index):
+    """Memcache key of the number of keys ever added to index."""
+    return 'index:%s:count' % index
+
+def slotkey(index, n):
+    """Memcache key of the slot of the n-th key added to index."""
+    return 'index:%s:%d' % (index, n % MAXINDEX)
+
+def index_keys(index):
+    """List of the keys in index, most recently added last."""
+    count = memcache.get(countkey(index)) or 0
+    slots = [slotkey(index, n) for n in range(max(1, count - MAXINDEX + 1), count + 1)]
+    keys = []
+    for i in range(0, len(slots), INDEXBATCH):
+        found = memcache.get_multi(slots[i:i + INDEXBATCH])
+        keys.extend(found[slot] for slot in slots[i:i + INDEXBATCH] if slot in found)
+    latest = dict((key, n) for n, key in enumerate(keys)) # Keys added more than once are listed once.
+    return [key for n, key in enumerate(keys) if latest[key] == n]
+
+def add_to_index(index, keys):
+    """Add keys to index, in the slots after those of earlier requests."""
+    if not keys:
+        return
+    count = memcache.incr(countkey(index), delta=len(keys), initial_value=0)
+    if count is None:
+        logging.warning('Failed to add %d keys to index %s' % (len(keys), index))
+        return
+    start = count - len(keys) + 1
+    memcache.set_multi(dict((slotkey(index, start + i), key) for i, key in enumerate(keys)))
+
+def pack(value, codec, digest):
+    """What to store in memcache for a value compressed with codec, with its sha512 hexdigest."""
+    return (codec, value, digest)
+
+def unpack(stored):
+    """Returns (value, codec, digest) from what pack (or an earlier version, without the digest) stored."""
+    if isinstance(stored, tuple):
+        if len(stored) == 3:
+            return stored[1], stored[0], stored[2]
+        return stored[1], stored[0], None
+    return stored, None, None
+
+
+def etagmatches(header, etag):
+    """Whether the If-None-Match header lists etag."""
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
 class GetHandler(webapp.RequestHandler):
     def get(self):
         key = self.request.get('key')
         logging.info('Cache request for key: %s' % key)
-        value = memcache.get(key)
-        hit = value != None
-        self.response.out.write(json.dumps({'key': key, 'hit' : hit}))
+        chunks, codec, digest = fetch(key, memcache.get(key))
+        hit = chunks != None
+        result = {'key': key, 'hit' : hit}
+        if hit:
+            if digest is None: # Saved by an earlier version.
+                h = hashlib.sha512()
+                for chunk in chunks:
+                    h.update(chunk)
+                digest = h.hexdigest()
+            result['value_sha512'] = digest
+            etag = '"%s"' % result['value_sha512']
+            self.response.headers.add_header('Cache-Control', HITCACHECONTROL)
+            self.response.headers.add_header('ETag', etag)
+            if etagmatches(self.request.headers.get('If-None-Match', ''), etag):
+                logging.info('Cache hit, not modified')
+                self.response.set_status(304)
+                return
+        if codec:
+            result['codec'] = codec
+        if hit and self.request.get('digest') == result['value_sha512']:
+            logging.info('Cache hit, not modified')
+            result['notmodified'] = True
+            chunks = []
+        self.response.out.write(json.dumps(result))
         self.response.out.write('\n\n')
         if hit:
             logging.info('Cache hit')
-            self.response.headers.add_header('Cache-Control', 'public, max-age=86400')
-            self.response.out.write(value)
+            for chunk in chunks:
+                self.response.out.write(chunk)
         else:
             # Cache miss
             self.response.headers.add_header('Cache-Control', 'no-cache')
@@ -41,15 +198,87 @@ class GetHandler(webapp.RequestHandler):
     
 class SetHandler(webapp.RequestHandler):
     def post(self):
-        key = json.loads(self.request.body_file.readline())['key']
+        body = self.request.body_file
+        header = body.readline()
+        request = json.loads(header)
+        key = request['key']
+        blank = body.readline() # Skip blank line
+        size = int(self.request.headers['Content-Length']) - len(header) - len(blank)
+        cached, digest = store(key, body.read, size, request.get('codec'))
+        if request.get('index'):
+            add_to_index(request['index'], [key])
+        self.response.out.write(json.dumps({'key' : key, 'cached' : cached, 'value_sha512' : digest}))
+        self.response.out.write('\n\n')
+
+class GetMultiHandler(webapp.RequestHandler):
+    def post(self):
+        keys = json.loads(self.request.body_file.readline())['keys']
+        logging.info('Cache request for %d keys' % len(keys))
+        stored = memcache.get_multi(keys)
+        values, codecs, _ = zip(*[fetch(key, stored.get(key)) for key in keys]) or ([], [], [])
+        hits = [chunks is not None for chunks in values]
+        logging.info('%d cache hits' % sum(hits))
+        self.response.headers.add_header('Cache-Control', 'no-cache')
+        result = {'keys' : keys, 'hits' : hits,
+                  'sizes' : [sum(len(chunk) for chunk in chunks or []) for chunks in values]}
+        if any(codecs):
+            result['codecs'] = codecs
+        self.response.out.write(json.dumps(result))
+        self.response.out.write('\n\n')
+        for chunks in values:
+            for chunk in chunks or []:
+                self.response.out.write(chunk)
+
+class SetMultiHandler(webapp.RequestHandler):
+    def post(self):
+        request = json.loads(self.request.body_file.readline())
         self.request.body_file.readline() # Skip blank line
-        value = self.request.body_file.read()
-        memcache.set(key, value)
-        self.response.out.write(json.dumps({'key' : key, 'cached' : True,
-                                           'value_sha512' : hashlib.sha512(value).hexdigest()}))
+        keys = request['keys']
+        codecs = request.get('codecs') or [None] * len(keys)
+        small, cached, digests = {}, {}, []
+        for key, size, codec in zip(keys, request['sizes'], codecs):
+            if size <= CHUNKSIZE:
+                value = self.request.body_file.read(size)
+                digests.append(hashlib.sha512(value).hexdigest())
+                small[key] = pack(value, codec, digests[-1])
+            else: # Large values are stored in chunks as they are read.
+                cached[key], digest = store(key, self.request.body_file.read, size, codec)
+                digests.append(digest)
+        failed = memcache.set_multi(small)
+        if request.get('index'):
+            add_to_index(request['index'], keys)
+        self.response.out.write(json.dumps({'keys' : keys,
+                                            'cached' : [cached.get(key, key not in failed) for key in keys],
+                                            'value_sha512' : digests}))
+        self.response.out.write('\n\n')
+
+class KeysHandler(webapp.RequestHandler):
+    def get(self):
+        index = self.request.get('index')
+        self.response.headers.add_header('Cache-Control', 'no-cache')
+        self.response.out.write(json.dumps({'index' : index, 'keys' : index_keys(index)}))
+        self.response.out.write('\n\n')
+
+class LeaseHandler(webapp.RequestHandler):
+    def post(self):
+        request = json.loads(self.request.body_file.readline())
+        acquired = memcache.add('lease:' + request['key'], request['owner'], time=request['ttl'])
+        logging.info('Lease on %s %s' % (request['key'], 'acquired' if acquired else 'held by another client'))
+        self.response.out.write(json.dumps({'key' : request['key'], 'acquired' : acquired}))
+        self.response.out.write('\n\n')
+
+class ReleaseHandler(webapp.RequestHandler):
+    def post(self):
+        request = json.loads(self.request.body_file.readline())
+        leasekey = 'lease:' + request['key']
+        released = memcache.get(leasekey) == request['owner'] and memcache.delete(leasekey) == 2
+        self.response.out.write(json.dumps({'key' : request['key'], 'released' : released}))
         self.response.out.write('\n\n')
 
-application = webapp.WSGIApplication([('/get', GetHandler), ('/set', SetHandler)],
+application = webapp.WSGIApplication([('/get', GetHandler), ('/set', SetHandler),
+                                      ('/getmulti', GetMultiHandler), ('/setmulti', SetMultiHandler),
+                                      ('/lease', LeaseHandler), ('/release', ReleaseHandler),
+                                      ('/keys', KeysHandler)],
                                      debug=True)
 
 
@@ -9,10 +9,13 @@ import logging
 
 class InternalKeyCache(kc.KeyCache):
     def __init__(self, app):
+        kc.KeyCache.__init__(self)
         self.app = app
         
-    def server_fetch(self, hook, data):
+    def server_fetch(self, hook, data, deadline=None):
         # Override for testing purposes to directly call the handler."""
+        if isinstance(data, list):
+            data = kc.joinpieces(data)
         if not data: # Get request
             res =  self.app.get('/' + hook)
         else:
@@ -40,4 +43,66 @@ class TestKeyStore(FunctionalTestCase, unittest.TestCase):
         self.assertEqual(self.kcclient['emptykey1111'], None)
         self.kcclient['testkey'] = 'foo';
         self.assertEqual(self.kcclient['testkey'], 'foo')
-    
+
+    def test_multi(self):
+        """Test reading and writing several keys in one request."""
+        self.kcclient.set_many({'multi1' : 'foo', 'multi2' : 'bar'})
+        self.assertEqual(self.kcclient.get_many(['multi1', 'multimiss', 'multi2']),
+                         {'multi1' : 'foo', 'multi2' : 'bar'})
+        self.assertEqual(self.kcclient.get('multi2'), 'bar')
+
+    def test_lease(self):
+        """Only one client can hold a lease until it is released."""
+        other = InternalKeyCache(self)
+        self.assertTrue(self.kcclient.acquire_lease('leasekey', 60))
+        self.assertFalse(other.acquire_lease('leasekey', 60))
+        other.release_lease('leasekey') # Not the owner so this does nothing.
+        self.assertFalse(other.acquire_lease('leasekey', 60))
+        self.kcclient.release_lease('leasekey')
+        self.assertTrue(other.acquire_lease('leasekey', 60))
+
+    def test_compression(self):
+        """Compressed values are stored with their codec and can be read by any client."""
+        compressing = InternalKeyCache(self)
+        compressing.compression = 'zlib'
+        compressing.set('compressed', 'x' * 100000)
+        self.assertEqual(self.kcclient.get('compressed'), 'x' * 100000)
+        self.assertEqual(self.kcclient.get_many(['compressed']), {'compressed' : 'x' * 100000})
+
+    def test_chunked(self):
+        """Values over the memcache item limit are stored in chunks."""
+        value = ''.join(chr(i % 251) for i in range(3 * keycacheserver.CHUNKSIZE))
+        self.kcclient.set('large', value)
+        self.assertEqual(memcache.get('large')['chunks'], 4)
+        self.assertEqual(self.kcclient.get('large'), value)
+        self.kcclient.set_many({'largemulti' : value, 'small' : 'x'})
+        self.assertEqual(self.kcclient.get_many(['largemulti', 'small']), {'largemulti' : value, 'small' : 'x'})
+        memcache.delete(keycacheserver.chunkkey('large', 2))
+        self.assertEqual(self.kcclient.get('large'), None)
+
+    def test_digest(self):
+        """Digests are saved with values, values saved without one are hashed when read."""
+        self.kcclient.set('hashed', 'value')
+        digest = memcache.get('hashed')[2]
+        self.assertEqual(self.kcclient.revalidate('hashed'), (True, True, 'value', digest))
+        memcache.set('legacy', kc.Serializer().dumps('value')[0])
+        self.assertEqual(self.kcclient.revalidate('legacy'), (True, True, 'value', digest))
+
+    def test_index(self):
+        """Keys set with an index are listed by the keys request."""
+        self.kcclient.set('indexed1', 1, index='fn')
+        self.kcclient.set_many({'indexed2' : 2, 'indexed3' : 3}, index='fn')
+        self.kcclient.set('indexed1', 1, index='fn')
+        self.kcclient.set('other', 1, index='otherfn')
+        self.assertEqual(sorted(self.kcclient.index_keys('fn')), ['indexed1', 'indexed2', 'indexed3'])
+        self.assertEqual(self.kcclient.index_keys('missing'), [])
+
+    def test_index_wraps(self):
+        """Only the most recent MAXINDEX additions are kept."""
+        maxindex, keycacheserver.MAXINDEX = keycacheserver.MAXINDEX, 3
+        try:
+            for i in range(5):
+                self.kcclient.set('wrap%d' % i, i, index='wraps')
+            self.assertEqual(self.kcclient.index_keys('wraps'), ['wrap2', 'wrap3', 'wrap4'])
+        finally:
+            keycacheserver.MAXINDEX = maxindex
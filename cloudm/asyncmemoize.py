@@ -0,0 +1,448 @@
+"""Memoization of asyncio coroutines.
+
+Requires trollius (asyncio for python 2).
+
+from cloudm.asyncmemoize import asynccloudmemoize
+
+@asynccloudmemoize
+@asyncio.coroutine
+def longcalc(params):
+    ...
+
+result = yield From(longcalc(1))
+
+Keys are generated exactly as for @cloudmemoize so results are shared with the
+synchronous decorators. Lookups on the key server use AsyncKeyCache, which makes
+non-blocking HTTP requests (many can be in flight at once) using the same protocol
+as KeyCache. Memory cache hits are returned without leaving the event loop, other
+synchronous caches (e.g. DiskCache) are accessed in the loop's default executor. As for
+@cloudmemoize a cache which fails is a miss, and expired results (with stale) are returned
+while they are refreshed in the background.
+"""
+
+import time
+import socket
+import logging
+import urllib2
+import urlparse
+from StringIO import StringIO
+from functools import partial
+import trollius as asyncio
+from trollius import From, Return
+from keycache import (KeyCache, ServerUnavailable, split_payload, joinpieces, set_params, setmulti_params,
+                      decodeerrors)
+from lrucache import LRUCache, approxsize
+from stats import timer
+from memoize import BaseClassMemoize, decorator_apply, memorycache, sharedcaches, diskcaches, hitsize
+
+
+class AsyncKeyCache(KeyCache):
+    """KeyCache whose methods are coroutines (get, lookup, lookup_entry, revalidate, set, get_many,
+    set_many, index_keys, acquire_lease, release_lease and the item accessors).
+
+    Up to poolsize idle keep-alive connections are kept, each concurrent request uses its own
+    connection. Connecting waits at most connecttimeout seconds and the reply timeout seconds, a
+    lookup (get or get_many) at most budget seconds, and failures open the circuit breaker as for
+    KeyCache."""
+    asynchronous = True
+
+    def __init__(self, server="http://keycache.42quarks.com/", poolsize=4, loop=None, **kwargs):
+        KeyCache.__init__(self, server, poolsize=poolsize, **kwargs)
+        self.loop = loop
+        self.idle = []
+
+    @asyncio.coroutine
+    def get(self, key):
+        hit, value = yield From(self.lookup(key))
+        raise Return(value)
+
+    @asyncio.coroutine
+    def lookup(self, key):
+        hit, modified, value, digest = yield From(self.revalidate(key))
+        raise Return((hit, value))
+
+    @asyncio.coroutine
+    def lookup_entry(self, key):
+        hit, modified, value, digest = yield From(self.revalidate(key))
+        raise Return((hit, value, False, digest))
+
+    @asyncio.coroutine
+    def revalidate(self, key, digest=None):
+        """Conditional lookup of key, returns (hit, modified, value, digest) as KeyCache.revalidate."""
+        params = {'key' : key}
+        if digest is not None:
+            params['digest'] = digest
+        res = yield From(self.budgeted('get', self.server_rpc('get', params=params)))
+        if res.get('notmodified'):
+            raise Return((True, False, None, digest))
+        value = None
+        if res['payload'] is not None and res.get('hit') is not False:
+            try:
+                value = self.decode_value(res['payload'], res.get('codec'))
+            except decodeerrors, e:
+                raise urllib2.URLError(e)
+        hit = res['hit'] if 'hit' in res else value is not None
+        raise Return((hit, hit, value, res.get('value_sha512')))
+
+    @asyncio.coroutine
+    def set(self, key, value, index=None):
+        payload, codec = self.encode_value(value)
+        params = set_params(key, codec)
+        if index is not None:
+            params['index'] = index
+        yield From(self.server_rpc('set', params=params, payload=payload))
+
+    @asyncio.coroutine
+    def get_many(self, keys):
+        keys = list(keys)
+        requests = [self.server_rpc('getmulti', params={'keys' : keys[i:i + self.batchsize]}, post=True)
+                    for i in range(0, len(keys), self.batchsize)]
+        out = {}
+        replies = yield From(self.budgeted('getmulti', asyncio.gather(*requests, loop=self.loop)))
+        for res in replies:
+            codecs = res.get('codecs') or [None] * len(res['keys'])
+            hits = res.get('hits') or [size > 0 for size in res['sizes']]
+            for key, hit, value, codec in zip(res['keys'], hits, split_payload(res['payload'], res['sizes']),
+                                              codecs):
+                if hit:
+                    try:
+                        out[key] = self.decode_value(value, codec)
+                    except decodeerrors, e:
+                        logging.warning('Ignoring corrupt value of %s from %s: %s', key, self.server, e)
+        raise Return(out)
+
+    @asyncio.coroutine
+    def set_many(self, mapping, index=None):
+        items = []
+        for key, value in mapping.iteritems():
+            value, codec = self.encode_value(value)
+            items.append((key, joinpieces(value), codec))
+        requests = [self.server_setmulti(items[i:i + self.batchsize], index)
+                    for i in range(0, len(items), self.batchsize)]
+        yield From(asyncio.gather(*requests, loop=self.loop))
+
+    @asyncio.coroutine
+    def server_setmulti(self, batch, index=None):
+        params = setmulti_params(batch)
+        if index is not None:
+            params['index'] = index
+        yield From(self.server_rpc('setmulti', payload=''.join(value for _, value, _ in batch), post=True,
+                                   params=params))
+
+    @asyncio.coroutine
+    def index_keys(self, index):
+        res = yield From(self.server_rpc('keys', params={'index' : index}))
+        raise Return(res['keys'])
+
+    @asyncio.coroutine
+    def acquire_lease(self, key, ttl):
+        try:
+            res = yield From(self.server_rpc('lease', params={'key' : key, 'ttl' : ttl, 'owner' : self.owner},
+                                             post=True))
+        except urllib2.HTTPError, e:
+            if e.code not in (404, 405):
+                raise
+            raise Return(True)
+        raise Return(res['acquired'])
+
+    @asyncio.coroutine
+    def release_lease(self, key):
+        try:
+            yield From(self.server_rpc('release', params={'key' : key, 'owner' : self.owner}, post=True))
+        except urllib2.HTTPError, e:
+            if e.code not in (404, 405):
+                raise
+
+    @asyncio.coroutine
+    def budgeted(self, name, request):
+        """Result of request (a coroutine or future), failing as KeyCache does if it takes more than
+        budget seconds."""
+        if self.budget is None:
+            result = yield From(request)
+            raise Return(result)
+        start = time.time()
+        try:
+            result = yield From(asyncio.wait_for(request, self.budget, loop=self.loop))
+        except asyncio.TimeoutError:
+            self.failed(name, start, socket.timeout('Latency budget exceeded'))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def server_rpc(self, hook, params={}, payload=None, post=False):
+        hook, data = self.encode_request(hook, params, payload, post)
+        response = yield From(self.server_fetch(hook, data))
+        try:
+            raise Return(self.decode_response(response))
+        except decodeerrors, e:
+            raise urllib2.URLError(e)
+
+    @asyncio.coroutine
+    def server_fetch(self, hook, data=None):
+        """Make a HTTP/1.1 request to server/hook and return the body as a file object."""
+        url = urlparse.urlsplit(self.server)
+        name = hook.split('?')[0]
+        if not self.breaker.allow():
+            raise ServerUnavailable('%s is unavailable (circuit breaker open)' % self.server)
+        logging.info('Fetching %s' % (self.server + hook))
+        if data is not None and not isinstance(data, list):
+            data = [data]
+        request = ['%s %s%s HTTP/1.1' % ('GET' if data is None else 'POST', url.path or '/', hook),
+                   'Host: %s' % url.netloc]
+        if data is not None:
+            request += ['Content-Type: application/x-www-form-urlencoded',
+                        'Content-Length: %d' % sum(len(piece) for piece in data)]
+        request = ['\r\n'.join(request) + '\r\n\r\n'] + (data or [])
+
+        start = time.time()
+        conn = None
+        try:
+            if self.idle:
+                conn, reused = self.idle.pop(), True
+            else:
+                conn, reused = (yield From(self.connect(url))), False
+            try:
+                status, headers, body = yield From(self.reply(conn, request))
+            except (EOFError, EnvironmentError):
+                if not reused:
+                    raise
+                # The server probably closed the idle connection, try again with a new one.
+                conn[1].close()
+                conn = None
+                conn = yield From(self.connect(url))
+                status, headers, body = yield From(self.reply(conn, request))
+        # Not just socket.error, trollius raises its own ConnectionRefusedError (an OSError).
+        except (EOFError, EnvironmentError, asyncio.TimeoutError), e:
+            if conn is not None:
+                conn[1].close()
+            self.failed(name, start, e)
+        except asyncio.CancelledError: # E.g. the lookup's budget ran out, the reply may be half read.
+            if conn is not None:
+                conn[1].close()
+            raise
+        if headers.get('connection', '').lower() == 'close' or len(self.idle) >= self.poolsize:
+            conn[1].close()
+        else:
+            self.idle.append(conn)
+        if status != 200:
+            if status >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            self.latencies.record(name, time.time() - start, error=True)
+            raise urllib2.HTTPError(self.server + hook, status, '', None, StringIO(body))
+        self.succeeded(name, start)
+        raise Return(StringIO(body))
+
+    @asyncio.coroutine
+    def connect(self, url):
+        port = url.port or (443 if url.scheme == 'https' else 80)
+        conn = yield From(asyncio.wait_for(asyncio.open_connection(url.hostname, port, ssl=url.scheme == 'https',
+                                                                   loop=self.loop),
+                                           self.connecttimeout, loop=self.loop))
+        raise Return(conn)
+
+    @asyncio.coroutine
+    def reply(self, conn, request):
+        """exchange, waiting at most timeout seconds."""
+        response = yield From(asyncio.wait_for(self.exchange(conn, request), self.timeout, loop=self.loop))
+        raise Return(response)
+
+    @asyncio.coroutine
+    def exchange(self, conn, request):
+        """Send request (a list of strings and memoryviews) on conn and read the response.
+        Returns (status, headers, body)."""
+        reader, writer = conn
+        for piece in request:
+            writer.write(piece)
+        status = yield From(reader.readline())
+        if not status:
+            raise EOFError('Connection closed by server')
+        status = int(status.split()[1])
+        headers = {}
+        while True:
+            line = (yield From(reader.readline())).strip()
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            body = yield From(reader.readexactly(int(headers['content-length'])))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((yield From(reader.readline())).split(';')[0], 16)
+                if size == 0:
+                    yield From(reader.readline())
+                    break
+                chunks.append((yield From(reader.readexactly(size))))
+                yield From(reader.readline())
+            body = ''.join(chunks)
+        else:
+            body = yield From(reader.read())
+            headers['connection'] = 'close'
+        raise Return((status, headers, body))
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+class AsyncClassMemoize(BaseClassMemoize):
+    """BaseClassMemoize for coroutine functions, calling the memoized function returns a coroutine.
+
+    Caches with an asynchronous attribute (AsyncKeyCache) are awaited, LRUCaches are used
+    directly and other caches are accessed in an executor so the event loop is never blocked.
+    Other keyword arguments (policy, instancekey, ...) are as for BaseClassMemoize, but leases
+    aren't supported."""
+    map = prefetch = None # Memoized coroutines don't have map or prefetch.
+
+    def __init__(self, func, caches, loop=None, **kwargs):
+        BaseClassMemoize.__init__(self, func, caches, **kwargs)
+        self.loop = loop
+
+    @asyncio.coroutine
+    def __call__(self, *args, **xargs):
+        start = timer()
+        key = self.hashargs((args, xargs))
+        hashtime = timer() - start
+
+        cacheindex = len(self.caches)
+        hit, value, nbytes = False, None, 0
+        lookups = []
+        use = self.policy.tiers(self)
+        if not self.cachecontrol['writeonly']:
+            for i, d in enumerate(self.caches): # Find the first cache to have a hit.
+                if not use[i]:
+                    continue
+                start = timer()
+                hit, value, expired, digest = yield From(self.cacheentry(d, key))
+                seconds = timer() - start
+                lookups.append((i, seconds))
+                if hit:
+                    cacheindex = i
+                    nbytes = hitsize(d, value)
+                    self.policy.observe(self, i, seconds, nbytes)
+                    break
+                self.policy.observe(self, i, seconds, None)
+
+        self.stats.record(hashtime, lookups, cacheindex if hit else None, nbytes)
+        if not hit:
+            start = timer()
+            value = yield From(self.func(*args, **xargs))
+            self.stats.compute(timer() - start, approxsize(value))
+        elif expired: # Use it now, the refresh updates the caches.
+            self.stats.stalehit()
+            self.refresh(key, cacheindex, value, digest, args, xargs)
+            raise Return(value)
+
+        self.update(self.caches[0:cacheindex], use, key, value)
+        raise Return(value)
+
+    def update(self, caches, use, key, value):
+        """Save value in the caches for which use is True, without waiting for slow caches."""
+        for d, used in zip(caches, use):
+            if not used:
+                continue
+            if isinstance(d, LRUCache):
+                d[key] = value
+            elif getattr(d, 'asynchronous', False):
+                asyncio.ensure_future(self.asyncset(d, key, value), loop=self.loop)
+            else:
+                self.getloop().run_in_executor(None, self.cacheset, d, key, value)
+
+    @asyncio.coroutine
+    def asyncset(self, d, key, value):
+        """Save value in the asynchronous cache d, logging any failure (as cacheset)."""
+        try:
+            yield From(d.set(key, value))
+        except EnvironmentError, e:
+            logging.warning('Saving to %s failed for %s: %s', type(d).__name__, self.func.__name__, e)
+
+    @asyncio.coroutine
+    def cacheget(self, d, key):
+        """(hit, value) for key in cache d, a cache which fails is a miss."""
+        entry = yield From(self.cacheentry(d, key))
+        raise Return(entry[:2])
+
+    @asyncio.coroutine
+    def cacheentry(self, d, key):
+        """(hit, value, expired, digest) for key in cache d (see memoize.lookup_entry)."""
+        if isinstance(d, LRUCache):
+            raise Return(d.lookup_entry(key))
+        if not getattr(d, 'asynchronous', False):
+            # BaseClassMemoize.cacheentry, which logs failures, in a thread.
+            raise Return((yield From(self.getloop().run_in_executor(None, BaseClassMemoize.cacheentry, self, d,
+                                                                    key))))
+        try:
+            entry = yield From(d.lookup_entry(key))
+        except EnvironmentError, e:
+            logging.warning('Lookup in %s failed for %s, calculating instead: %s', type(d).__name__,
+                            self.func.__name__, e)
+            raise Return((False, None, False, None))
+        raise Return(entry)
+
+    def refresh(self, key, cacheindex, value, digest, args, xargs):
+        """Refresh the expired value of key found in self.caches[cacheindex] in the background (unless
+        it is already being refreshed)."""
+        with self.inflightlock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        asyncio.ensure_future(self.freshen(key, cacheindex, args, xargs), loop=self.loop)
+
+    @asyncio.coroutine
+    def freshen(self, key, cacheindex, args, xargs):
+        """Look for a fresh value of key in the caches after cacheindex, otherwise evaluate the function
+        again, and save it in the caches before."""
+        try:
+            use = self.policy.tiers(self)
+            for i in range(cacheindex + 1, len(self.caches)):
+                if not use[i]:
+                    continue
+                hit, fresh, expired, digest = yield From(self.cacheentry(self.caches[i], key))
+                if hit and not expired:
+                    break
+            else:
+                i = len(self.caches)
+                fresh = yield From(self.func(*args, **xargs))
+            self.update(self.caches[0:i], use, key, fresh)
+        except Exception:
+            logging.exception('Refreshing %s failed for %s', key, self.func.__name__)
+        finally:
+            with self.inflightlock:
+                self.refreshing.discard(key)
+
+    def getloop(self):
+        return self.loop or asyncio.get_event_loop()
+
+
+default_asynckeycache = None
+# Key cache used by @asynccloudmemoize (an AsyncKeyCache() is created when the first coroutine is
+# decorated), which should use the same server as memoize.default_keycache for results to be shared
+# with @cloudmemoize.
+
+def asynckeycaches():
+    """default_asynckeycache (created if it hasn't been set) as a list."""
+    global default_asynckeycache
+    if default_asynckeycache is None:
+        default_asynckeycache = AsyncKeyCache()
+    return [default_asynckeycache]
+
+def asynccloudmemoize(func=None, disk=False, policy=None, shared=False, instancekey=None, **cacheargs):
+    """Decorator for memoizing a coroutine using a memory based cache and the key server.
+
+    Takes the same arguments as cloudmemoize except lease and index (coroutines don't have
+    prefetch)."""
+    if func is None:
+        return partial(asynccloudmemoize, disk=disk, policy=policy, shared=shared, instancekey=instancekey,
+                       **cacheargs)
+    return decorator_apply(partial(AsyncClassMemoize, caches=[memorycache(**cacheargs)] + sharedcaches(shared) +
+                                                             diskcaches(disk) + asynckeycaches(),
+                                   policy=policy, instancekey=instancekey), func)
+
+def asyncmemmemoize(func=None, shared=False, instancekey=None, **cacheargs):
+    """Decorator for memoizing a coroutine using a memory based cache, with the arguments of memmemoize."""
+    if func is None:
+        return partial(asyncmemmemoize, shared=shared, instancekey=instancekey, **cacheargs)
+    return decorator_apply(partial(AsyncClassMemoize, caches=[memorycache(**cacheargs)] + sharedcaches(shared),
+                                   instancekey=instancekey), func)
@@ -0,0 +1,263 @@
+"""Benchmarks of the cost of memoization.
+
+Measures decorating functions, hashing arguments, hits and misses on each cache tier,
+serializing and transferring results of different sizes and concurrent writes, against a
+KeyCacheServer started in this process (so no network is needed). The results are printed
+(or saved with --output) as JSON so runs can be compared:
+
+$ python -m cloudm.benchmark --output before.json
+$ python -m cloudm.benchmark --compare before.json
+
+--compare prints the ratio of each time to the time in the earlier run (below 1 is faster).
+--scale 0.1 runs fewer repetitions (quicker but noisier) and --sections picks benchmarks.
+
+Every result is a dictionary with a 'name' and 'seconds' (per operation), and some have a
+'throughput' (bytes or operations per second).
+"""
+
+import os
+import sys
+import json
+import types
+import shutil
+import platform
+import argparse
+import tempfile
+from threading import Thread
+from stats import timer
+from lrucache import LRUCache
+from diskcache import DiskCache
+from sharedcache import SharedCache
+from keycache import KeyCache, ThreadWriteKeyCache, Serializer, connection_pool, joinpieces
+from policy import AdmissionPolicy
+from memoize import BaseClassMemoize
+import memoize
+import keyhash
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+sections = ['decorate', 'hashargs', 'tiers', 'transfer', 'writes']
+
+
+def measure(fn, number, repeat=3):
+    """Seconds per call of fn(), the best of repeat runs of number calls."""
+    number = max(1, int(number))
+    best = None
+    for i in range(repeat):
+        start = timer()
+        for j in xrange(number):
+            fn()
+        seconds = (timer() - start) / number
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def identity(x):
+    return x
+
+
+def bench_decorate(context):
+    """Building a memoizer and its function hash (buildfnhash), including hashing compiled (.so) modules
+    with and without their digest cached (see memoize.ModuleDigests)."""
+    out = [{'name' : 'python function', 'seconds' : measure(lambda: BaseClassMemoize(identity, [LRUCache()]),
+                                                          1000 * context.scale)},
+           {'name' : 'python function buildfnhash',
+            'seconds' : measure(lambda: BaseClassMemoize(identity, [LRUCache()]).buildfnhash(), 1000 * context.scale)}]
+    moduledigests = memoize.default_moduledigests
+    for size in (1024 * 1024, 16 * 1024 * 1024):
+        # A function which appears to come from a compiled module of size bytes.
+        path = os.path.join(context.tmpdir, 'module%d.so' % size)
+        with open(path, 'wb') as f:
+            f.write('\0' * size)
+        module = types.ModuleType('cloudm_benchmark_module%d' % size)
+        module.__file__ = path
+        sys.modules[module.__name__] = module
+        try:
+            fn = CompiledFunction()
+            fn.__module__ = module.__name__
+            def uncached():
+                memoize.default_moduledigests = memoize.ModuleDigests()
+                BaseClassMemoize(fn, [LRUCache()]).buildfnhash()
+            seconds = measure(uncached, 20 * context.scale)
+            cached = measure(lambda: BaseClassMemoize(fn, [LRUCache()]).buildfnhash(), 1000 * context.scale)
+        finally:
+            memoize.default_moduledigests = moduledigests
+            del sys.modules[module.__name__]
+        out.append({'name' : 'compiled module %d bytes' % size, 'seconds' : seconds, 'size' : size,
+                    'throughput' : size / seconds})
+        out.append({'name' : 'compiled module %d bytes cached' % size, 'seconds' : cached, 'size' : size})
+    return out
+
+
+class CompiledFunction(object):
+    """Callable without func_code, like the functions of compiled modules."""
+    __name__ = 'compiled'
+
+    def __call__(self, x):
+        return x
+
+
+def bench_hashargs(context):
+    """keyhash.default_keyhasher on arguments of each type and size."""
+    args = [('int', 12345), ('float', 1.5), ('none', None), ('tuple of 10 ints', tuple(range(10))),
+            ('dict of 10', dict((str(i), i) for i in range(10))), ('object', Serializer())]
+    for size in (100, 10 * 1024, 1024 * 1024):
+        args.append(('str %d' % size, 'x' * size))
+        args.append(('unicode %d' % size, u'x' * size))
+        args.append(('list of %d ints' % (size // 100), range(size // 100)))
+        if numpy is not None:
+            args.append(('ndarray %d' % size, numpy.zeros(size // 8)))
+    out = []
+    hasher = keyhash.default_keyhasher
+    for name, arg in args:
+        number = 100000 * context.scale / (1 + approxbytes(arg) // 1000)
+        seconds = measure(lambda: hasher.hashargs('fnhash', ((arg,), {})), number)
+        out.append({'name' : name, 'seconds' : seconds, 'size' : approxbytes(arg)})
+    return out
+
+
+def approxbytes(arg):
+    if numpy is not None and isinstance(arg, numpy.ndarray):
+        return arg.nbytes
+    if isinstance(arg, (str, unicode, list)):
+        return len(arg) * (8 if isinstance(arg, list) else 1)
+    return 0
+
+
+def bench_tiers(context):
+    """Lookups which hit and miss on each tier, and whole memoized calls which hit and miss."""
+    out = []
+    value = 'x' * 1000
+    for name, tier in context.tiers():
+        tier.set('hit', value)
+        out.append({'name' : '%s get hit' % name, 'seconds' : measure(lambda: tier.get('hit'), 1000 * context.scale)})
+        out.append({'name' : '%s get miss' % name,
+                    'seconds' : measure(lambda: tier.get('miss'), 1000 * context.scale)})
+        memoized = BaseClassMemoize(lambda x: value, [tier], policy=AdmissionPolicy(), singleflight=False)
+        memoized(0)
+        out.append({'name' : '%s call hit' % name, 'seconds' : measure(lambda: memoized(0), 1000 * context.scale)})
+        misses = iter(xrange(1, sys.maxint))
+        out.append({'name' : '%s call miss' % name,
+                    'seconds' : measure(lambda: memoized(next(misses)), 300 * context.scale)})
+    return out
+
+
+def bench_transfer(context):
+    """Serializing and sending results to (and reading them from) the key server, by size, and
+    revalidating results which haven't changed."""
+    serializer = Serializer()
+    kc = KeyCache(context.server.url)
+    payloads = [('str', lambda size: 'x' * size)]
+    if numpy is not None:
+        payloads.append(('ndarray', lambda size: numpy.zeros(size // 8)))
+    out = []
+    for kind, make in payloads:
+        for size in (1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024):
+            value = make(size)
+            number = max(1, 100 * context.scale * 1024 * 1024 // max(size, 64 * 1024))
+            data = joinpieces(serializer.dumps(value))
+            for name, fn in [('dumps', lambda: serializer.dumps(value)), ('loads', lambda: serializer.loads(data)),
+                             ('set', lambda: kc.set('transfer', value)), ('get', lambda: kc.get('transfer'))]:
+                if name == 'get':
+                    kc.set('transfer', value)
+                seconds = measure(fn, number)
+                out.append({'name' : '%s %s %d' % (name, kind, size), 'seconds' : seconds, 'size' : size,
+                            'throughput' : size / seconds})
+            # Checking a value we already hold is current (see KeyCache.revalidate).
+            digest = kc.revalidate('transfer')[3]
+            out.append({'name' : 'revalidate %s %d' % (kind, size), 'size' : size,
+                        'seconds' : measure(lambda: kc.revalidate('transfer', digest), number)})
+    return out
+
+
+def bench_writes(context):
+    """Memoized calls which miss, from concurrent threads, with results written by ThreadWriteKeyCache."""
+    out = []
+    value = 'x' * 1000
+    calls = int(max(10, 200 * context.scale))
+    for threads in (1, 4, 16):
+        kc = ThreadWriteKeyCache(context.server.url, poolsize=threads)
+        memoized = BaseClassMemoize(lambda x: value, [LRUCache(), kc], policy=AdmissionPolicy())
+        def caller(n):
+            for i in range(calls):
+                memoized((threads, n, i))
+        workers = [Thread(target=caller, args=(n,)) for n in range(threads)]
+        start = timer()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        kc.flush()
+        seconds = timer() - start
+        out.append({'name' : '%d threads' % threads, 'seconds' : seconds / (threads * calls),
+                    'throughput' : threads * calls / seconds})
+    return out
+
+
+class Context(object):
+    """Server, temporary directory and tiers shared by the benchmarks."""
+    def __init__(self, scale=1.0):
+        from server import KeyCacheServer
+        self.scale = scale
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = KeyCacheServer(('127.0.0.1', 0), maxbytes=512 * 1024 * 1024)
+        self.server.start()
+
+    def tiers(self):
+        """(name, cache) for each tier."""
+        return [('memory', LRUCache()),
+                ('shared', SharedCache(os.path.join(self.tmpdir, 'shared'), size=64 * 1024 * 1024)),
+                ('disk', DiskCache(os.path.join(self.tmpdir, 'disk'))),
+                ('server', KeyCache(self.server.url))]
+
+    def close(self):
+        connection_pool(self.server.url).close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+
+def run(names=sections, scale=1.0):
+    """Run the benchmarks in names, returns a dictionary of the results."""
+    context = Context(scale)
+    try:
+        results = dict((name, globals()['bench_' + name](context)) for name in names)
+    finally:
+        context.close()
+    return {'python' : sys.version.split()[0], 'platform' : platform.platform(), 'scale' : scale,
+            'numpy' : numpy is not None and numpy.__version__, 'results' : results}
+
+
+def compare(old, new):
+    """List of (section, name, new seconds / old seconds) for the results in both runs."""
+    out = []
+    for section, results in sorted(new['results'].iteritems()):
+        before = dict((result['name'], result) for result in old['results'].get(section, ()))
+        for result in results:
+            if result['name'] in before and before[result['name']]['seconds']:
+                out.append((section, result['name'], result['seconds'] / before[result['name']]['seconds']))
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the cost of memoization.')
+    parser.add_argument('--sections', nargs='+', choices=sections, default=sections)
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the number of repetitions.')
+    parser.add_argument('--output', help='File to save the results in (JSON).')
+    parser.add_argument('--compare', help='Results of an earlier run to compare with.')
+    args = parser.parse_args(argv)
+    results = run(args.sections, args.scale)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            for section, name, ratio in compare(json.load(f), results):
+                print '%-10s %-40s %.2f' % (section, name, ratio)
+    elif not args.output:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
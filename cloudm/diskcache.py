@@ -0,0 +1,221 @@
+"""Persistent cache stored as files in a local directory.
+
+DiskCache sits between the memory cache and the key server so that results survive
+restarts without a round trip to the server. It behaves like a dictionary which
+returns None for missing keys.
+
+cache = DiskCache('/tmp/mycache', maxbytes=1024 * 1024 * 1024)
+cache['key'] = value
+value = cache['key']
+
+Each value is serialized (see keycache.Serializer) into its own file. Writes go to a
+temporary file which is then renamed into place so several processes can safely share
+the same directory. Large values are read through mmap rather than copied into memory
+first. When the directory grows beyond maxbytes the least recently used files are removed.
+
+With ttl, values expire after ttl seconds and are still returned, flagged as expired by
+lookup_entry, for stale more seconds (see LRUCache). The expiry time and the digest given
+to set are saved in a short header before the serialized value.
+"""
+
+import os
+import time
+import errno
+import mmap
+import struct
+import hashlib
+import logging
+import tempfile
+import cPickle as pickle
+from threading import Lock
+from keycache import default_serializer, MAGIC
+
+default_path = os.path.join(os.path.expanduser('~'), '.cloudm', 'cache')
+
+# Header of values with an expiry time or digest: tag, expiry time (0 for none) and the
+# sha512 of the value on the key server (zeros for none).
+ENTRYTAG = MAGIC + 't'
+ENTRY = struct.Struct('<4sd64s')
+NODIGEST = '\0' * 64
+
+
+class DiskCache(object):
+    """Dictionary-like cache which saves serialized values as files in path.
+
+    maxbytes limits the total size of the directory (None for no limit). Values larger
+    than mmapthreshold bytes are read using mmap, so large numpy arrays are returned as
+    read-only views on the mapped file rather than copies. ttl and stale are as for LRUCache.
+    """
+    def __init__(self, path=default_path, maxbytes=1024 * 1024 * 1024, mmapthreshold=1024 * 1024,
+                 serializer=None, ttl=None, stale=0):
+        self.path = path
+        self.ttl = ttl
+        self.stale = stale
+        self.serializer = serializer or default_serializer
+        self.maxbytes = maxbytes
+        self.mmapthreshold = mmapthreshold
+        self._nbytes = None # Estimate of the directory size, None until scanned.
+        self._lock = Lock()
+
+    def filename(self, key):
+        """Name of the file used to store key."""
+        name = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.path, name[:2], name)
+
+    def get(self, key):
+        return self.lookup(key)[1]
+
+    def lookup(self, key):
+        """(True, value) if key is cached, otherwise (False, None)."""
+        return self.lookup_entry(key)[:2]
+
+    def lookup_entry(self, key):
+        """(hit, value, expired, digest) for key, expired entries are hits within the stale window."""
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size >= self.mmapthreshold:
+                    # The map is closed once nothing (e.g. an array in value) refers to it.
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = f.read()
+            expires, digest = 0.0, NODIGEST
+            if data[:len(ENTRYTAG)] == ENTRYTAG:
+                tag, expires, digest = ENTRY.unpack_from(data)
+                data = buffer(data, ENTRY.size)
+            now = time.time()
+            expired = 0 < expires < now
+            if expired and self.stale is not None and expires + self.stale < now:
+                return False, None, False, None
+            value = self.serializer.loads(data)
+            os.utime(filename, None) # Mark as recently used for eviction.
+            return True, value, expired, digest.encode('hex') if digest != NODIGEST else None
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                logging.warning('Failed to read %s from disk cache: %s', key, e)
+            return False, None, False, None
+        except (pickle.UnpicklingError, EOFError, ValueError, struct.error), e:
+            logging.warning('Corrupt disk cache entry %s: %s', filename, e)
+            return False, None, False, None
+
+    def set(self, key, value, digest=None):
+        pieces = self.serializer.dumps(value)
+        if self.ttl is not None or digest is not None:
+            expires = time.time() + self.ttl if self.ttl is not None else 0.0
+            pieces.insert(0, ENTRY.pack(ENTRYTAG, expires, digest.decode('hex') if digest else NODIGEST))
+        size = sum(len(piece) for piece in pieces)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        filename = self.filename(key)
+        dirname = os.path.dirname(filename)
+        try:
+            os.makedirs(dirname)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file in the same directory and rename it into place so
+        # that readers (in this or other processes) never see a partially written file.
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for piece in pieces:
+                    f.write(piece)
+            rename(tmpname, filename)
+        except:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            if self._nbytes is not None:
+                self._nbytes += size
+        self._evict()
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        try:
+            os.remove(self.filename(key))
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+
+    def __contains__(self, key):
+        return os.path.exists(self.filename(key))
+
+    def entries(self):
+        """Return a list of (last use time, size, filename) for every file in the cache."""
+        out = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                if name.startswith('.tmp'):
+                    continue
+                filename = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue # Removed by another process.
+                out.append((st.st_mtime, st.st_size, filename))
+        return out
+
+    @property
+    def nbytes(self):
+        """Total size of the values in the cache."""
+        return sum(size for _, size, _ in self.entries())
+
+    def __len__(self):
+        return len(self.entries())
+
+    def clear(self):
+        for _, _, filename in self.entries():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        with self._lock:
+            self._nbytes = 0
+
+    def _evict(self):
+        """Remove the least recently used files if the cache is larger than maxbytes.
+
+        The directory is only scanned when the running estimate of its size is over the
+        limit, which also picks up files written by other processes."""
+        if self.maxbytes is None:
+            return
+        with self._lock:
+            if self._nbytes is not None and self._nbytes <= self.maxbytes:
+                return
+            entries = self.entries()
+            nbytes = sum(size for _, size, _ in entries)
+            if nbytes > self.maxbytes:
+                # Evict down to 90% of the limit so that we don't rescan on every write.
+                target = 0.9 * self.maxbytes
+                entries.sort()
+                for _, size, filename in entries:
+                    if nbytes <= target:
+                        break
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass # Already removed by another process.
+                    nbytes -= size
+            self._nbytes = nbytes
+
+
+def rename(src, dst):
+    """Atomically replace dst with src."""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Windows won't rename over an existing file.
+        if os.name != 'nt' or not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
@@ -5,6 +5,7 @@ Example usage.
 Default server is "http://keycache.42quarks.com/"
 
 keycache.get(key) returns value or None
+keycache.lookup(key) returns (hit, value), so a cached None is a hit
 keycache.set(key, value) throws Exception on error.
 
 or
@@ -17,31 +18,738 @@ it never raises Exceptions for missing objects (defaultdict()).
 kc['key'] = value
 value = kc['key']
 
-KeyCache pickles and unpickles objects before saving them.
+KeyCache pickles and unpickles objects before saving them (see Serializer), a different
+serializer can be used with KeyCache(serializer=...).
+
+Values can be compressed before being sent with KeyCache(compression='zlib') ('bz2' or
+'lzma' if available), compresslevel sets the level. Values smaller than compressthreshold
+bytes (after serializing) are sent uncompressed. The codec is saved with the value on the
+server so clients can read values whatever compression was used to write them.
+
+Many keys can be read or written with a single request per batch
+kc.get_many([key1, key2]) returns {key: value} for the keys which were found.
+kc.set_many({key1: value1, key2: value2})
+
+A client which holds a value (e.g. in a local cache) can check it is still current without
+downloading it again, digest is the value_sha512 of the value (returned by lookup_entry)
+kc.revalidate(key, digest) returns (hit, modified, value, digest), value is only sent if modified.
+
+A client can take a lease on a key while it calculates the value so that other clients
+wait for the value rather than also calculating it.
+if kc.acquire_lease(key, ttl=600): ... calculate and kc.set(key, value)
+
+Connections to the server are kept alive and shared between KeyCaches using the same
+server in a process (see ConnectionPool). poolsize sets how many idle connections are kept
+(the largest poolsize of the KeyCaches sharing them).
+
+Keys can be spread over several servers (see ShardedKeyCache), each key is kept on
+replicas of them and read from the first which is working
+kc = keycache.ShardedKeyCache(['http://host1:8080/', 'http://host2:8080/'], replicas=2)
 """
 
 import logging
 import json
 import urllib
 import urllib2
-import pickle
-from threading import Thread
+import urlparse
+import httplib
+import socket
+import struct
+import sys
+import hashlib
+import bisect
+import cPickle as pickle
+import zlib
+import bz2
+import Queue
+import os
+import time
+import atexit
+from StringIO import StringIO
+from cStringIO import StringIO as FastStringIO
+from collections import deque
+from weakref import WeakSet
+from threading import Thread, Lock, Condition
 from functools import partial
 
 
+MAGIC = '\x00cm' # Starts payloads with a format tag (never the start of a pickle).
+
+class Serializer(object):
+    """Converts values to and from the bytes stored by the caches.
+
+    Values are pickled with protocol. numpy arrays of at least threshold bytes are stored
+    out-of-band: their memory is sent as it is rather than copied into the pickle, and the
+    arrays read back are views on the received bytes (so they are read-only unless writable
+    is True). Such payloads start with a format tag, and can't be read by cloudm 0.1.7 and
+    earlier. Other values are plain pickles, which all versions can read.
+    """
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL, threshold=64 * 1024, writable=False):
+        self.protocol = protocol
+        self.threshold = threshold # None to never use out-of-band buffers.
+        self.writable = writable
+
+    def dumps(self, value):
+        """Return the serialized value as a list of strings and memoryviews (to avoid copying arrays)."""
+        if self.threshold is None or 'numpy' not in sys.modules:
+            return [pickle.dumps(value, self.protocol)]
+        buffers = []
+        f = FastStringIO()
+        pickler = pickle.Pickler(f, self.protocol)
+        # Only called for objects of non-builtin types (e.g. arrays), so other values pickle at C speed.
+        pickler.inst_persistent_id = partial(self.persistent_id, buffers)
+        pickler.dump(value)
+        data = f.getvalue()
+        if not buffers:
+            return [data]
+        # Layout: tag, pickle size, number of buffers, pickle, (offset, size) of each buffer and
+        # then the buffers, each aligned to 16 bytes.
+        offset = len(MAGIC) + 1 + 16 + len(data) + 16 * len(buffers)
+        table = []
+        pieces = []
+        for buf in buffers:
+            padding = -offset % 16
+            pieces.append('\x00' * padding)
+            offset += padding
+            table += [offset, len(buf)]
+            pieces.append(buf)
+            offset += len(buf)
+        header = (MAGIC + 'b' + struct.pack('<QQ', len(data), len(buffers)) + data +
+                  struct.pack('<%dQ' % len(table), *table))
+        return [header] + pieces
+
+    def persistent_id(self, buffers, obj):
+        numpy = sys.modules['numpy']
+        if type(obj) is numpy.ndarray and obj.nbytes >= self.threshold and not obj.dtype.hasobject:
+            obj = numpy.ascontiguousarray(obj)
+            buffers.append(memoryview(obj.reshape(-1).view(numpy.uint8)))
+            return ('ndarray', len(buffers) - 1, obj.dtype, obj.shape)
+        return None
+
+    def loads(self, data):
+        """Return the value serialized in data (a string or any buffer such as an mmap)."""
+        if data[:len(MAGIC)] != MAGIC:
+            return pickle.loads(data if isinstance(data, str) else data[:])
+        fmt = data[len(MAGIC)]
+        if fmt != 'b':
+            raise ValueError('Unknown serialization format %r' % fmt)
+        start = len(MAGIC) + 1
+        size, nbuffers = struct.unpack_from('<QQ', data, start)
+        start += 16
+        table = struct.unpack_from('<%dQ' % (2 * nbuffers), data, start + size)
+        unpickler = pickle.Unpickler(FastStringIO(data[start:start + size]))
+        unpickler.persistent_load = partial(self.persistent_load, data, table)
+        return unpickler.load()
+
+    def load(self, f):
+        """Read a value from the file object f (up to its end) as it arrives. Returns None if f is empty.
+
+        Out-of-band arrays are read straight into their own (writable) memory, so the
+        serialized value is never held in memory as a whole. Pickles are read whole and
+        then unpickled (unpickling from f would call f.read for every pickle opcode)."""
+        head = f.read(len(MAGIC) + 1)
+        if not head:
+            return None
+        if head[:len(MAGIC)] != MAGIC:
+            return pickle.loads(head + f.read())
+        fmt = head[len(MAGIC):]
+        if fmt != 'b':
+            raise ValueError('Unknown serialization format %r' % fmt)
+        size, nbuffers = struct.unpack('<QQ', readexactly(f, 16))
+        data = readexactly(f, size)
+        table = struct.unpack('<%dQ' % (2 * nbuffers), readexactly(f, 16 * nbuffers))
+        position = len(MAGIC) + 1 + 16 + size + 16 * nbuffers
+        buffers = []
+        if nbuffers:
+            import numpy
+        for i in range(nbuffers):
+            offset, size = table[2 * i], table[2 * i + 1]
+            readexactly(f, offset - position) # Padding
+            buf = numpy.empty(size, numpy.uint8)
+            readinto(f, memoryview(buf))
+            buffers.append(buf)
+            position = offset + size
+        unpickler = pickle.Unpickler(FastStringIO(data))
+        unpickler.persistent_load = lambda pid: buffers[pid[1]].view(pid[2]).reshape(pid[3])
+        return unpickler.load()
+
+    def persistent_load(self, data, table, pid):
+        import numpy
+        kind, index, dtype, shape = pid
+        offset, size = table[2 * index], table[2 * index + 1]
+        if size == 0:
+            return numpy.zeros(shape, dtype)
+        value = numpy.frombuffer(data, dtype, size // dtype.itemsize, offset).reshape(shape)
+        if self.writable:
+            value = value.copy()
+        return value
+
+
+def readexactly(f, n):
+    """Read n bytes from f."""
+    data = f.read(n)
+    if len(data) != n:
+        raise EOFError('Expected %d bytes, got %d' % (n, len(data)))
+    return data
+
+def readinto(f, buf, chunksize=1024 * 1024):
+    """Fill the memoryview buf with bytes read from f."""
+    offset = 0
+    while offset < len(buf):
+        chunk = readexactly(f, min(chunksize, len(buf) - offset))
+        buf[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+
+def piecessize(pieces):
+    """Total length of a list of strings and memoryviews (or of a string)."""
+    if isinstance(pieces, list):
+        return sum(len(piece) for piece in pieces)
+    return len(pieces)
+
+def joinpieces(pieces):
+    """Join the list of strings and memoryviews returned by Serializer.dumps into one string."""
+    return ''.join(p if isinstance(p, str) else p.tobytes() for p in pieces)
+
+default_serializer = Serializer()
+
+
+try: # lzma is in the standard library from python 3.3, otherwise use backports.lzma if installed.
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Functions making a compressor (with compress and flush methods) for a level, decompressing a string
+# and making an incremental decompressor.
+codecs = {'zlib' : (zlib.compressobj, zlib.decompress, zlib.decompressobj),
+          'bz2' : (bz2.BZ2Compressor, bz2.decompress, bz2.BZ2Decompressor)}
+if lzma is not None:
+    codecs['lzma'] = (lambda level: lzma.LZMACompressor(preset=level), lzma.decompress, lzma.LZMADecompressor)
+
+# Errors decoding a corrupt or truncated reply (see KeyCache.corrupt).
+decodeerrors = (EOFError, ValueError, struct.error, pickle.UnpicklingError, zlib.error)
+if lzma is not None:
+    decodeerrors += (lzma.LZMAError,)
+
+def compress(pieces, codec, level):
+    """Compress a list of strings and memoryviews (from Serializer.dumps) into a list of strings."""
+    compressor = codecs[codec][0](level)
+    out = [compressor.compress(p if isinstance(p, str) else p.tobytes()) for p in pieces]
+    out.append(compressor.flush())
+    return [chunk for chunk in out if chunk]
+
+def decompress(data, codec):
+    if codec not in codecs:
+        raise ValueError('Unknown compression codec %r' % codec)
+    return codecs[codec][1](data)
+
+
+class DecompressReader(object):
+    """File-like object which decompresses (with codec) data read from f as it is needed."""
+    def __init__(self, f, codec, chunksize=64 * 1024):
+        if codec not in codecs:
+            raise ValueError('Unknown compression codec %r' % codec)
+        self.f = f
+        self.decompressor = codecs[codec][2]()
+        self.chunksize = chunksize
+        self.buf = '' # Decompressed data, read up to offset.
+        self.offset = 0
+        self.eof = False
+
+    def fill(self, n):
+        """Decompress until at least n bytes are buffered (or the end of f)."""
+        chunks = []
+        buffered = len(self.buf) - self.offset
+        while (n < 0 or buffered < n) and not self.eof:
+            data = self.f.read(self.chunksize)
+            if data:
+                data = self.decompressor.decompress(data)
+            else:
+                self.eof = True
+                data = self.decompressor.flush() if hasattr(self.decompressor, 'flush') else ''
+            chunks.append(data)
+            buffered += len(data)
+        if chunks: # Drop what has been read, once per fill rather than on every read.
+            self.buf, self.offset = self.buf[self.offset:] + ''.join(chunks), 0
+
+    def read(self, n=-1):
+        self.fill(n)
+        end = len(self.buf) if n < 0 else self.offset + n
+        data = self.buf[self.offset:end]
+        self.offset += len(data)
+        return data
+
+    def readline(self):
+        while self.buf.find('\n', self.offset) < 0 and not self.eof:
+            self.fill(len(self.buf) - self.offset + 1)
+        end = self.buf.find('\n', self.offset) + 1 or len(self.buf)
+        return self.read(end - self.offset)
+
+
+class PooledResponse(object):
+    """Body of a response from ConnectionPool.request(stream=True), read as it arrives.
+
+    The connection goes back to the pool once the whole body has been read, or is
+    closed if the response is closed before that."""
+    def __init__(self, pool, conn, response, timeout=None, deadline=None):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.timeout = timeout
+        self.deadline = deadline
+        self.buf = '' # Read by readline but not returned yet.
+
+    def settimeout(self):
+        """Limit the next read to what is left before the deadline."""
+        if self.deadline is not None and self.conn is not None and self.conn.sock is not None:
+            self.conn.sock.settimeout(sockettimeout(self.timeout, self.deadline))
+
+    def read(self, n=-1):
+        self.settimeout()
+        if n is None or n < 0:
+            data, self.buf = self.buf + self.response.read(), ''
+        elif len(self.buf) >= n:
+            data, self.buf = self.buf[:n], self.buf[n:]
+        else:
+            data, self.buf = self.buf + self.response.read(n - len(self.buf)), ''
+        self.checkdone()
+        return data
+
+    def readline(self):
+        while '\n' not in self.buf:
+            self.settimeout()
+            data = self.response.read(256)
+            if not data:
+                break
+            self.buf += data
+        end = self.buf.find('\n') + 1 or len(self.buf)
+        line, self.buf = self.buf[:end], self.buf[end:]
+        self.checkdone()
+        return line
+
+    def checkdone(self):
+        if self.conn is not None and self.response.isclosed() and not self.buf:
+            if self.response.will_close:
+                self.conn.close()
+            else:
+                self.pool.release(self.conn)
+            self.conn = None
+
+    def close(self):
+        if self.conn is not None: # Not completely read so the connection can't be reused.
+            self.conn.close()
+            self.conn = None
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of keep-alive HTTP(S) connections to a single server.
+
+    Up to size idle connections are kept for reuse, more connections are opened if
+    needed by concurrent requests. A connection which the server has closed is
+    transparently replaced.
+    """
+    def __init__(self, server, size=4):
+        url = urlparse.urlsplit(server)
+        self.host = url.netloc
+        self.path = url.path or '/'
+        if url.scheme == 'https':
+            self.connectionclass = httplib.HTTPSConnection
+        else:
+            self.connectionclass = httplib.HTTPConnection
+        self.idle = Queue.LifoQueue(size)
+
+    @property
+    def size(self):
+        return self.idle.maxsize
+
+    def grow(self, size):
+        """Keep up to size idle connections (if that's more than now)."""
+        with self.idle.mutex:
+            self.idle.maxsize = max(self.idle.maxsize, size)
+
+    def connect(self, timeout=None):
+        """Open a new connection, waiting at most timeout seconds (None for no limit)."""
+        if timeout is None:
+            conn = self.connectionclass(self.host)
+        else:
+            conn = self.connectionclass(self.host, timeout=timeout)
+        conn.connect()
+        # Requests are sent in several pieces, don't wait for acks between them.
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def request(self, method, path, body=None, headers={}, stream=False, timeout=None,
+                connecttimeout=None, deadline=None):
+        """Make a request and return the response as (status, reason, body).
+
+        If stream is True (and the status is 200) body is a PooledResponse to read the body
+        from as it arrives, otherwise it is a string. Connecting waits at most connecttimeout
+        seconds and each read timeout seconds, and the whole request (including reading a
+        streamed body) raises socket.timeout if it isn't finished by deadline (a time.time())."""
+        sockettimeout(timeout, deadline) # Don't start if the deadline has already passed.
+        try:
+            conn, reused = self.idle.get_nowait(), True
+        except Queue.Empty:
+            conn, reused = None, False
+        try:
+            try:
+                if conn is None or conn.sock is None:
+                    if conn is not None:
+                        conn.close()
+                    conn = self.connect(connecttimeout)
+                conn.sock.settimeout(sockettimeout(timeout, deadline))
+                response = self.send(conn, method, path, body, headers)
+            except (httplib.HTTPException, socket.error), e:
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                # The server probably closed the idle connection, try again with a new one.
+                conn.close()
+                conn = self.connect(connecttimeout)
+                conn.sock.settimeout(sockettimeout(timeout, deadline))
+                response = self.send(conn, method, path, body, headers)
+            if stream and response.status == 200:
+                return response.status, response.reason, PooledResponse(self, conn, response, timeout, deadline)
+            conn.sock.settimeout(sockettimeout(timeout, deadline))
+            data = response.read()
+        except:
+            if conn is not None:
+                conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        return response.status, response.reason, data
+
+    def send(self, conn, method, path, body, headers):
+        """Send a request on conn and return the response. body can be a list of strings and
+        memoryviews, which are sent one after another."""
+        if not isinstance(body, list):
+            conn.request(method, self.path + path, body, headers)
+            return conn.getresponse()
+        conn.putrequest(method, self.path + path)
+        for name, value in headers.iteritems():
+            conn.putheader(name, value)
+        conn.putheader('Content-Length', str(sum(len(piece) for piece in body)))
+        conn.endheaders()
+        for piece in body:
+            conn.send(piece)
+        return conn.getresponse()
+
+    def release(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+def sockettimeout(timeout, deadline):
+    """Socket timeout to use for a read which must finish by deadline (or None)."""
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout('Latency budget exceeded')
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+pools = {} # ConnectionPools by (process id, server).
+poolslock = Lock()
+
+def connection_pool(server, size=4):
+    """Return the shared ConnectionPool for server, keeping at least size idle connections.
+
+    Each process has its own pools, a process forked from one which used a pool mustn't share
+    its connections (the replies would go to whichever process reads first)."""
+    pid = os.getpid()
+    with poolslock:
+        pool = pools.get((pid, server))
+        if pool is None:
+            for key in [key for key in pools if key[0] != pid]: # Inherited from the parent.
+                del pools[key]
+            pool = pools[(pid, server)] = ConnectionPool(server, size)
+        elif size > pool.size:
+            pool.grow(size)
+        return pool
+
+
+class ServerUnavailable(urllib2.URLError):
+    """Raised instead of contacting a server while its CircuitBreaker is open."""
+
+
+class CircuitBreaker(object):
+    """Stops requests to a server for cooldown seconds after failures consecutive failures.
+
+    After the cool-down one request is let through, if it succeeds the server is used
+    again, otherwise the breaker opens for another cooldown seconds."""
+    def __init__(self, failures=5, cooldown=30.0):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.lock = Lock()
+        self.consecutive = 0 # Failures since the last success.
+        self.openuntil = 0
+        self.opened = 0 # Number of times the breaker has opened.
+
+    def allow(self):
+        """Whether a request can be made now."""
+        with self.lock:
+            if self.consecutive < self.failures:
+                return True
+            now = time.time()
+            if now < self.openuntil:
+                return False
+            self.openuntil = now + self.cooldown # Let just this request try the server.
+            return True
+
+    def success(self):
+        with self.lock:
+            self.consecutive = 0
+
+    def failure(self):
+        with self.lock:
+            self.consecutive += 1
+            if self.consecutive >= self.failures:
+                if self.consecutive == self.failures:
+                    self.opened += 1
+                self.openuntil = time.time() + self.cooldown
+
+    @property
+    def state(self):
+        if self.consecutive < self.failures:
+            return 'closed'
+        return 'open' if time.time() < self.openuntil else 'half-open'
+
+
+class Latencies(object):
+    """Latency of the most recent requests (of each type) to a server, and counts of errors."""
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.counts = {}
+            self.errors = {}
+
+    def record(self, name, seconds, error=False):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+                self.counts[name] = self.errors[name] = 0
+            self.samples[name].append(seconds)
+            self.counts[name] += 1
+            if error:
+                self.errors[name] += 1
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        """{request type: {'count', 'errors', 'max', 'p50', 'p90', ...}} where the percentiles
+        (in seconds) are of the last window requests."""
+        with self.lock:
+            out = {}
+            for name, samples in self.samples.iteritems():
+                ordered = sorted(samples)
+                out[name] = {'count' : self.counts[name], 'errors' : self.errors[name], 'max' : ordered[-1]}
+                for p in percentiles:
+                    out[name]['p%g' % p] = ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+            return out
+
+
 class KeyCache(object):
-    def __init__(self,server="http://keycache.42quarks.com/"):
+    """Cache on a key server.
+
+    Connecting to the server waits at most connecttimeout seconds and each read timeout seconds.
+    If budget is set a lookup (get or get_many) which takes longer than budget seconds fails.
+    After failures consecutive failures (see CircuitBreaker) the server isn't contacted for
+    cooldown seconds, requests fail with ServerUnavailable immediately. The latency of requests
+    is recorded in latencies (see Latencies).
+    """
+    def __init__(self,server="http://keycache.42quarks.com/", poolsize=4, batchsize=100,
+                 batchbytes=4 * 1024 * 1024, serializer=None, compression=None, compresslevel=6,
+                 compressthreshold=16 * 1024, timeout=10.0, connecttimeout=3.0, budget=None,
+                 failures=5, cooldown=30.0):
+        if compression is not None and compression not in codecs:
+            raise ValueError('Unknown compression codec %r' % compression)
         self.server = server
+        self.serializer = serializer or default_serializer
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.compressthreshold = compressthreshold
+        self.poolsize = poolsize
+        self.batchsize = batchsize # Maximum number of keys in a getmulti/setmulti request.
+        self.batchbytes = batchbytes # Approximate maximum payload of a setmulti request.
+        self.owner = os.urandom(16).encode('hex') # Identifies our leases (uuid is slow to import).
+        self.timeout = timeout
+        self.connecttimeout = connecttimeout
+        self.budget = budget
+        self.breaker = CircuitBreaker(failures, cooldown)
+        self.latencies = Latencies()
 
     def get(self, key):
-        res = self.server_rpc('get', params={'key' : key})['payload']
-        if res == None:
-            return None
-        else:
-            return pickle.loads(res)
+        return self.lookup(key)[1]
+
+    def lookup(self, key):
+        """(True, value) if the server has key (even if value is None), otherwise (False, None)."""
+        hit, modified, value, digest = self.revalidate(key)
+        return hit, value
+
+    def lookup_entry(self, key):
+        """(hit, value, expired, digest) as for the local caches, values on the server don't expire."""
+        hit, modified, value, digest = self.revalidate(key)
+        return hit, value, False, digest
+
+    def revalidate(self, key, digest=None):
+        """Conditional lookup of key, returns (hit, modified, value, digest).
+
+        digest is the value_sha512 (returned by set) of the value we hold. If the server's value
+        has the same digest it only replies that it is not modified, (True, False, None, digest),
+        otherwise the value is read as for lookup and digest is the server's (None if it doesn't
+        send one)."""
+        start = time.time()
+        deadline = start + self.budget if self.budget is not None else None
+        params = {'key' : key}
+        if digest is not None:
+            params['digest'] = digest
+        hook, data = self.encode_request('get', params=params)
+        response = self.server_fetch(hook, data, deadline)
+        try:
+            res = self.decode_header(response)
+            if res.get('hit') is False or res.get('notmodified'):
+                value = None
+            else:
+                value = self.read_value(response, res.get('codec'))
+            response.read() # Anything after the value (e.g. a compressed stream's trailer).
+        except (httplib.HTTPException, socket.error), e: # Connection lost while reading the value.
+            self.failed('get', start, e)
+        except decodeerrors, e:
+            self.corrupt('get', start, e)
+        finally:
+            response.close()
+        self.succeeded('get', start)
+        if res.get('notmodified'):
+            return True, False, None, digest
+        hit = res['hit'] if 'hit' in res else value is not None # Servers without the hit flag can't cache None.
+        return hit, hit, value, res.get('value_sha512')
         
-    def set(self, key, value):
-        self.server_rpc('set', params={'key': key}, payload=pickle.dumps(value))
+    def set(self, key, value, index=None):
+        """Save value under key. If index is given the key is added to the server's list of
+        keys for index (see index_keys)."""
+        payload, codec = self.encode_value(value)
+        params = set_params(key, codec)
+        if index is not None:
+            params['index'] = index
+        self.server_rpc('set', params=params, payload=payload)
+
+    def get_many(self, keys):
+        """Return a dictionary of {key: value} for the keys in the cache."""
+        out = {}
+        keys = list(keys)
+        start = time.time()
+        deadline = start + self.budget if self.budget is not None else None
+        for i in range(0, len(keys), self.batchsize):
+            hook, data = self.encode_request('getmulti', params={'keys' : keys[i:i + self.batchsize]}, post=True)
+            response = self.server_fetch(hook, data, deadline)
+            try:
+                res = self.decode_header(response)
+                codecs = res.get('codecs') or [None] * len(res['keys'])
+                hits = res.get('hits') or [size > 0 for size in res['sizes']]
+                for key, hit, size, codec in zip(res['keys'], hits, res['sizes'], codecs):
+                    if hit: # Read each value as it arrives.
+                        data = readexactly(response, size)
+                        try:
+                            out[key] = self.decode_value(data, codec)
+                        except decodeerrors, e: # The other values can still be read.
+                            logging.warning('Ignoring corrupt value of %s from %s: %s', key, self.server, e)
+            except (httplib.HTTPException, socket.error), e:
+                self.failed('getmulti', start, e)
+            except decodeerrors, e:
+                self.corrupt('getmulti', start, e)
+            finally:
+                response.close()
+        self.succeeded('getmulti', start)
+        return out
+
+    def set_many(self, mapping, index=None):
+        """Set all the keys in the dictionary mapping (adding them to index as for set)."""
+        batch = []
+        nbytes = 0
+        for key, value in mapping.iteritems():
+            value, codec = self.encode_value(value)
+            size = piecessize(value)
+            if batch and (len(batch) >= self.batchsize or nbytes + size > self.batchbytes):
+                self.server_setmulti(batch, index)
+                batch, nbytes = [], 0
+            batch.append((key, value, codec))
+            nbytes += size
+        if batch:
+            self.server_setmulti(batch, index)
+
+    def server_setmulti(self, batch, index=None):
+        """Send a list of (key, serialized value (a list of pieces), codec) to the server in one request."""
+        params = setmulti_params(batch)
+        if index is not None:
+            params['index'] = index
+        self.server_rpc('setmulti', payload=[piece for _, value, _ in batch for piece in value], post=True,
+                        params=params)
+
+    def index_keys(self, index):
+        """List of the keys the server has saved with index (most recent last)."""
+        return self.server_rpc('keys', params={'index' : index})['keys']
+
+    def encode_value(self, value):
+        """Serialize (and compress) value. Returns (list of strings and memoryviews, codec or None)."""
+        pieces = self.serializer.dumps(value)
+        if self.compression is None:
+            return pieces, None
+        size = sum(len(piece) for piece in pieces)
+        if size < self.compressthreshold:
+            return pieces, None
+        compressed = compress(pieces, self.compression, self.compresslevel)
+        if sum(len(chunk) for chunk in compressed) >= size:
+            return pieces, None # Incompressible.
+        return compressed, self.compression
+
+    def read_value(self, f, codec=None):
+        """Read a value sent by the server with codec from the file object f. Returns None if f is empty."""
+        if codec:
+            f = DecompressReader(f, codec)
+        return self.serializer.load(f)
+
+    def decode_value(self, data, codec=None):
+        """Value from data (a string) as sent by the server with codec."""
+        if codec:
+            data = decompress(data, codec)
+        return self.serializer.loads(data)
+
+    def acquire_lease(self, key, ttl):
+        """Try to acquire a lease on key for ttl seconds, to tell other clients the value is being calculated.
+
+        Returns True if the lease was acquired (or the server doesn't support leases)."""
+        try:
+            return self.server_rpc('lease', params={'key' : key, 'ttl' : ttl, 'owner' : self.owner},
+                                   post=True)['acquired']
+        except urllib2.HTTPError, e:
+            if e.code not in (404, 405):
+                raise
+            return True
+
+    def release_lease(self, key):
+        """Release a lease acquired by acquire_lease."""
+        try:
+            self.server_rpc('release', params={'key' : key, 'owner' : self.owner}, post=True)
+        except urllib2.HTTPError, e:
+            if e.code not in (404, 405):
+                raise
 
     def __getitem__(self, key):
         return self.get(key)
@@ -49,23 +757,39 @@ class KeyCache(object):
     def __setitem__(self, key, value):
         self.set(key, value)
 
-    def server_rpc(self, hook, params={}, payload=None):
+    def server_rpc(self, hook, params={}, payload=None, post=False):
         """GET or POST request to server at URL server/hook with extras dictionary of additional parameters.
         Returns response as a dictionary with JSON response and an entry 'data' if any binary payload is included.
 
-        If payload==None then a POST request is used. Otherwise GET.
+        If payload==None (and post is False) then a GET request is used. Otherwise POST.
         """
-        if not payload: # Get request so params are encode in the URL
+        name = hook
+        start = time.time()
+        hook, data = self.encode_request(hook, params, payload, post)
+        response = self.server_fetch(hook, data)
+        try:
+            out = self.decode_response(response)
+        except (httplib.HTTPException, socket.error), e:
+            self.failed(name, start, e)
+        except decodeerrors, e:
+            self.corrupt(name, start, e)
+        self.succeeded(name, start)
+        return out
+
+    def encode_request(self, hook, params={}, payload=None, post=False):
+        """Return the (hook, data) to fetch for server_rpc. data is None for GET requests."""
+        if not payload and not post: # Get request so params are encode in the URL
             hook += '?' + urllib.urlencode(params)
             data = None
+        elif isinstance(payload, list): # POST request of several pieces (see Serializer.dumps).
+            data = [json.dumps(params) + '\n\n'] + payload
         else: # POST request.
-            data = json.dumps(params) + '\n\n' + payload
-        return self.decode_response(self.server_fetch(hook,data))
+            data = json.dumps(params) + '\n\n' + (payload or '')
+        return hook, data
             
     def decode_response(self, response):
         """Decode the response (file object) from the server."""
-        out = json.loads(response.readline())
-        response.readline()
+        out = self.decode_header(response)
         payload = response.read()
         if len(payload): # Don't save payload if empty
             out['payload'] = payload
@@ -73,21 +797,489 @@ class KeyCache(object):
             out['payload'] = None
         return out
             
-    def server_fetch(self, hook, data=None):
+    def decode_header(self, response):
+        """Read the JSON line (and blank line) at the start of a response from the server."""
+        out = json.loads(response.readline())
+        response.readline()
+        return out
+
+    def server_fetch(self, hook, data=None, deadline=None):
+        """Request server/hook (POSTing data unless it is None). Returns the body as a file object."""
         url = self.server + hook
+        name = hook.split('?')[0]
+        if not self.breaker.allow():
+            raise ServerUnavailable('%s is unavailable (circuit breaker open)' % self.server)
         logging.info('Fetching %s' % url)
-        return urllib2.urlopen(url, data)
+        pool = connection_pool(self.server, self.poolsize)
+        start = time.time()
+        kwargs = {'stream' : True, 'timeout' : self.timeout, 'connecttimeout' : self.connecttimeout,
+                  'deadline' : deadline}
+        try:
+            if data is None:
+                status, reason, body = pool.request('GET', hook, **kwargs)
+            else:
+                status, reason, body = pool.request('POST', hook, data,
+                                                    {'Content-Type' : 'application/x-www-form-urlencoded'},
+                                                    **kwargs)
+        except (httplib.HTTPException, socket.error), e:
+            self.failed(name, start, e)
+        if status != 200:
+            if status >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success() # The server is working, e.g. it doesn't support leases (404).
+            self.latencies.record(name, time.time() - start, error=True)
+            raise urllib2.HTTPError(url, status, reason, None, StringIO(body))
+        return body
+
+    def failed(self, name, start, e):
+        """Record a request which failed with the connection or socket error e and raise URLError."""
+        self.breaker.failure()
+        self.latencies.record(name, time.time() - start, error=True)
+        raise urllib2.URLError(e)
+
+    def corrupt(self, name, start, e):
+        """Record a request whose reply couldn't be decoded (error e, e.g. a truncated pickle) and raise
+        URLError. The server answered, so this doesn't count towards opening the circuit breaker."""
+        self.latencies.record(name, time.time() - start, error=True)
+        raise urllib2.URLError(e)
+
+    def succeeded(self, name, start):
+        self.breaker.success()
+        self.latencies.record(name, time.time() - start)
         
 
-defaultkeycache = KeyCache()
+def set_params(key, codec):
+    """JSON parameters for a set request."""
+    if codec:
+        return {'key' : key, 'codec' : codec}
+    return {'key' : key}
+
+def setmulti_params(batch):
+    """JSON parameters for a setmulti request of a list of (key, serialized value, codec)."""
+    params = {'keys' : [key for key, _, _ in batch], 'sizes' : [piecessize(value) for _, value, _ in batch]}
+    if any(codec for _, _, codec in batch):
+        params['codecs'] = [codec for _, _, codec in batch]
+    return params
+
+def split_payload(payload, sizes):
+    """Split the concatenated values of a multi-key response. Values of size 0 are misses (None)."""
+    out = []
+    offset = 0
+    for size in sizes:
+        out.append(payload[offset:offset + size] if size else None)
+        offset += size
+    return out
+
 
-get = defaultkeycache.get
-set = defaultkeycache.set
+defaultkeycache = None # KeyCache used by get and set below, created when first used.
+
+def default():
+    global defaultkeycache
+    if defaultkeycache is None:
+        defaultkeycache = KeyCache()
+    return defaultkeycache
+
+def get(key):
+    return default().get(key)
+
+def set(key, value):
+    default().set(key, value)
 
 
 class ThreadWriteKeyCache(KeyCache):
-   """Wrapper around KeyCache so that writes are threaded and don't delay other code."""      
-   def set(self,key,value):
-      logging.info('Setting %s to %s in thread.' % (str(key), str(value)))
-      t = Thread(target=partial(KeyCache.set, self, key, value))
-      t.start()
+   """Wrapper around KeyCache so that writes are threaded and don't delay other code.
+
+   Writes are queued and sent by a fixed number of worker threads, using setmulti
+   requests when several writes are waiting (and the server supports it). Repeated
+   writes to a key which hasn't been sent yet only send the latest value.
+
+   At most queuesize writes are kept waiting. If the queue is full onfull decides what
+   happens to a new write: 'block' waits for space, 'drop' discards it and 'inline'
+   writes it in the calling thread.
+
+   flush() waits for all queued writes to be sent, it is also called when python exits.
+   release_lease of a key waiting to be written is sent after the write, so those waiting
+   for the lease find the value.
+   """
+   def __init__(self, server="http://keycache.42quarks.com/", workers=2, queuesize=1000, onfull='block',
+                **kwargs):
+      KeyCache.__init__(self, server, **kwargs)
+      if onfull not in ('block', 'drop', 'inline'):
+         raise ValueError('onfull must be block, drop or inline not %s' % onfull)
+      self.workers = workers
+      self.queuesize = queuesize
+      self.onfull = onfull
+      self.multi = True # Set to False if the server doesn't support setmulti.
+      self.pending = {} # Values waiting to be written by key.
+      self.indexes = {} # Index (see KeyCache.set) of keys in pending which have one.
+      self.order = deque() # Keys in pending in the order they were set.
+      self.inflight = 0 # Number of batches being written.
+      self.writing = {} # Keys in the batches being written.
+      self.releases = {} # Keys whose lease is released once they have been written.
+      self.cond = Condition()
+      self.threads = []
+      writecaches.add(self)
+
+   def lookup(self, key):
+      try:
+         return True, self.pending[key]
+      except KeyError:
+         return KeyCache.lookup(self, key)
+
+   def revalidate(self, key, digest=None):
+      try:
+         return True, True, self.pending[key], None # Not on the server yet, so no digest.
+      except KeyError:
+         return KeyCache.revalidate(self, key, digest)
+
+   def get_many(self, keys):
+      out = {}
+      for key in keys:
+         try:
+            out[key] = self.pending[key]
+         except KeyError:
+            pass
+      missing = [key for key in keys if key not in out]
+      if missing:
+         out.update(KeyCache.get_many(self, missing))
+      return out
+
+   def set(self, key, value, index=None):
+      logging.info('Queueing write of %s.' % str(key))
+      with self.cond:
+         while key not in self.pending and len(self.pending) >= self.queuesize:
+            if self.onfull != 'block':
+               break
+            self.cond.wait()
+         else:
+            if key not in self.pending:
+               self.order.append(key)
+            self.pending[key] = value # Replaces any older value which hasn't been sent.
+            if index is not None:
+               self.indexes[key] = index
+            self.startworkers()
+            self.cond.notify_all()
+            return
+      if self.onfull == 'inline':
+         KeyCache.set(self, key, value, index)
+      else:
+         logging.warning('Write queue for %s is full, dropping write of %s.' % (self.server, key))
+
+   def set_many(self, mapping, index=None):
+      for key, value in mapping.iteritems():
+         self.set(key, value, index)
+
+   def release_lease(self, key):
+      with self.cond:
+         if key in self.pending or key in self.writing:
+            self.releases[key] = True
+            return
+      KeyCache.release_lease(self, key)
+
+   def flush(self, timeout=None):
+      """Wait until all queued writes have been sent. Returns False if timeout (seconds) expired first."""
+      if timeout is not None:
+         deadline = time.time() + timeout
+      with self.cond:
+         while self.order or self.inflight:
+            if timeout is None:
+               self.cond.wait()
+            else:
+               remaining = deadline - time.time()
+               if remaining <= 0:
+                  return False
+               self.cond.wait(remaining)
+      return True
+
+   def startworkers(self):
+      """Start the worker threads if they aren't running (cond must be held)."""
+      while len(self.threads) < self.workers:
+         t = Thread(target=self.worker, name='ThreadWriteKeyCache writer')
+         t.daemon = True
+         t.start()
+         self.threads.append(t)
+
+   def worker(self):
+      while True:
+         with self.cond:
+            while not self.order:
+               self.cond.wait()
+            batch = []
+            index = self.indexes.get(self.order[0])
+            # Keys with different indexes are sent in different batches.
+            while self.order and len(batch) < self.batchsize and self.indexes.get(self.order[0]) == index:
+               key = self.order.popleft()
+               self.indexes.pop(key, None)
+               batch.append((key, self.pending.pop(key)))
+               self.writing[key] = True
+            self.inflight += 1
+            self.cond.notify_all()
+         try:
+            self.write(batch, index)
+         except ServerUnavailable, e:
+            logging.warning('Dropped %d keys: %s' % (len(batch), e))
+         except Exception:
+            logging.exception('Failed to write %d keys to %s' % (len(batch), self.server))
+         finally:
+            with self.cond:
+               releases = []
+               for key, value in batch:
+                  self.writing.pop(key, None)
+                  if key not in self.pending and self.releases.pop(key, False):
+                     releases.append(key)
+            for key in releases:
+               try:
+                  KeyCache.release_lease(self, key)
+               except Exception:
+                  logging.exception('Failed to release the lease on %s' % key)
+            with self.cond:
+               self.inflight -= 1
+               self.cond.notify_all()
+
+   def write(self, batch, index=None):
+      """Send a list of (key, value) to the server, adding them to index."""
+      if len(batch) > 1 and self.multi:
+         try:
+            KeyCache.set_many(self, dict(batch), index)
+            return
+         except urllib2.HTTPError, e:
+            if e.code not in (404, 405):
+               raise
+            logging.info('%s does not support setmulti' % self.server)
+            self.multi = False
+      for key, value in batch:
+         KeyCache.set(self, key, value, index)
+
+
+# ThreadWriteKeyCaches are flushed (for up to exitflushtimeout seconds each) when python exits.
+writecaches = WeakSet()
+exitflushtimeout = 60
+
+def flush_writecaches():
+   for cache in list(writecaches):
+      if not cache.flush(exitflushtimeout):
+         logging.warning('Gave up waiting for writes to %s' % cache.server)
+
+atexit.register(flush_writecaches)
+
+
+def ringhash(s):
+    """Position of s on a HashRing."""
+    return struct.unpack('>Q', hashlib.md5(s).digest()[:8])[0]
+
+
+class HashRing(object):
+    """Consistent hashing of keys to nodes (strings).
+
+    Each node is placed at vnodes pseudo-random points on a ring and a key belongs to the
+    nodes at the first points after its own, so adding or removing a node only moves the
+    keys next to its points (about 1 / the number of nodes of them)."""
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self.points = [] # Sorted (position, node).
+        self.nodeset = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodeset:
+            return
+        self.nodeset.append(node)
+        for i in range(self.vnodes):
+            bisect.insort(self.points, (ringhash('%s#%d' % (node, i)), node))
+
+    def remove(self, node):
+        self.nodeset.remove(node)
+        self.points = [point for point in self.points if point[1] != node]
+
+    def nodes(self, key, n=1):
+        """The first n different nodes for key, the first is the key's primary node."""
+        out = []
+        n = min(n, len(self.nodeset))
+        start = bisect.bisect(self.points, (ringhash(key),))
+        for i in range(len(self.points)):
+            node = self.points[(start + i) % len(self.points)][1]
+            if node not in out:
+                out.append(node)
+                if len(out) == n:
+                    break
+        return out
+
+    def __len__(self):
+        return len(self.nodeset)
+
+
+def fanout(calls):
+    """Call each function in calls, in parallel threads if there are several. Returns a list of
+    (result, None) or (None, exception) in the same order."""
+    results = [None] * len(calls)
+    def run(i):
+        try:
+            results[i] = (calls[i](), None)
+        except Exception, e:
+            results[i] = (None, e)
+    threads = [Thread(target=run, args=(i,), name='cloudm fanout') for i in range(1, len(calls))]
+    for t in threads:
+        t.start()
+    if calls:
+        run(0) # In this thread.
+    for t in threads:
+        t.join()
+    return results
+
+
+class ShardedKeyCache(object):
+    """Cache spread over several key servers, usable wherever a KeyCache is.
+
+    Keys are assigned to servers by consistent hashing (see HashRing). Each value is written
+    to replicas servers and read from the first of them which is healthy (whose
+    CircuitBreaker is closed), falling back to the others if it fails. Batched requests
+    (get_many, set_many, index_keys) are sent to each server in parallel.
+
+    servers is a list of URLs, for which cache(url, **kwargs) is used (e.g.
+    cache=ThreadWriteKeyCache to write in the background), or of KeyCaches.
+    """
+    def __init__(self, servers, replicas=1, vnodes=160, cache=KeyCache, **kwargs):
+        self.replicas = replicas
+        self.cache = cache
+        self.kwargs = kwargs
+        self.caches = {} # URL to KeyCache.
+        self.ring = HashRing(vnodes=vnodes)
+        for server in servers:
+            self.add(server)
+
+    def add(self, server):
+        """Add a server (a URL or KeyCache)."""
+        if isinstance(server, basestring):
+            server = self.cache(server, **self.kwargs)
+        self.caches[server.server] = server
+        self.ring.add(server.server)
+
+    def remove(self, server):
+        """Stop using a server (given by URL)."""
+        self.ring.remove(server)
+        del self.caches[server]
+
+    @property
+    def servers(self):
+        return list(self.ring.nodeset)
+
+    @property
+    def serializer(self):
+        """Serializer of the values (used by memoize to size hits, as for a KeyCache)."""
+        return self.kwargs.get('serializer') or default_serializer
+
+    def replicas_for(self, key):
+        """URLs of the servers holding key, healthy ones first."""
+        nodes = self.ring.nodes(key, self.replicas)
+        return sorted(nodes, key=lambda node: self.caches[node].breaker.state == 'open')
+
+    def get(self, key):
+        return self.lookup(key)[1]
+
+    def lookup(self, key):
+        return self.first('lookup', key)
+
+    def lookup_entry(self, key):
+        return self.first('lookup_entry', key)
+
+    def revalidate(self, key, digest=None):
+        return self.first('revalidate', key, digest)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if keys and not self.caches:
+            raise ServerUnavailable('No key servers')
+        out = {}
+        remaining = dict((key, self.replicas_for(key)) for key in keys)
+        failed = [] # Keys no server could return.
+        error = None
+        while remaining:
+            groups = {}
+            for key, nodes in remaining.iteritems():
+                groups.setdefault(nodes[0], []).append(key)
+            nodes = groups.keys()
+            results = fanout([partial(self.caches[node].get_many, groups[node]) for node in nodes])
+            retry = {}
+            for node, (result, e) in zip(nodes, results):
+                if e is None:
+                    out.update(result)
+                    continue
+                if not isinstance(e, IOError):
+                    raise e
+                error = e
+                for key in groups[node]: # Try the next replica.
+                    if len(remaining[key]) > 1:
+                        retry[key] = remaining[key][1:]
+                    else:
+                        failed.append(key)
+            remaining = retry
+        if failed:
+            if len(failed) == len(keys):
+                raise error
+            logging.warning('Could not look up %d keys: %s' % (len(failed), error))
+        return out
+
+    def set(self, key, value, index=None):
+        nodes = self.ring.nodes(key, self.replicas)
+        self.check(nodes, fanout([partial(self.caches[node].set, key, value, index) for node in nodes]))
+
+    def set_many(self, mapping, index=None):
+        groups = {}
+        for key, value in mapping.iteritems():
+            for node in self.ring.nodes(key, self.replicas):
+                groups.setdefault(node, {})[key] = value
+        nodes = groups.keys()
+        self.check(nodes, fanout([partial(self.caches[node].set_many, groups[node], index) for node in nodes]))
+
+    def check(self, nodes, results):
+        """Raise the error if every write in results (from fanout) failed, otherwise log the failures."""
+        errors = [(node, e) for node, (_, e) in zip(nodes, results) if e is not None]
+        if errors and len(errors) == len(results):
+            raise errors[0][1]
+        for node, e in errors:
+            logging.warning('Failed to write to %s: %s' % (node, e))
+
+    def index_keys(self, index):
+        nodes = self.servers
+        results = fanout([partial(self.caches[node].index_keys, index) for node in nodes])
+        self.check(nodes, results)
+        out = []
+        seen = {} # Not a set, set is KeyCache.set in this module.
+        for keys, e in results:
+            for key in keys or ():
+                if key not in seen:
+                    seen[key] = True
+                    out.append(key)
+        return out
+
+    def acquire_lease(self, key, ttl):
+        return self.first('acquire_lease', key, ttl)
+
+    def release_lease(self, key):
+        return self.first('release_lease', key)
+
+    def first(self, method, key, *args):
+        """Call method on the first healthy server holding key, falling back to the other replicas."""
+        error = None
+        for node in self.replicas_for(key):
+            try:
+                return getattr(self.caches[node], method)(key, *args)
+            except IOError, e:
+                error = e
+        raise error or ServerUnavailable('No key servers for %s' % key)
+
+    def flush(self, timeout=None):
+        """Wait for the writes of servers which write in the background (see ThreadWriteKeyCache.flush)."""
+        return all([cache.flush(timeout) for cache in self.caches.values() if hasattr(cache, 'flush')])
+
+    def health(self):
+        """{URL: state of its CircuitBreaker} for each server."""
+        return dict((node, cache.breaker.state) for node, cache in self.caches.iteritems())
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
@@ -0,0 +1,127 @@
+"""Hashing of function arguments into cache keys.
+
+BaseClassMemoize uses a KeyHasher to turn the function hash and the arguments of a call
+into the key used for every cache. KeyHasher feeds strings and buffers (array.array,
+bytearray, numpy arrays with their dtype and shape) straight into the hash without
+copying them, and pickles (with the binary protocol) anything else.
+
+The hash algorithm can be chosen per memoizer, e.g. for a shorter (faster to compare
+and store) key
+memoizer = BaseClassMemoize(fn, caches, keyhasher=KeyHasher('blake2b', digestsize=32))
+
+PickleKeyHasher generates the keys used by earlier versions of cloudm (a sha512 of the
+text pickle of the arguments).
+"""
+
+import sys
+import array
+import hashlib
+import pickle as pypickle
+import cPickle as pickle
+
+try: # blake2 is in hashlib from python 3.6, otherwise use pyblake2 if it is installed.
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+
+class KeyHasher(object):
+    """Hashes arguments using algorithm (any hashlib algorithm or 'blake2b').
+
+    If digestsize is given keys are only digestsize bytes (2 * digestsize hex characters) long.
+    """
+    def __init__(self, algorithm='sha512', digestsize=None):
+        if algorithm == 'blake2b' and blake2b is None:
+            raise ValueError('blake2b requires python 3.6 or pyblake2')
+        self.algorithm = algorithm
+        self.digestsize = digestsize
+
+    def new(self):
+        if self.algorithm == 'blake2b':
+            return blake2b(digest_size=self.digestsize or 64)
+        return hashlib.new(self.algorithm)
+
+    def hashargs(self, fnhash, args):
+        """Return the key (a hex string) for args to the function with hash fnhash."""
+        h = self.new()
+        h.update(fnhash)
+        self.update(h, args)
+        if self.digestsize is not None:
+            return h.hexdigest()[:2 * self.digestsize]
+        return h.hexdigest()
+
+    def update(self, h, obj):
+        """Add obj to the hash h. Each value is prefixed by its type (and length) so different
+        arguments can't produce the same sequence of bytes."""
+        t = type(obj)
+        if t is str:
+            h.update('s%d:' % len(obj))
+            h.update(obj)
+        elif t is unicode:
+            obj = obj.encode('utf-8')
+            h.update('u%d:' % len(obj))
+            h.update(obj)
+        elif t in (int, long, float, bool, complex) or obj is None:
+            h.update('%s:%r;' % (t.__name__, obj))
+        elif t in (tuple, list):
+            h.update('%s%d:' % (t.__name__, len(obj)))
+            for item in obj:
+                self.update(h, item)
+        elif t is dict:
+            h.update('dict%d:' % len(obj))
+            for key, value in sortitems(obj):
+                self.update(h, key)
+                self.update(h, value)
+        elif t is array.array:
+            h.update('array%s%d:' % (obj.typecode, len(obj)))
+            h.update(obj)
+        elif t in (bytearray, buffer, memoryview):
+            h.update('%s%d:' % (t.__name__, len(obj)))
+            h.update(obj)
+        elif isndarray(obj) and not obj.dtype.hasobject:
+            h.update('ndarray%s%r:' % (obj.dtype.str, obj.shape))
+            if obj.dtype.names is not None: # Record arrays also need the field names.
+                h.update('%r:' % (obj.dtype.descr,))
+            if not obj.flags.c_contiguous:
+                obj = obj.copy(order='C')
+            h.update(obj)
+        else:
+            try:
+                data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError):
+                # The text protocol doesn't need to find (old style) classes by name so
+                # handles e.g. instances of classes defined inside functions.
+                data = pypickle.dumps(obj)
+            h.update('pickle%d:' % len(data))
+            h.update(data)
+
+
+class PickleKeyHasher(KeyHasher):
+    """Generates the same keys as earlier versions of cloudm (slow for large arguments)."""
+    def __init__(self):
+        KeyHasher.__init__(self, 'sha512')
+
+    def update(self, h, obj):
+        h.update(pypickle.dumps(obj))
+
+
+def isndarray(obj):
+    """True if obj is a numpy array (without importing numpy if it hasn't been already)."""
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and type(obj) is numpy.ndarray
+
+
+def sortitems(d):
+    """Items of d sorted by key if possible, so the order the dictionary was built in doesn't matter."""
+    items = d.items()
+    try:
+        items.sort(key=lambda item: item[0])
+    except TypeError:
+        pass
+    return items
+
+
+default_keyhasher = KeyHasher()
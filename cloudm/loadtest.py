@@ -0,0 +1,82 @@
+"""Load test for key servers.
+
+Runs clients threads each making requests gets and sets (readfraction of them gets) of
+values of size bytes spread over keys keys, and prints the throughput and latency
+percentiles as JSON:
+
+$ python -m cloudm.loadtest --server http://myhost:8080/ --clients 16 --requests 1000 --size 65536
+
+Without --server a KeyCacheServer is started in this process to test against.
+"""
+
+import json
+import time
+import random
+import argparse
+from threading import Thread
+from keycache import KeyCache, Latencies, connection_pool
+
+
+def run(server, clients=8, requests=1000, size=1024, keys=1000, readfraction=0.9, seed=0):
+    """Run the load test against server, returns a dictionary of the results."""
+    value = 'x' * size
+    loader = KeyCache(server, poolsize=clients)
+    loader.set_many(dict(('loadtest%d' % i, value) for i in range(keys)))
+    latencies = Latencies(window=clients * requests)
+
+    def client(n):
+        kc = KeyCache(server, poolsize=clients)
+        rand = random.Random(seed + n)
+        for i in range(requests):
+            key = 'loadtest%d' % rand.randrange(keys)
+            read = rand.random() < readfraction
+            start = time.time()
+            try:
+                if read:
+                    kc.get(key)
+                else:
+                    kc.set(key, value)
+                error = False
+            except IOError:
+                error = True
+            latencies.record('get' if read else 'set', time.time() - start, error)
+
+    threads = [Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.time() - start
+    latency = latencies.snapshot()
+    return {'server' : server, 'clients' : clients, 'requests' : clients * requests, 'size' : size,
+            'seconds' : seconds, 'throughput' : clients * requests / seconds,
+            'bytespersecond' : clients * requests * size / seconds,
+            'errors' : sum(stats['errors'] for stats in latency.values()), 'latency' : latency}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test a cloudm key server.')
+    parser.add_argument('--server', help='URL of the server (by default one is started in this process).')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=1000, help='Requests made by each client.')
+    parser.add_argument('--size', type=int, default=1024, help='Size of each value in bytes.')
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--readfraction', type=float, default=0.9)
+    args = parser.parse_args(argv)
+    server = None
+    if args.server is None:
+        from server import KeyCacheServer
+        server = KeyCacheServer(('127.0.0.1', 0), maxbytes=2 * args.keys * (args.size + 1024))
+        server.start()
+        args.server = server.url
+    try:
+        print json.dumps(run(args.server, args.clients, args.requests, args.size, args.keys, args.readfraction),
+                         indent=2, sort_keys=True)
+    finally:
+        if server is not None:
+            connection_pool(server.url).close()
+            server.stop()
+
+if __name__ == '__main__':
+    main()
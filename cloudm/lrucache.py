@@ -0,0 +1,169 @@
+"""Bounded in-memory cache used as the local tier of the memoizers.
+
+LRUCache behaves like the defaultdict it replaces (missing keys return None) but
+limits both the number of entries and their approximate size in bytes, evicting the
+least recently used entries first. Entries can optionally expire after a fixed time.
+lookup(key) returns (hit, value) so a cached None can be told apart from a miss, as do
+the lookup methods of the other caches (DiskCache, SharedCache and KeyCache).
+
+With stale, expired entries are still returned for stale more seconds (None for as long as
+they are kept) so the memoizers can use them while they are refreshed in the background.
+lookup_entry(key) returns (hit, value, expired, digest), where digest is the key server's
+value_sha512 of the value if it was given to set (see KeyCache.revalidate).
+
+cache = LRUCache(maxentries=1000, maxbytes=64 * 1024 * 1024, ttl=3600, stale=86400)
+cache['key'] = value
+value = cache['key']
+len(cache), cache.nbytes
+"""
+
+import sys
+import time
+from threading import Lock
+from itertools import islice
+
+# Fields of a link in the (circular, doubly linked) recency list.
+PREV, NEXT, KEY, VALUE, SIZE, EXPIRES, DIGEST = range(7)
+
+# approxsize looks at most SAMPLE items of each container and MAXDEPTH levels of nesting.
+SAMPLE = 32
+MAXDEPTH = 2
+
+
+def approxsize(value, depth=0):
+    """Rough estimate of the number of bytes used by value.
+
+    Buffers (strings, numpy arrays) are counted fully. The items of containers are counted
+    recursively, estimated from the first SAMPLE items of large containers and not at all
+    below MAXDEPTH levels, so the time taken doesn't depend on the size of value. Anything
+    else falls back to sys.getsizeof."""
+    nbytes = getattr(value, 'nbytes', None) # numpy arrays
+    if isinstance(nbytes, (int, long)):
+        return sys.getsizeof(value) + nbytes
+    if isinstance(value, (tuple, list, set, frozenset, dict)) and depth < MAXDEPTH and value:
+        if isinstance(value, dict):
+            sample = sum(approxsize(k, depth + 1) + approxsize(v, depth + 1)
+                         for k, v in islice(value.iteritems(), SAMPLE))
+        else:
+            sample = sum(approxsize(v, depth + 1) for v in islice(value, SAMPLE))
+        return sys.getsizeof(value) + sample * len(value) // min(len(value), SAMPLE)
+    try:
+        return sys.getsizeof(value)
+    except TypeError:
+        return 0
+
+
+class LRUCache(object):
+    """Dictionary-like cache bounded by entry count and approximate byte size.
+
+    maxentries and maxbytes can be None for no limit. ttl is the number of seconds an
+    entry is fresh (None to keep entries until they are evicted) and stale the number of
+    seconds an expired entry is still returned (None for no limit). sizeof is used to
+    estimate the size of each value.
+
+    Lookups and inserts are O(1) and safe to use from multiple threads.
+    """
+    def __init__(self, maxentries=100000, maxbytes=256 * 1024 * 1024, ttl=None, stale=0,
+                 sizeof=approxsize):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.stale = stale
+        self.sizeof = sizeof
+        self.nbytes = 0 # Approximate size of all values currently cached.
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, 0, None, None]
+        self._lock = Lock()
+
+    def lookup(self, key):
+        """(True, value) if key is cached (even if value is None), otherwise (False, None)."""
+        return self.lookup_entry(key)[:2]
+
+    def lookup_entry(self, key):
+        """(hit, value, expired, digest) for key, expired entries are hits within the stale window."""
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                return False, None, False, None
+            now = time.time()
+            expired = link[EXPIRES] is not None and link[EXPIRES] < now
+            if expired and self.stale is not None and link[EXPIRES] + self.stale < now:
+                self._unlink(link)
+                return False, None, False, None
+            self._movetoend(link)
+            return True, link[VALUE], expired, link[DIGEST]
+
+    def get(self, key, default=None):
+        hit, value = self.lookup(key)
+        return value if hit else default
+
+    def set(self, key, value, digest=None):
+        size = self.sizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return # Would evict everything else and still not fit.
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                self.nbytes += size - link[SIZE]
+                link[VALUE], link[SIZE], link[EXPIRES], link[DIGEST] = value, size, expires, digest
+                self._movetoend(link)
+            else:
+                root = self._root
+                last = root[PREV]
+                link = [last, root, key, value, size, expires, digest]
+                last[NEXT] = root[PREV] = self._map[key] = link
+                self.nbytes += size
+            self._evict()
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._unlink(self._map[key])
+
+    def __contains__(self, key):
+        link = self._map.get(key)
+        return link is not None and (link[EXPIRES] is None or self.stale is None or
+                                     link[EXPIRES] + self.stale >= time.time())
+
+    def __len__(self):
+        return len(self._map)
+
+    def clear(self):
+        with self._lock:
+            root = self._root
+            root[:] = [root, root, None, None, 0, None, None]
+            self._map.clear()
+            self.nbytes = 0
+
+    def _movetoend(self, link):
+        """Mark link as the most recently used (lock must be held)."""
+        prev, next = link[PREV], link[NEXT]
+        prev[NEXT] = next
+        next[PREV] = prev
+        root = self._root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = link
+        link[PREV] = last
+        link[NEXT] = root
+
+    def _unlink(self, link):
+        """Remove link from the cache (lock must be held)."""
+        prev, next = link[PREV], link[NEXT]
+        prev[NEXT] = next
+        next[PREV] = prev
+        del self._map[link[KEY]]
+        self.nbytes -= link[SIZE]
+
+    def _evict(self):
+        """Drop least recently used entries until the cache is within its limits (lock must be held)."""
+        root = self._root
+        while ((self.maxentries is not None and len(self._map) > self.maxentries) or
+               (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            self._unlink(root[NEXT])
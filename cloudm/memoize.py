@@ -1,22 +1,101 @@
 """Library from memoizing python functions (as safely as possible) and saving the results in the cloud."""
 
+import os
+import json
+import errno
 import hashlib
 import logging
+import tempfile
 import functools
 from functools import partial
-import itertools
-import pickle
 from decorator import decorator, FunctionMaker
 from keycache import KeyCache, ThreadWriteKeyCache
-from collections import defaultdict
+from lrucache import LRUCache, approxsize
+from diskcache import DiskCache
+from sharedcache import SharedCache
+import keyhash
+import policy as policies
+from stats import MemoizeStats, timer
 import sys
 import re
+import time
 import types
+from threading import Lock, Event, Thread
+from itertools import izip
+from weakref import ref, WeakKeyDictionary
 
-default_keycache = ThreadWriteKeyCache()
-# You can modify this to make @cloudmemoize use a different KeyCase.
-# for instance
-# memoize.default_keycase = ThreadWriteKeyCache('http://myserver/')
+default_keycache = None
+# KeyCache used by @cloudmemoize, a ThreadWriteKeyCache() is created when the first function is decorated.
+# You can modify this to make @cloudmemoize use a different KeyCache, for instance
+# memoize.default_keycache = ThreadWriteKeyCache('http://myserver/')
+
+default_diskcache = DiskCache()
+# Disk cache used by @diskmemoize and @cloudmemoize(disk=True), for instance
+# memoize.default_diskcache = DiskCache('/scratch/cache', maxbytes=10 * 1024 ** 3)
+
+default_sharedcache = SharedCache()
+# Cache shared by the processes on this computer, used by the decorators with shared=True, for instance
+# memoize.default_sharedcache = SharedCache('/dev/shm/mycache', size=4 * 1024 ** 3)
+
+class ModuleDigests(object):
+   """Function hashes of compiled modules, which only depend on the module file (and
+   BaseClassMemoize.extrahash), by the file's path, modification time and size.
+
+   They are kept in memory and, if path is set, in that file (as JSON) so they are
+   only calculated once per version of each module, e.g.
+   memoize.default_moduledigests = ModuleDigests(os.path.expanduser('~/.cloudm/moduledigests.json'))
+   """
+   def __init__(self, path=None):
+      self.path = path
+      self.digests = None # Loaded from path when first used.
+      self.lock = Lock()
+
+   def key(self, filename, extrahash):
+      st = os.stat(filename)
+      return '%s:%r:%d:%s' % (os.path.abspath(filename), st.st_mtime, st.st_size, extrahash.encode('hex'))
+
+   def get(self, key):
+      """The digest (a string) for key or None."""
+      with self.lock:
+         if self.digests is None:
+            self.load()
+         digest = self.digests.get(key)
+      return digest.decode('hex') if digest is not None else None
+
+   def set(self, key, digest):
+      with self.lock:
+         if self.digests is None:
+            self.load()
+         self.digests[key] = digest.encode('hex')
+         if self.path is not None:
+            self.save()
+
+   def load(self):
+      self.digests = {}
+      if self.path is None:
+         return
+      try:
+         with open(self.path) as f:
+            self.digests = json.load(f)
+      except (IOError, ValueError), e:
+         if getattr(e, 'errno', None) != errno.ENOENT:
+            logging.warning('Ignoring module digests in %s: %s', self.path, e)
+
+   def save(self):
+      """Write the digests to path (atomically, as processes may share it)."""
+      dirname = os.path.dirname(os.path.abspath(self.path))
+      try:
+         if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+         fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+         with os.fdopen(fd, 'w') as f:
+            json.dump(self.digests, f)
+         os.rename(tmpname, self.path)
+      except (IOError, OSError), e:
+         logging.warning('Failed to save module digests to %s: %s', self.path, e)
+
+default_moduledigests = ModuleDigests()
+# Cache of the hashes of compiled modules, set a path to also keep them on disk (see ModuleDigests).
 
 class BaseClassMemoize(object):
    """Base class for memoizing a function using a list of dictionaries.
@@ -31,13 +110,49 @@ class BaseClassMemoize(object):
 
    extrahash = 'FOOBAR' # Extra hash to can be modified to generate cache misses if needed.
    
-   def __init__(self, func, caches):
-      """Use partial to build a constructor that provides some dictionaries in caches for caching."""
+   def __init__(self, func, caches, singleflight=True, lease=None, leasepoll=0.5, keyhasher=None,
+                policy=None, index=False, instancekey=None):
+      """Use partial to build a constructor that provides some dictionaries in caches for caching.
+
+      If singleflight is True concurrent calls with the same arguments wait for the first
+      call to finish rather than also evaluating the function. If lease is set (in seconds)
+      the key server is asked for a lease before evaluating the function, so processes on
+      other computers wait (polling every leasepoll seconds) for the result instead.
+      keyhasher (a keyhash.KeyHasher) generates the keys, by default keyhash.default_keyhasher.
+      policy (see policy.py) decides which caches are worth using, by default policy.default_policy.
+      If index is True the key server keeps a list of the keys saved for this function, so
+      prefetch() can fetch all of them.
+      instancekey is for methods, it replaces the hash of the instance (self, the first argument)
+      which otherwise pickles it on every call: 'weak' hashes each instance once, remembering
+      the hash (while the instance exists) so it must not change, the name of an attribute (or
+      method) of the instance, e.g. 'version', or a function of the instance uses its result
+      (with the class name) as a fingerprint of the instance.
+      """
       self.func = func
       self.caches = caches
-      self.buildfnhash()
+      self.singleflight = singleflight
+      self.lease = lease
+      self.leasepoll = leasepoll
+      self.inflight = {} # InFlight calls by key.
+      self.refreshing = set() # Keys of expired results being refreshed in the background.
+      self.inflightlock = Lock()
+      self.keyhasher = keyhasher or keyhash.default_keyhasher
+      self.policy = policy or policies.default_policy
+      self.overrides = {} # Tier index or cache class name to True/False, overriding the policy.
+      self.index = index
+      self.instancekey = instancekey
+      self.instancehashes = {} # id(instance) to (weak reference, hash) for instancekey='weak'.
+      self.bound = WeakKeyDictionary() # Instance to a weak reference to its bound method.
+      self.stats = MemoizeStats('%s.%s' % (getattr(func, '__module__', None), func.__name__), caches)
+      self._fnhash = None # Built when first needed, to keep decorating (and so importing) quick.
       functools.update_wrapper(self, func)
 
+   @property
+   def fnhash(self):
+      if self._fnhash is None:
+         self.buildfnhash()
+      return self._fnhash
+
    def buildfnhash(self):
        """Build a hash of the function which is hashed to the the argument values so that, as much as possible,
        if the function is modified a new hash is created and so out-of-date values aren't retrieved from the
@@ -47,73 +162,526 @@ class BaseClassMemoize(object):
        h.update(self.extrahash)
        # We try and hash any many things as possible to make sure that false hits are not generated.
        # However, we need to deal robustly with compiled functions which don't have the same attributes.
+       hascode = False
        try:
           h.update(str(hash(self.func.func_code)))
           h.update(self.func.func_code.co_filename)
           h.update(self.func.func_code.co_code)
           h.update(str(self.func.func_code.co_varnames))
+          hascode = True
        except AttributeError:
           pass # Ignore this if these properties don't exist in the function.
                # as occurs in compiled code.
 
        # For compiled code since we can't access the byte-code we hash using the source library.
+       module_file = self.compiled_module_file()
+       if module_file is not None and not hascode:
+          # The hash only depends on the module file, so is shared by all the module's functions.
+          key = default_moduledigests.key(module_file, self.extrahash)
+          self._fnhash = default_moduledigests.get(key)
+          if self._fnhash is None:
+             self.hash_compiled_module(h)
+             self._fnhash = h.digest()
+             default_moduledigests.set(key, self._fnhash)
+          return
        self.hash_compiled_module(h)
        # TODO in future we'd like to introspection to find what other things depend on this function
        # but this will do for now
-       self.fnhash = h.digest()
+       self._fnhash = h.digest()
+
+   def compiled_module_file(self):
+      """The file of the function's module if it is compiled (a .so) otherwise None."""
+      module_file = getattr(sys.modules.get(self.func.__module__), '__file__', None)
+      if module_file is not None and re.match(r'.*\.so', module_file):
+         return module_file
+      return None
 
    def hash_compiled_module(self, h):
       """Hash the compiled version of the code for cython modules since we can't track the source code."""
-      module_file = sys.modules[self.func.__module__].__file__
-      if re.match(r'.*\.so', module_file):
+      module_file = self.compiled_module_file()
+      if module_file is not None:
          with open(module_file, 'rb') as f:
-            h.update(f.read())
+            for chunk in iter(partial(f.read, 1024 * 1024), ''):
+               h.update(chunk)
 
 
    def __call__(self, *args, **xargs):
+       cacheindex = len(self.caches)
+       hit, value, nbytes = False, None, 0
+       lookups = [] # (tier, seconds), recorded in the stats at once.
+       if not self.cachecontrol['writeonly'] and self.policy.static(self):
+          # Every cache is used (e.g. they are all in memory), so there is nothing to decide or time.
+          key = self.hashargs((args, xargs))
+          hashtime = 0.0
+          use = None
+          for i, d in enumerate(self.caches):
+             hit, value, expired, digest = self.cacheentry(d, key)
+             lookups.append((i, None)) # Not timed.
+             if hit:
+                cacheindex = i
+                nbytes = hitsize(d, value)
+                break
+          self.stats.record(hashtime, lookups, cacheindex if hit else None, nbytes)
+          if not hit:
+             return self.compute(key, args, xargs)
+          return self.usehit(key, cacheindex, value, expired, digest, args, xargs, use)
+
        # Pickle the arguments check if they're in the cache.
+       start = timer()
        key = self.hashargs((args, xargs))
+       hashtime = timer() - start
 
-       cacheindex = len(self.caches)
+       use = self.policy.tiers(self)
        if not self.cachecontrol['writeonly']: # Write to the cache.
           for d,i in zip(self.caches, range(len(self.caches))): # Find the first cache to have a hit.
-             value = d[key]
-             if value != None:
+             if not use[i]:
+                continue
+             start = timer()
+             hit, value, expired, digest = self.cacheentry(d, key)
+             seconds = timer() - start
+             lookups.append((i, seconds))
+             if hit: # Not value != None: None can be cached and arrays compare elementwise.
                 cacheindex = i
-                cachetype = type(d)
+                nbytes = hitsize(d, value)
+                self.policy.observe(self, i, seconds, nbytes)
                 break
-       else:
-          value = None
-          
-       if value == None: # If the value is empty
-           logging.info('Cache miss for %s', self.func.__name__)
-           value = self.func(*args, **xargs)
-       else:
-           logging.info('Cache hit (type %s) for %s', str(cachetype), self.func.__name__)
+             self.policy.observe(self, i, seconds, None)
+
+       self.stats.record(hashtime, lookups, cacheindex if hit else None, nbytes)
+       if not hit:
+           return self.compute(key, args, xargs)
+       return self.usehit(key, cacheindex, value, expired, digest, args, xargs, use)
+
+   def usehit(self, key, cacheindex, value, expired, digest, args, xargs, use=None):
+       """Return value, found in self.caches[cacheindex], after saving it in the caches above for
+       which use is True (None for all) or, if it has expired, starting to refresh it."""
+       if expired: # Use it now, the refresh updates the caches.
+          self.stats.stalehit()
+          self.refresh(key, cacheindex, value, digest, args, xargs)
+          return value
+       if cacheindex:
+          # Update any caches further up with the key.
+          start = timer()
+          for d, used in zip(self.caches[0:cacheindex], use or [True] * cacheindex):
+             if used:
+                 self.cacheset(d, key, value, digest)
+          self.stats.write(timer() - start)
+       return value
+
+   def cacheget(self, d, key):
+      """Look up key in cache d, returns (hit, value). A cache which fails (e.g. the server is slow
+      or down, or the disk is full) is a miss."""
+      return self.cacheentry(d, key)[:2]
+
+   def cacheentry(self, d, key):
+      """Look up key in cache d, returns (hit, value, expired, digest) (see lookup_entry)."""
+      try:
+         return lookup_entry(d, key)
+      except EnvironmentError, e:
+         logging.warning('Lookup in %s failed for %s, calculating instead: %s', type(d).__name__,
+                         self.func.__name__, e)
+         return False, None, False, None
+
+   def cacheset(self, d, key, value, digest=None):
+      """Save value in cache d, logging (rather than raising) any failure to reach a server or
+      write a file.
+
+      digest is the key server's value_sha512 of value, which local caches keep to revalidate with."""
+      try:
+         if self.index and hasattr(d, 'index_keys'):
+            d.set(key, value, index=self.indexname())
+         elif digest is not None and hasattr(d, 'lookup_entry') and not hasattr(d, 'revalidate'):
+            d.set(key, value, digest=digest)
+         else:
+            d[key] = value
+      except EnvironmentError, e:
+         logging.warning('Saving to %s failed for %s: %s', type(d).__name__, self.func.__name__, e)
 
-       # Update any caches further up with the key.
-       for d in self.caches[0:cacheindex]: 
-              d[key] = value
-       
+   def refresh(self, key, cacheindex, value, digest, args, xargs):
+      """Refresh the expired value of key found in self.caches[cacheindex] in a background thread
+      (unless it is already being refreshed)."""
+      with self.inflightlock:
+         if key in self.refreshing:
+            return
+         self.refreshing.add(key)
+      thread = Thread(target=self.freshen, args=(key, cacheindex, value, digest, args, xargs),
+                      name='cloudm refresh')
+      thread.daemon = True
+      thread.start()
+
+   def freshen(self, key, cacheindex, value, digest, args, xargs):
+      """Look for a fresh value of key in the caches after cacheindex, and save it in the caches before.
+
+      A key server only sends the value if it differs from ours (its digest isn't digest). If no
+      cache has a fresh value the function is evaluated again."""
+      try:
+         use = self.policy.tiers(self)
+         for i in range(cacheindex + 1, len(self.caches)):
+            d = self.caches[i]
+            if not use[i]:
+               continue
+            try:
+               if hasattr(d, 'revalidate'):
+                  hit, modified, fresh, freshdigest = d.revalidate(key, digest)
+                  if hit and not modified:
+                     fresh = value
+               else:
+                  hit, fresh, expired, freshdigest = lookup_entry(d, key)
+                  hit = hit and not expired
+            except EnvironmentError, e:
+               logging.warning('Refreshing %s from %s failed for %s: %s', key, type(d).__name__,
+                               self.func.__name__, e)
+               continue
+            if hit:
+               for upper, used in zip(self.caches[0:i], use):
+                  if used:
+                     self.cacheset(upper, key, fresh, freshdigest)
+               return
+         self.compute(key, args, xargs)
+      except Exception:
+         logging.exception('Refreshing %s failed for %s', key, self.func.__name__)
+      finally:
+         with self.inflightlock:
+            self.refreshing.discard(key)
+
+   def compute(self, key, args, xargs):
+       """Evaluate the function (or wait for an identical call in progress) after a cache miss."""
+       if not self.singleflight:
+          return self.evaluate(key, args, xargs)
+       with self.inflightlock:
+          call = self.inflight.get(key)
+          first = call is None
+          if first:
+             call = self.inflight[key] = InFlight()
+       if not first:
+          logging.info('Waiting for identical call of %s', self.func.__name__)
+          return call.result()
+       try:
+          call.value = self.evaluate(key, args, xargs)
+          return call.value
+       except:
+          call.exc_info = sys.exc_info()
+          raise
+       finally:
+          with self.inflightlock:
+             del self.inflight[key]
+          call.done.set()
+
+   def evaluate(self, key, args, xargs):
+       """Evaluate the function and save the result in all the caches."""
+       leaser = self.leaser()
+       try:
+          if leaser is not None and not leaser.acquire_lease(key, self.lease):
+             hit, value = self.wait_for_lease(leaser, key)
+             if hit:
+                for d in self.caches[0:self.caches.index(leaser)]:
+                   self.cacheset(d, key, value)
+                return value
+       except IOError, e:
+          logging.warning('Lease on %s failed for %s, calculating anyway: %s', key, self.func.__name__, e)
+          leaser = None
+       try:
+          start = timer()
+          value = self.func(*args, **xargs)
+          self.stats.compute(timer() - start, approxsize(value))
+       except:
+          self.release_lease(leaser, key)
+          raise
+       start = timer()
+       for d, used in zip(self.caches, self.policy.tiers(self)):
+          if used:
+             self.cacheset(d, key, value)
+       self.stats.write(timer() - start)
+       self.release_lease(leaser, key) # Those waiting find the result (or calculate it themselves).
        return value
 
+   def release_lease(self, leaser, key):
+      """Release our lease on key from leaser (if it isn't None)."""
+      if leaser is None:
+         return
+      try:
+         leaser.release_lease(key)
+      except EnvironmentError:
+         pass # The lease expires anyway.
+
+   def leaser(self):
+      """The key server to ask for leases (if leases are used)."""
+      if self.lease is None:
+         return None
+      leasers = [d for d in self.caches if hasattr(d, 'acquire_lease')]
+      return leasers[-1] if leasers else None
+
+   def wait_for_lease(self, leaser, key):
+      """Wait for whoever holds the lease on key to save their result on the server.
+
+      Returns (True, value), or (False, None) if the lease was released (without a result being
+      saved) or expired and we now hold it."""
+      logging.info('Waiting for lease on %s for %s', key, self.func.__name__)
+      while True:
+         time.sleep(self.leasepoll)
+         hit, value = lookup(leaser, key)
+         if hit:
+            return hit, value
+         if leaser.acquire_lease(key, self.lease):
+            return False, None
+
+   def map(self, iterable, workers=None, processes=False, batchsize=100):
+       """Generator of the function's result for each item of iterable, in order.
+
+       The keys of all the items are looked up in each cache at once (using get_many where
+       the cache has it) and only the misses are calculated, by a pool of workers threads
+       (or processes if processes is True, which needs the memoized function to be defined
+       at the top level of a module). workers=1 calculates them in this thread. Results are
+       written to the caches in batches of batchsize."""
+       items = list(iterable)
+       start = timer()
+       keys = [self.hashargs(((item,), {})) for item in items]
+       self.stats.call(timer() - start, len(items))
+       use = self.policy.tiers(self)
+       found = {}
+       if not self.cachecontrol['writeonly']:
+          found = self.lookup_many(keys, use)
+       missing, seen = [], set(found)
+       for key in keys:
+          if key not in seen: # Each distinct miss is calculated once.
+             missing.append(key)
+             seen.add(key)
+             self.stats.miss()
+       missingargs = dict(zip(keys, items))
+
+       pool = None
+       calls = [(self.original(), missingargs[key]) for key in missing]
+       if workers == 1 or len(missing) <= 1:
+          results = (callwithtime(call) for call in calls)
+       else:
+          from multiprocessing.pool import Pool, ThreadPool
+          pool = (Pool if processes else ThreadPool)(workers)
+          results = pool.imap(callwithtime, calls)
+       results = izip(missing, results)
+       batch = {}
+       try:
+          for key in keys:
+             while key not in found: # Wait for the next result to be calculated.
+                newkey, (value, seconds) = next(results)
+                self.stats.compute(seconds, approxsize(value))
+                found[newkey] = batch[newkey] = value
+                if len(batch) >= batchsize:
+                   self.save_many(batch, use)
+                   batch = {}
+             yield found[key]
+       finally:
+          if batch:
+             self.save_many(batch, use)
+          if pool is not None:
+             pool.terminate()
+
+   def lookup_many(self, keys, use, counthits=True):
+      """Look up keys in each cache, returns a dictionary of those found. Hits are copied to the caches above
+      (and counted in stats if counthits)."""
+      found = {}
+      for i, d in enumerate(self.caches):
+         remaining = [key for key in set(keys) if key not in found]
+         if not remaining:
+            break
+         if not use[i]:
+            continue
+         start = timer()
+         if hasattr(d, 'get_many'):
+            try:
+               hits = d.get_many(remaining)
+            except EnvironmentError, e:
+               logging.warning('Lookup in %s failed for %s, calculating instead: %s', type(d).__name__,
+                               self.func.__name__, e)
+               hits = {}
+         else:
+            hits = {}
+            for key in remaining:
+               hit, value = self.cacheget(d, key)
+               if hit:
+                  hits[key] = value
+         self.stats.lookup(i, timer() - start, len(remaining))
+         for key, value in hits.iteritems():
+            if counthits:
+               self.stats.hit(i, approxsize(value))
+         if hits:
+            self.save_many(hits, use[0:i])
+         found.update(hits)
+      return found
+
+   def save_many(self, mapping, use):
+      """Save a dictionary of results in the caches (of self.caches) for which use is True."""
+      start = timer()
+      for d, used in zip(self.caches, use):
+         if not used:
+            continue
+         if hasattr(d, 'set_many'):
+            try:
+               if self.index and hasattr(d, 'index_keys'):
+                  d.set_many(mapping, index=self.indexname())
+               else:
+                  d.set_many(mapping)
+            except EnvironmentError, e:
+               logging.warning('Saving to %s failed for %s: %s', type(d).__name__, self.func.__name__, e)
+         else:
+            for key, value in mapping.iteritems():
+               self.cacheset(d, key, value)
+      self.stats.write(timer() - start)
+
+   def prefetch(self, iterable=None, workers=4, wait=False):
+      """Fetch the results for each item of iterable (as for map) from the key server (or any
+      cache after the first) into the caches above it, in the background, so that later calls
+      are quick. With no iterable every result the key server has saved for this function
+      (which needs index=True) is fetched.
+
+      Keys are fetched in workers concurrent requests. Returns the background thread, or
+      waits for it to finish if wait is True."""
+      items = None if iterable is None else list(iterable)
+      use = self.policy.tiers(self)
+      use[1:] = [True] * (len(use) - 1) # Prefetching happens in the background so is always worth it.
+      def fetch():
+         if items is None:
+            keys = []
+            for d in self.caches:
+               if hasattr(d, 'index_keys'):
+                  try:
+                     keys.extend(d.index_keys(self.indexname()))
+                  except EnvironmentError, e:
+                     logging.warning('Listing the keys of %s in %s failed: %s', self.func.__name__,
+                                     type(d).__name__, e)
+         else:
+            keys = [self.hashargs(((item,), {})) for item in items]
+         chunks = [keys[i::workers] for i in range(workers)]
+         threads = [Thread(target=self.lookup_many, args=(chunk, use, False), name='cloudm prefetch')
+                    for chunk in chunks if chunk]
+         for t in threads:
+            t.start()
+         for t in threads:
+            t.join()
+      thread = Thread(target=fetch, name='cloudm prefetch')
+      thread.daemon = True
+      thread.start()
+      if wait:
+         thread.join()
+      return thread
+
+   def indexname(self):
+      """Name of the key server's list of keys saved for this function (see index)."""
+      return self.fnhash.encode('hex')
+
+   def original(self):
+      """The function being memoized, as something which can be sent to another process."""
+      return getattr(self, 'decorated', None) or self.func
+
    def hashargs(self, args):
        """Generate a hash from a set of arguments and the fnhash (previously calculated)."""
-       h = hashlib.new('sha512')
-       h.update(self.fnhash)
-       # We use pickle rather than python hash function because it's more reliable and works on
-       # most objects.
-       h.update(pickle.dumps(args))
-       return h.hexdigest()
+       # We hash the arguments themselves (see keyhash) rather than use python's hash function
+       # because it's more reliable and works on most objects.
+       if self.instancekey is not None and args[0]:
+          args = ((self.instancefingerprint(args[0][0]),) + tuple(args[0][1:]), args[1])
+       return self.keyhasher.hashargs(self.fnhash, args)
+
+   def instancefingerprint(self, obj):
+      """What is hashed in place of the instance obj (see instancekey)."""
+      if self.instancekey == 'weak':
+         entry = self.instancehashes.get(id(obj))
+         if entry is not None and entry[0]() is obj:
+            return ('instance', entry[1])
+         h = self.keyhasher.new()
+         self.keyhasher.update(h, obj)
+         try:
+            self.instancehashes[id(obj)] = (ref(obj, partial(self.forgetinstance, id(obj))), h.hexdigest())
+         except TypeError: # Can't be weakly referenced, so it's hashed every call.
+            pass
+         return ('instance', h.hexdigest())
+      if callable(self.instancekey):
+         fingerprint = self.instancekey(obj)
+      else:
+         fingerprint = getattr(obj, self.instancekey)
+         if callable(fingerprint):
+            fingerprint = fingerprint()
+      return ('instance', '%s.%s' % (type(obj).__module__, type(obj).__name__), fingerprint)
+
+   def forgetinstance(self, objid, objref):
+      """Remove the hash of an instance which no longer exists."""
+      if self.instancehashes.get(objid, (None,))[0] is objref:
+         del self.instancehashes[objid]
      
    def __repr__(self):
       """Return the function's docstring."""
       return self.func.__doc__
    
    def __get__(self, obj, objtype):
-      """Support instance methods."""
-      fn = functools.partial(self.__call__, obj)
-      return fn
+      """Support instance methods. The bound method is reused while it exists (e.g. in
+      model.predict is model.predict, or while a caller holds it). Only weak references to it are
+      kept, by instance, so it isn't kept alive by the memoizer or saved on the instance (which
+      would change the instance's pickle and so its keys)."""
+      if obj is None:
+         return self
+      try:
+         bound = self.bound[obj]()
+      except (KeyError, TypeError):
+         bound = None # Not bound yet, or obj can't be weakly referenced or hashed.
+      if bound is None or bound.args[0] is not obj: # Equal instances share a key.
+         bound = partial(self.__call__, obj)
+         try:
+            self.bound[obj] = ref(bound)
+         except TypeError:
+            pass
+      return bound
+
+
+def lookup(d, key):
+   """(hit, value) for key in cache d, using d.lookup if it has one. Other caches (e.g. dictionaries)
+   return None for a miss, so can't cache None."""
+   if hasattr(d, 'lookup'):
+      return d.lookup(key)
+   try:
+      value = d[key]
+   except KeyError:
+      return False, None
+   return value is not None, value
+
+
+def hitsize(d, value):
+   """Size of value read from cache d for the stats and policy. Only values which were deserialized
+   (read from disk, shared memory or a server) are sized, hits on memory caches count as 0 bytes."""
+   if hasattr(d, 'serializer'):
+      return approxsize(value)
+   return 0
+
+
+def lookup_entry(d, key):
+   """(hit, value, expired, digest) for key in cache d, using d.lookup_entry if it has one. Other
+   caches' values never expire and have no digest."""
+   if hasattr(d, 'lookup_entry'):
+      return d.lookup_entry(key)
+   hit, value = lookup(d, key)
+   return hit, value, False, None
+
+
+def callwithtime(call):
+   """Call call[0](call[1]) (with call[0] the undecorated function if it's a memoized function),
+   returning the result and how long it took."""
+   fn, arg = call
+   fn = getattr(fn, 'undecorated', fn)
+   start = timer()
+   value = fn(arg)
+   return value, timer() - start
+
+
+class InFlight(object):
+   """Result of a call which identical calls are waiting for."""
+   def __init__(self):
+      self.done = Event()
+      self.value = None
+      self.exc_info = None
+
+   def result(self):
+      """Wait for the call to finish and return its value (or raise its exception)."""
+      self.done.wait()
+      if self.exc_info is not None:
+         raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+      return self.value
 
 
 def decorator_apply(dec, func):
@@ -124,21 +692,94 @@ def decorator_apply(dec, func):
     if (type(func) ==  types.BuiltinFunctionType) or (type(func) == types.BuiltinMethodType):
        return builtin_decorator_apply(dec, func)
     # FunctionMaker doesn't seem to work for built-ins (i.e. compiled code, it should though).      
-    return FunctionMaker.create(
+    memoizer = dec(func)
+    fn = FunctionMaker.create(
         func, 'return decorated(%(signature)s)',
-        dict(decorated=dec(func)), undecorated=func)
+        dict(decorated=memoizer), undecorated=func, memoizer=memoizer)
+    if getattr(memoizer, 'map', None) is not None:
+       fn.map = memoizer.map
+       fn.prefetch = memoizer.prefetch
+       memoizer.decorated = fn # Which (unlike func) can be pickled by name.
+    return fn
 
 def builtin_decorator_apply(dec, func):
    decfn = dec(func)
    decfn.__doc__ = func.__doc__
+   decfn.memoizer = decfn
    return decfn
 
-def cloudmemoize(func):
-    """Decorator for memoizing a function using a memory based cache and a Google App Engine based cache."""
-    return decorator_apply(partial(BaseClassMemoize, caches=[defaultdict(itertools.repeat(None).next),
-                                                             default_keycache]), func)
+# Limits for the memory cache used by @memmemoize and @cloudmemoize (see LRUCache).
+# These can be overridden per function, e.g. @memmemoize(maxentries=10, ttl=60, stale=3600)
+default_memcache_args = {'maxentries' : 100000, 'maxbytes' : 256 * 1024 * 1024, 'ttl' : None, 'stale' : 0}
+
+def keycaches():
+   """Key server tier used by @cloudmemoize, default_keycache (created if it hasn't been set)."""
+   global default_keycache
+   if default_keycache is None:
+      default_keycache = ThreadWriteKeyCache()
+   return [default_keycache]
+
+def memorycache(**cacheargs):
+   """Build a memory cache using default_memcache_args updated with cacheargs."""
+   args = dict(default_memcache_args)
+   args.update(cacheargs)
+   return LRUCache(**args)
+
+def diskcaches(disk):
+   """Disk tier(s) to use for the disk argument of the decorators below."""
+   if disk is False or disk is None: # Not "if not disk", an empty DiskCache has len 0.
+      return []
+   if disk is True:
+      return [default_diskcache]
+   return [disk]
+
+def sharedcaches(shared):
+   """Shared memory tier(s) to use for the shared argument of the decorators below."""
+   if shared is False or shared is None:
+      return []
+   if shared is True:
+      return [default_sharedcache]
+   return [shared]
+
+def cloudmemoize(func=None, disk=False, lease=None, policy=None, index=False, shared=False, instancekey=None,
+                 **cacheargs):
+    """Decorator for memoizing a function using a memory based cache and a Google App Engine based cache.
+
+    If shared is True (or a SharedCache) results are also cached in memory shared by every
+    process on the computer, checked after the process's own memory. If disk is True (or a
+    DiskCache) results are also cached on disk, checked after memory and before the server.
+    If lease is set (in seconds) only one process in the cluster evaluates the function for
+    each set of arguments at a time, others wait for its result to reach the server. policy
+    (see policy.py) decides which caches are worth using for the function. If index is True
+    the server lists the keys saved for the function so fn.prefetch() can fetch them all.
+    instancekey (see BaseClassMemoize) avoids pickling self for methods.
+    Other keyword arguments (maxentries, maxbytes, ttl, stale) set the limits of the memory cache."""
+    if func is None:
+       return partial(cloudmemoize, disk=disk, lease=lease, policy=policy, index=index, shared=shared,
+                      instancekey=instancekey, **cacheargs)
+    return decorator_apply(partial(BaseClassMemoize, caches=[memorycache(**cacheargs)] + sharedcaches(shared) +
+                                                            diskcaches(disk) + keycaches(),
+                                   lease=lease, policy=policy, index=index, instancekey=instancekey), func)
+
+def diskmemoize(func=None, disk=True, policy=None, shared=False, instancekey=None, **cacheargs):
+   """Decorator for memoizing a function using a memory based cache and a local disk cache.
+
+   disk can be a DiskCache to use instead of default_diskcache. policy, shared and instancekey are
+   as for cloudmemoize. Other keyword arguments (maxentries, maxbytes, ttl, stale) set the limits of
+   the memory cache."""
+   if func is None:
+      return partial(diskmemoize, disk=disk, policy=policy, shared=shared, instancekey=instancekey, **cacheargs)
+   return decorator_apply(partial(BaseClassMemoize, caches=[memorycache(**cacheargs)] + sharedcaches(shared) +
+                                                           diskcaches(disk), policy=policy,
+                                  instancekey=instancekey), func)
+
+def memmemoize(func=None, shared=False, instancekey=None, **cacheargs):
+   """Decorator for memoizing a function using on a memory based cache.
 
-def memmemoize(func):
-   """Decorator for memoizing a function using on a memory based cache."""
-   return decorator_apply(partial(BaseClassMemoize, caches=[defaultdict(itertools.repeat(None).next)]), func)
+   shared and instancekey are as for cloudmemoize. Other keyword arguments (maxentries, maxbytes,
+   ttl, stale) set the limits of the memory cache."""
+   if func is None:
+      return partial(memmemoize, shared=shared, instancekey=instancekey, **cacheargs)
+   return decorator_apply(partial(BaseClassMemoize, caches=[memorycache(**cacheargs)] + sharedcaches(shared),
+                                  instancekey=instancekey), func)
 
@@ -0,0 +1,193 @@
+"""Policies deciding which caches a memoized function uses.
+
+Looking up (and writing) a result on the key server only pays off if fetching it is
+quicker than calculating it again. AdaptivePolicy, the default, measures how long each
+function takes to calculate and how long each cache takes to return a result of that
+size, and skips the caches that aren't worth it for the function:
+
+@cloudmemoize
+def quickcalc(params):
+    ...
+
+quickcalc.memoizer.policy.explain(quickcalc.memoizer)
+[{'tier': 'LRUCache', 'use': True, 'reason': 'local'},
+ {'tier': 'ThreadWriteKeyCache', 'use': False, 'reason': 'fetch 0.0120s > compute 0.0003s', ...}]
+
+Decisions can be overridden for a single function by tier index or cache class name,
+quickcalc.memoizer.overrides['ThreadWriteKeyCache'] = True
+or by giving the decorator a different policy, e.g. @cloudmemoize(policy=AdmissionPolicy())
+to always use every cache.
+"""
+
+from threading import Lock
+from functools import partial
+from weakref import ref
+
+
+class TierCost(object):
+    """Observed cost of looking up a cache, shared by every function using the cache."""
+    def __init__(self):
+        self.misses = 0
+        self.misstime = 0.0
+        self.hits = 0
+        self.hittime = 0.0
+        self.hitbytes = 0
+
+    def observe(self, seconds, nbytes):
+        """Record a lookup which took seconds, nbytes is the size of the result (None for a miss).
+
+        Not locked, it is called on every lookup and a sample lost to a race doesn't matter."""
+        if nbytes is None:
+            self.misses += 1
+            self.misstime += seconds
+        else:
+            self.hits += 1
+            self.hittime += seconds
+            self.hitbytes += nbytes
+
+    @property
+    def latency(self):
+        """Estimated time of a lookup which returns nothing."""
+        if self.misses:
+            return self.misstime / self.misses
+        return self.hittime / self.hits if self.hits else 0.0
+
+    @property
+    def perbyte(self):
+        """Estimated time to transfer each byte of a result."""
+        if not self.hitbytes:
+            return 0.0
+        return max(0.0, self.hittime - self.hits * self.latency) / self.hitbytes
+
+    def fetchtime(self, nbytes):
+        """Estimated time to fetch a result of nbytes."""
+        return self.latency + self.perbyte * nbytes
+
+    @property
+    def samples(self):
+        return self.hits + self.misses
+
+
+tiercosts = {} # id(cache) to (weak reference to cache, TierCost), caches needn't be hashable.
+tiercostslock = Lock()
+
+def tiercost(cache):
+    """The TierCost of cache."""
+    entry = tiercosts.get(id(cache)) # Without the lock, this is called for every tier of every call.
+    if entry is not None and entry[0]() is cache:
+        return entry[1]
+    with tiercostslock:
+        entry = tiercosts.get(id(cache))
+        if entry is None or entry[0]() is not cache:
+            try:
+                entry = (ref(cache, partial(forget, id(cache))), TierCost())
+            except TypeError: # Can't be weakly referenced (e.g. a dict), so isn't shared.
+                return TierCost()
+            tiercosts[id(cache)] = entry
+        return entry[1]
+
+def forget(cacheid, cacheref):
+    """Remove the TierCost of a cache which no longer exists."""
+    with tiercostslock:
+        if tiercosts.get(cacheid, (None,))[0] is cacheref:
+            del tiercosts[cacheid]
+
+
+class AdmissionPolicy(object):
+    """Uses every cache (the behaviour of cloudm before policies)."""
+    def observe(self, memoizer, tier, seconds, nbytes):
+        """Record a lookup of memoizer.caches[tier] (nbytes is None for a miss)."""
+        pass
+
+    def decide(self, memoizer, tier):
+        """Returns (use, reason) for whether memoizer should look up and write memoizer.caches[tier]."""
+        return True, 'always'
+
+    def static(self, memoizer):
+        """Whether memoizer always uses every cache, so tiers (and observe) needn't be called for
+        each call. Subclasses which override decide must override this."""
+        return not memoizer.overrides
+
+    def tiers(self, memoizer):
+        """List of whether to use each of memoizer's caches, applying memoizer.overrides."""
+        out = []
+        for i, cache in enumerate(memoizer.caches):
+            override = overridden(memoizer, i)
+            out.append(override if override is not None else self.decide(memoizer, i)[0])
+        return out
+
+    def explain(self, memoizer):
+        """List of dictionaries describing the decision for each of memoizer's caches."""
+        out = []
+        for i, cache in enumerate(memoizer.caches):
+            override = overridden(memoizer, i)
+            if override is not None:
+                use, reason = override, 'override'
+            else:
+                use, reason = self.decide(memoizer, i)
+            out.append({'tier' : type(cache).__name__, 'use' : use, 'reason' : reason})
+        return out
+
+
+class AdaptivePolicy(AdmissionPolicy):
+    """Skips caches where the estimated time to fetch a result is more than margin times the
+    mean time taken to calculate it.
+
+    The first local caches (the memory cache) are always used, as is every cache until the
+    function has been calculated minsamples times. Every probeevery calls skipped caches are
+    used anyway so their cost estimates stay up to date.
+    """
+    def __init__(self, margin=1.0, minsamples=3, probeevery=100, local=1):
+        self.margin = margin
+        self.minsamples = minsamples
+        self.probeevery = probeevery
+        self.local = local
+
+    def observe(self, memoizer, tier, seconds, nbytes):
+        tiercost(memoizer.caches[tier]).observe(seconds, nbytes)
+
+    def static(self, memoizer):
+        return len(memoizer.caches) <= self.local and not memoizer.overrides # Only local caches.
+
+    def decide(self, memoizer, tier):
+        if tier < self.local:
+            return True, 'local'
+        stats = memoizer.stats
+        if stats.computes < self.minsamples:
+            return True, 'measuring'
+        cost = tiercost(memoizer.caches[tier])
+        if not cost.samples:
+            return True, 'measuring'
+        fetch = cost.fetchtime(stats.computebytes / stats.computes)
+        compute = stats.meancomputetime
+        if fetch <= self.margin * compute:
+            return True, 'fetch %.4fs <= compute %.4fs' % (fetch, compute)
+        if self.probeevery and stats.calls % self.probeevery == 0:
+            return True, 'probe'
+        return False, 'fetch %.4fs > compute %.4fs' % (fetch, compute)
+
+    def explain(self, memoizer):
+        out = AdmissionPolicy.explain(self, memoizer)
+        stats = memoizer.stats
+        for i, decision in enumerate(out):
+            cost = tiercost(memoizer.caches[i])
+            decision['latency'] = cost.latency
+            decision['perbyte'] = cost.perbyte
+            if stats.computes:
+                decision['fetchtime'] = cost.fetchtime(stats.computebytes / stats.computes)
+                decision['computetime'] = stats.meancomputetime
+        return out
+
+
+def overridden(memoizer, tier):
+    """memoizer's override (True or False) for whether to use memoizer.caches[tier], or None."""
+    overrides = memoizer.overrides
+    if not overrides:
+        return None
+    if tier in overrides:
+        return overrides[tier]
+    return overrides.get(type(memoizer.caches[tier]).__name__)
+
+
+default_policy = AdaptivePolicy()
+# Policy used by memoizers which aren't given one, AdmissionPolicy() uses every cache.
@@ -0,0 +1,330 @@
+"""Standalone key server.
+
+Speaks the same protocol as the appengine server (see appengine/keycacheserver.py) so any
+KeyCache can use it, but runs anywhere python does:
+
+$ python -m cloudm.server --port 8080 --maxbytes 1073741824 --path /var/cache/cloudm
+
+cloudm.memoize.default_keycache = cloudm.keycache.ThreadWriteKeyCache('http://myhost:8080/')
+
+Values are kept in memory (an LRUCache limited to maxbytes) and, if path is given, also
+saved to disk (a DiskCache limited to diskbytes) so they survive restarts. Each request
+is handled in its own thread and connections are kept alive.
+
+Hits of /get carry the value's sha512 (value_sha512, as returned by set) and an ETag. A get
+with digest=<value_sha512> (see KeyCache.revalidate), or an If-None-Match header with the
+ETag, of a value which hasn't changed is answered without the value: {"notmodified": true}
+or 304 Not Modified. Hits can be cached (and served while they are revalidated) by HTTP
+caches in between.
+
+Besides get, set, getmulti, setmulti, lease, release and keys the server answers
+/health with {"status": "ok"} and /stats with request counts, bytes transferred and the
+size of the store.
+
+KeyCacheServer can also be started from python, e.g. for tests
+server = KeyCacheServer(('127.0.0.1', 0))
+server.start()
+KeyCache(server.url)
+server.stop()
+"""
+
+import sys
+import json
+import time
+import socket
+import hashlib
+import logging
+import argparse
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+from threading import Thread, Lock
+from lrucache import LRUCache
+from diskcache import DiskCache
+
+# Most keys kept in an index (see KeyCache.set).
+MAXINDEX = 100000
+
+# Expired leases are dropped when there are this many leases (or twice as many as were left the
+# last time).
+LEASEPURGE = 1000
+
+# Cache-Control of hits, values don't change often so HTTP caches can keep them and serve them
+# while they check for a new value (with the ETag).
+HITCACHECONTROL = 'public, max-age=86400, stale-while-revalidate=86400'
+
+
+def entrysize(entry):
+    """Size of a stored (value, codec, digest)."""
+    return len(entry[0]) + 192
+
+
+def etagmatches(header, etag):
+    """Whether the If-None-Match header lists etag."""
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+class Store(object):
+    """Values (with their codec and sha512) kept in memory and, if path is given, on disk."""
+    def __init__(self, maxbytes=256 * 1024 * 1024, path=None, diskbytes=1024 * 1024 * 1024):
+        self.memory = LRUCache(maxentries=None, maxbytes=maxbytes, sizeof=entrysize)
+        self.disk = DiskCache(path, maxbytes=diskbytes) if path is not None else None
+        self.leases = {} # Key to (owner, expiry time).
+        self.purgeleases = LEASEPURGE # Number of leases at which expired ones are dropped.
+        self.indexes = {} # Index name to OrderedDict of keys.
+        self.lock = Lock()
+
+    def get(self, key):
+        """Returns (value, codec, sha512 hexdigest of value) or None."""
+        entry = self.memory.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                if len(entry) == 2: # Saved by an earlier version, without the digest.
+                    entry = entry + (hashlib.sha512(entry[0]).hexdigest(),)
+                self.memory.set(key, entry)
+        return entry
+
+    def set(self, key, value, codec=None, digest=None):
+        """Save value, digest is its sha512 hexdigest if it has already been calculated."""
+        entry = (value, codec, digest or hashlib.sha512(value).hexdigest())
+        self.memory.set(key, entry)
+        if self.disk is not None:
+            self.disk.set(key, entry)
+
+    def acquire_lease(self, key, ttl, owner):
+        with self.lock:
+            now = time.time()
+            if len(self.leases) >= self.purgeleases:
+                self.leases = dict((k, lease) for k, lease in self.leases.iteritems() if lease[1] > now)
+                self.purgeleases = max(LEASEPURGE, 2 * len(self.leases))
+            holder = self.leases.get(key)
+            if holder is not None and holder[0] != owner and holder[1] > now:
+                return False
+            self.leases[key] = (owner, now + ttl)
+            return True
+
+    def release_lease(self, key, owner):
+        with self.lock:
+            if self.leases.get(key, (None,))[0] != owner:
+                return False
+            del self.leases[key]
+            return True
+
+    def add_to_index(self, index, keys):
+        with self.lock:
+            indexed = self.indexes.setdefault(index, OrderedDict())
+            for key in keys:
+                indexed.pop(key, None)
+                indexed[key] = True
+            while len(indexed) > MAXINDEX:
+                indexed.popitem(last=False)
+
+    def index_keys(self, index):
+        with self.lock:
+            return list(self.indexes.get(index, ()))
+
+    def stats(self):
+        out = {'entries' : len(self.memory), 'nbytes' : self.memory.nbytes, 'maxbytes' : self.memory.maxbytes,
+               'leases' : len(self.leases), 'indexes' : len(self.indexes)}
+        if self.disk is not None:
+            out['diskpath'] = self.disk.path
+        return out
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Replies are buffered and sent without waiting for acks (which otherwise adds ~40ms to each request).
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = dict((name, values[0]) for name, values in urlparse.parse_qs(url.query).iteritems())
+        if url.path == '/get':
+            self.get(params['key'], params.get('digest'))
+        elif url.path == '/keys':
+            self.reply({'index' : params['index'], 'keys' : self.server.store.index_keys(params['index'])})
+        elif url.path == '/stats':
+            self.reply(self.server.stats())
+        elif url.path == '/health':
+            self.reply({'status' : 'ok'})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        path = urlparse.urlsplit(self.path).path
+        length = int(self.headers.get('Content-Length', 0))
+        header = self.rfile.readline()
+        blank = self.rfile.readline()
+        request = json.loads(header)
+        size = length - len(header) - len(blank) # Size of the binary part.
+        self.server.count('bytesin', length)
+        store = self.server.store
+        if path == '/set':
+            value = self.rfile.read(size)
+            digest = hashlib.sha512(value).hexdigest()
+            store.set(request['key'], value, request.get('codec'), digest)
+            if request.get('index'):
+                store.add_to_index(request['index'], [request['key']])
+            self.server.count('sets')
+            self.reply({'key' : request['key'], 'cached' : True, 'value_sha512' : digest})
+        elif path == '/setmulti':
+            keys = request['keys']
+            codecs = request.get('codecs') or [None] * len(keys)
+            digests = []
+            for key, size, codec in zip(keys, request['sizes'], codecs):
+                value = self.rfile.read(size)
+                digests.append(hashlib.sha512(value).hexdigest())
+                store.set(key, value, codec, digests[-1])
+            if request.get('index'):
+                store.add_to_index(request['index'], keys)
+            self.server.count('sets', len(keys))
+            self.reply({'keys' : keys, 'cached' : [True] * len(keys), 'value_sha512' : digests})
+        elif path == '/getmulti':
+            self.rfile.read(size)
+            self.getmulti(request['keys'])
+        elif path == '/lease':
+            self.rfile.read(size)
+            self.reply({'key' : request['key'],
+                        'acquired' : store.acquire_lease(request['key'], request['ttl'], request['owner'])})
+        elif path == '/release':
+            self.rfile.read(size)
+            self.reply({'key' : request['key'],
+                        'released' : store.release_lease(request['key'], request['owner'])})
+        else:
+            self.rfile.read(size)
+            self.send_error(404)
+
+    def get(self, key, digest=None):
+        """Send the value of key, unless the client holds it already (it sent its digest or ETag)."""
+        entry = self.server.store.get(key)
+        result = {'key' : key, 'hit' : entry is not None}
+        self.server.count('hits' if entry is not None else 'misses')
+        if entry is None:
+            self.reply(result, cachecontrol='no-cache')
+            return
+        value, codec, valuedigest = entry
+        etag = '"%s"' % valuedigest
+        if etagmatches(self.headers.get('If-None-Match', ''), etag):
+            self.server.count('notmodified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', HITCACHECONTROL)
+            self.end_headers()
+            return
+        result['value_sha512'] = valuedigest
+        if codec:
+            result['codec'] = codec
+        if digest == valuedigest:
+            self.server.count('notmodified')
+            result['notmodified'] = True
+            self.reply(result, cachecontrol=HITCACHECONTROL, etag=etag)
+            return
+        self.reply(result, [value], cachecontrol=HITCACHECONTROL, etag=etag)
+
+    def getmulti(self, keys):
+        entries = [self.server.store.get(key) for key in keys]
+        hits = [entry is not None for entry in entries]
+        self.server.count('hits', sum(hits))
+        self.server.count('misses', len(keys) - sum(hits))
+        result = {'keys' : keys, 'hits' : hits, 'sizes' : [len(entry[0]) if entry else 0 for entry in entries]}
+        codecs = [entry[1] if entry else None for entry in entries]
+        if any(codecs):
+            result['codecs'] = codecs
+        self.reply(result, [entry[0] for entry in entries if entry], cachecontrol='no-cache')
+
+    def reply(self, result, values=(), cachecontrol=None, etag=None):
+        """Send the JSON result followed by values (a list of strings)."""
+        header = json.dumps(result) + '\n\n'
+        length = len(header) + sum(len(value) for value in values)
+        self.send_response(200)
+        self.send_header('Content-Length', str(length))
+        if cachecontrol:
+            self.send_header('Cache-Control', cachecontrol)
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(header)
+        for value in values:
+            self.wfile.write(value)
+        self.server.count('bytesout', length)
+
+    def handle_one_request(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        if getattr(self, 'raw_requestline', None):
+            self.server.count('requests')
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s' % (self.address_string(), format % args))
+
+
+class KeyCacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Key server listening on address (host, port), port 0 picks a free port.
+
+    Other arguments are passed to Store."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 8080), **storeargs):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.store = Store(**storeargs)
+        self.started = time.time()
+        self.counts = dict.fromkeys(['requests', 'hits', 'misses', 'notmodified', 'sets', 'bytesin',
+                                     'bytesout'], 0)
+        self.countslock = Lock()
+        self.thread = None
+        host, port = self.server_address[:2]
+        self.url = 'http://%s:%d/' % (host, port)
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], socket.error): # e.g. the client went away.
+            logging.debug('Connection from %s failed: %s' % (client_address, sys.exc_info()[1]))
+        else:
+            logging.exception('Error handling request from %s' % (client_address,))
+
+    def count(self, name, n=1):
+        with self.countslock:
+            self.counts[name] += n
+
+    def stats(self):
+        with self.countslock:
+            out = dict(self.counts)
+        out['uptime'] = time.time() - self.started
+        out.update(self.store.stats())
+        return out
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.thread = Thread(target=self.serve_forever, name='cloudm KeyCacheServer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Key server for cloudm.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--maxbytes', type=int, default=256 * 1024 * 1024,
+                        help='Size limit of the values kept in memory.')
+    parser.add_argument('--path', help='Directory to also save values in.')
+    parser.add_argument('--diskbytes', type=int, default=1024 * 1024 * 1024,
+                        help='Size limit of the values saved to disk.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    server = KeyCacheServer((args.host, args.port), maxbytes=args.maxbytes, path=args.path,
+                            diskbytes=args.diskbytes)
+    logging.info('Serving on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
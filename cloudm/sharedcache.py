@@ -0,0 +1,287 @@
+"""Cache shared by every process on a host, in a memory mapped file.
+
+Processes each have their own memory cache, so without this a pool of worker processes
+calculates (or downloads from the key server) each result once per process. SharedCache
+sits between the memory cache and the disk cache or key server:
+
+@cloudmemoize(shared=True)
+def longcalc(params):
+    ...
+
+cache = SharedCache('/dev/shm/mycache', size=1024 * 1024 * 1024)
+cache['key'] = value
+value = cache['key']
+
+The file holds a hash table of slots (the md5 of the key and the position of its value)
+followed by a data area used as a ring: values are appended and, once it is full, the
+oldest are overwritten (so the least recently added results are evicted). Values are
+serialized (see keycache.Serializer) straight into the map and copied out once when read.
+Writers (and readers) hold a lock on the file so processes never see a value being
+overwritten. The file is created (or opened) when the cache is first used, and opened again
+in a process forked after that (a flock is shared with the parent across fork).
+
+Each value is saved with its expiry time (with ttl) and the digest given to set, so with
+stale expired values are still returned, flagged as expired by lookup_entry (see LRUCache).
+"""
+
+import os
+import time
+import mmap
+import struct
+import hashlib
+import logging
+import tempfile
+import cPickle as pickle
+from threading import Lock
+from keycache import default_serializer
+
+try:
+    import fcntl
+except ImportError: # Windows, only threads in one process are safe.
+    fcntl = None
+
+MAGIC = 'cloudmsh'
+VERSION = 2
+HEADER = struct.Struct('<8sIQQQ') # Magic, version, number of slots, size of the data area, write position.
+SLOT = struct.Struct('<16sQQ') # md5 of the key, position of the record and its size.
+# md5 of the key, size of the value, expiry time (0 for none) and the sha512 of the value on the
+# key server (zeros for none), before each value.
+RECORD = struct.Struct('<16sQd64s')
+NODIGEST = '\0' * 64
+CURSOR = 28 # Offset of the write position in the header.
+MAXPROBE = 16 # Number of slots a key can be in.
+SLOTS = 64 # Offset of the first slot (the header padded to 64 bytes).
+
+default_path = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                            'cloudm-%s' % (os.getuid() if hasattr(os, 'getuid') else 'shared'))
+
+
+class SharedCache(object):
+    """Dictionary-like cache in the file path, size bytes long, shared between processes.
+
+    nslots is the most values kept (by default one per 4KB). Values larger than a quarter
+    of the file aren't kept. ttl and stale are as for LRUCache.
+    """
+    def __init__(self, path=default_path, size=256 * 1024 * 1024, nslots=None, serializer=None, ttl=None,
+                 stale=0):
+        self.path = path
+        self.size = size
+        self.nslots = nslots or size // 4096
+        self.ttl = ttl
+        self.stale = stale
+        self.serializer = serializer or default_serializer
+        self.map = None
+        self.pid = None # Process that opened the file.
+        self.lock = Lock() # fcntl locks don't exclude threads of the same process.
+
+    def open(self):
+        """Open (creating if needed) and map the file, again in a child process forked after it
+        was opened, whose copies of the file and thread locks don't exclude the parent."""
+        if self.pid is not None and self.pid != os.getpid():
+            # Closing the inherited descriptor doesn't release the parent's lock (unlocking would).
+            self.map.close()
+            os.close(self.fd)
+            self.map = None
+            self.pid = None
+            self.lock = Lock() # The copy may have been held by another thread of the parent.
+        with self.lock:
+            if self.map is not None:
+                return
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                self.fd = fd
+                self.lockfile(fcntl and fcntl.LOCK_EX)
+                try:
+                    header = os.read(fd, HEADER.size)
+                    if len(header) < HEADER.size or HEADER.unpack(header)[:2] != (MAGIC, VERSION):
+                        self.create(fd)
+                    else:
+                        self.nslots, self.datasize = HEADER.unpack(header)[2:4]
+                    self.dataoffset = SLOTS + SLOT.size * self.nslots
+                    self.map = mmap.mmap(fd, self.dataoffset + self.datasize)
+                    self.pid = os.getpid()
+                finally:
+                    self.unlockfile()
+            except:
+                os.close(fd)
+                raise
+
+    def create(self, fd):
+        """Initialize the file (which is locked)."""
+        dataoffset = SLOTS + SLOT.size * self.nslots
+        if dataoffset >= self.size:
+            raise ValueError('A %d byte SharedCache is too small for %d slots' % (self.size, self.nslots))
+        self.datasize = self.size - dataoffset
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self.size) # Sparse, so only the parts used take memory or disk.
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, HEADER.pack(MAGIC, VERSION, self.nslots, self.datasize, 0))
+
+    def lockfile(self, operation):
+        if fcntl is not None and operation:
+            fcntl.flock(self.fd, operation)
+
+    def unlockfile(self):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def locked(self, shared=False):
+        """Context manager holding the thread lock and the file lock."""
+        return FileLock(self, fcntl and (fcntl.LOCK_SH if shared else fcntl.LOCK_EX))
+
+    def cursor(self):
+        return struct.unpack_from('<Q', self.map, CURSOR)[0]
+
+    def slots(self, digest):
+        """Indexes of the slots digest can be in."""
+        start = struct.unpack_from('<Q', digest)[0] % self.nslots
+        return [(start + i) % self.nslots for i in range(min(MAXPROBE, self.nslots))]
+
+    def slot(self, i):
+        return SLOT.unpack_from(self.map, SLOTS + SLOT.size * i)
+
+    def valid(self, position, cursor):
+        """Whether the record at position hasn't been overwritten."""
+        return position + self.datasize >= cursor
+
+    def find(self, digest):
+        """(position, size) of the record of digest, or None."""
+        cursor = self.cursor()
+        for i in self.slots(digest):
+            slotdigest, position, size = self.slot(i)
+            if not size: # Slots are filled in order and never emptied, so digest isn't after this.
+                return None
+            if slotdigest == digest:
+                return (position, size) if self.valid(position, cursor) else None
+        return None
+
+    def get(self, key):
+        return self.lookup(key)[1]
+
+    def lookup(self, key):
+        """(True, value) if key is cached, otherwise (False, None)."""
+        return self.lookup_entry(key)[:2]
+
+    def lookup_entry(self, key):
+        """(hit, value, expired, digest) for key, expired entries are hits within the stale window."""
+        if self.pid != os.getpid():
+            self.open()
+        digest = hashlib.md5(key).digest()
+        with self.locked(shared=True):
+            found = self.find(digest)
+            if found is None:
+                return False, None, False, None
+            offset = self.dataoffset + found[0] % self.datasize
+            recorddigest, size, expires, valuedigest = RECORD.unpack_from(self.map, offset)
+            if (recorddigest, size) != (digest, found[1] - RECORD.size):
+                logging.warning('Corrupt shared cache entry for %s in %s', key, self.path)
+                return False, None, False, None
+            now = time.time()
+            expired = 0 < expires < now
+            if expired and self.stale is not None and expires + self.stale < now:
+                return False, None, False, None
+            data = self.map[offset + RECORD.size:offset + found[1]]
+        try:
+            return (True, self.serializer.loads(data), expired,
+                    valuedigest.encode('hex') if valuedigest != NODIGEST else None)
+        except (pickle.UnpicklingError, EOFError, ValueError), e:
+            logging.warning('Corrupt shared cache entry for %s in %s: %s', key, self.path, e)
+            return False, None, False, None
+
+    def set(self, key, value, digest=None):
+        if self.pid != os.getpid():
+            self.open()
+        pieces = self.serializer.dumps(value)
+        expires = time.time() + self.ttl if self.ttl is not None else 0.0
+        valuedigest = digest.decode('hex') if digest else NODIGEST
+        size = RECORD.size + sum(len(piece) for piece in pieces)
+        if size > self.datasize // 4:
+            return
+        keydigest = hashlib.md5(key).digest()
+        with self.locked():
+            cursor = self.cursor()
+            if cursor % self.datasize + size > self.datasize: # Doesn't fit before the end, start again.
+                cursor += self.datasize - cursor % self.datasize
+            offset = self.dataoffset + cursor % self.datasize
+            RECORD.pack_into(self.map, offset, keydigest, size - RECORD.size, expires, valuedigest)
+            offset += RECORD.size
+            for piece in pieces:
+                self.map[offset:offset + len(piece)] = piece if isinstance(piece, str) else piece.tobytes()
+                offset += len(piece)
+            struct.pack_into('<Q', self.map, CURSOR, cursor + size)
+            # Use the slot of the key, otherwise the first empty or overwritten slot, otherwise the first.
+            newcursor = cursor + size
+            slots = self.slots(keydigest)
+            target = None
+            for i in slots:
+                slotdigest, position, slotsize = self.slot(i)
+                if slotdigest == keydigest or not slotsize:
+                    target = i
+                    break
+                if target is None and not self.valid(position, newcursor):
+                    target = i
+            if target is None:
+                target = slots[0]
+            SLOT.pack_into(self.map, SLOTS + SLOT.size * target, keydigest, cursor, size)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __contains__(self, key):
+        if self.pid != os.getpid():
+            self.open()
+        with self.locked(shared=True):
+            return self.find(hashlib.md5(key).digest()) is not None
+
+    def __len__(self):
+        if self.pid != os.getpid():
+            self.open()
+        with self.locked(shared=True):
+            cursor = self.cursor()
+            return sum(1 for i in range(self.nslots) if self.slot(i)[2] and self.valid(self.slot(i)[1], cursor))
+
+    @property
+    def nbytes(self):
+        """Bytes of the data area in use."""
+        if self.pid != os.getpid():
+            self.open()
+        return min(self.cursor(), self.datasize)
+
+    def clear(self):
+        if self.pid != os.getpid():
+            self.open()
+        with self.locked():
+            self.map[SLOTS:self.dataoffset] = '\0' * (self.dataoffset - SLOTS)
+            struct.pack_into('<Q', self.map, CURSOR, 0)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                os.close(self.fd)
+                self.map = None
+                self.pid = None
+
+
+class FileLock(object):
+    """Holds a SharedCache's thread lock and (with operation) a lock on its file."""
+    def __init__(self, cache, operation):
+        self.cache = cache
+        self.operation = operation
+
+    def __enter__(self):
+        self.cache.lock.acquire()
+        try:
+            self.cache.lockfile(self.operation)
+        except:
+            self.cache.lock.release()
+            raise
+
+    def __exit__(self, *exc_info):
+        try:
+            self.cache.unlockfile()
+        finally:
+            self.cache.lock.release()
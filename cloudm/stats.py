@@ -0,0 +1,178 @@
+"""Statistics of memoized functions.
+
+Every memoizer (BaseClassMemoize) records how often each cache tier had a hit, how long
+hashing the arguments, each lookup and the function itself took and how large the
+results were, in its stats attribute.
+
+fn.memoizer.stats.snapshot()
+{'function': 'mymodule.longcalc', 'calls': 10, 'misses': 2, 'hashtime': 0.0004, ...
+ 'tiers': [{'tier': 'LRUCache', 'lookups': 10, 'hits': 7, 'lookuptime': 0.0001, 'bytes': 0,
+             'lookuphistogram': [3, 0, 0, 0, 0, 0, 0, 0]}, ...],
+ 'computehistogram': [0, 0, 0, 0, 1, 1, 0, 0], 'buckets': [1e-05, 0.0001, ...], 'saved': 61.2}
+
+bytes is the approximate size of the results read from each cache. Results are only sized
+when they are read from disk, shared memory or a server, so the memory cache's is 0 and a
+hit costs the same whatever the size of the result. Each call takes the lock once. Hashing
+and lookups aren't timed for memoizers which use every cache without deciding (see
+AdmissionPolicy.static), such as those with only a memory cache.
+
+The histograms count the lookups of each tier and the calls of the function by duration:
+bucket i counts those which took at most BUCKETS[i] seconds (and longer than BUCKETS[i-1]),
+the last those longer than BUCKETS[-1]. Untimed lookups aren't counted in them and a
+lookup of several keys at once counts once.
+
+saved estimates the number of seconds memoization saved: the mean compute time for every
+hit less the time spent hashing, looking up and writing results. Functions with a
+negative saved cost more to memoize than they save.
+
+snapshot() and reset() (below) cover every memoizer. Hooks are called after every call
+of a memoized function, e.g. to export to a monitoring system,
+cloudm.stats.hooks.append(lambda stats, event, tier, seconds, nbytes: ...)
+where event is 'hit' (tier is the index of the cache), 'miss' or 'compute' (seconds is the
+time the function took). stalehits counts the hits on expired results, which were returned
+while they were refreshed in the background. Hooks can also be added to a single function's stats.hooks.
+"""
+
+import time
+from bisect import bisect_left
+from threading import Lock
+from weakref import WeakSet
+
+timer = time.time
+
+registry = WeakSet() # Stats of every memoizer.
+hooks = [] # Called for every memoizer's events.
+
+BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0) # Upper bounds (in seconds) of the histograms' buckets.
+
+
+class MemoizeStats(object):
+    """Counters for one memoized function. tiers is the list of caches it uses."""
+    def __init__(self, name, tiers):
+        self.name = name
+        self.tiernames = [type(tier).__name__ for tier in tiers]
+        self.hooks = []
+        self.lock = Lock()
+        self.reset()
+        registry.add(self)
+
+    def reset(self):
+        with self.lock:
+            self.calls = 0
+            self.misses = 0
+            self.stalehits = 0
+            self.computes = 0
+            self.hashtime = 0.0
+            self.computetime = 0.0
+            self.writetime = 0.0
+            self.computebytes = 0
+            self.lookups = [0] * len(self.tiernames)
+            self.hits = [0] * len(self.tiernames)
+            self.lookuptime = [0.0] * len(self.tiernames)
+            self.hitbytes = [0] * len(self.tiernames)
+            self.lookuphistograms = [[0] * (len(BUCKETS) + 1) for name in self.tiernames]
+            self.computehistogram = [0] * (len(BUCKETS) + 1)
+
+    def call(self, hashtime, count=1):
+        with self.lock:
+            self.calls += count
+            self.hashtime += hashtime
+
+    def record(self, hashtime, lookups, tier, nbytes):
+        """Record a call which hashed its arguments in hashtime seconds and made lookups, a list
+        of (tier, seconds), which hit tier (None for a miss) with a result of nbytes. seconds is
+        None for lookups which weren't timed."""
+        with self.lock:
+            self.calls += 1
+            self.hashtime += hashtime
+            for i, seconds in lookups:
+                self.lookups[i] += 1
+                if seconds is not None:
+                    self.lookuptime[i] += seconds
+                    self.lookuphistograms[i][bisect_left(BUCKETS, seconds)] += 1
+            if tier is None:
+                self.misses += 1
+            else:
+                self.hits[tier] += 1
+                self.hitbytes[tier] += nbytes
+        if tier is None:
+            self.fire('miss', None, None, 0)
+        else:
+            self.fire('hit', tier, None, nbytes)
+
+    def lookup(self, tier, seconds, count=1):
+        with self.lock:
+            self.lookups[tier] += count
+            self.lookuptime[tier] += seconds
+            self.lookuphistograms[tier][bisect_left(BUCKETS, seconds)] += 1
+
+    def hit(self, tier, nbytes):
+        with self.lock:
+            self.hits[tier] += 1
+            self.hitbytes[tier] += nbytes
+        self.fire('hit', tier, None, nbytes)
+
+    def stalehit(self):
+        with self.lock:
+            self.stalehits += 1
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+        self.fire('miss', None, None, 0)
+
+    def compute(self, seconds, nbytes):
+        with self.lock:
+            self.computes += 1
+            self.computetime += seconds
+            self.computebytes += nbytes
+            self.computehistogram[bisect_left(BUCKETS, seconds)] += 1
+        self.fire('compute', None, seconds, nbytes)
+
+    def write(self, seconds):
+        with self.lock:
+            self.writetime += seconds
+
+    def fire(self, event, tier, seconds, nbytes):
+        if not (self.hooks or hooks):
+            return
+        for hook in self.hooks + hooks:
+            hook(self, event, tier, seconds, nbytes)
+
+    @property
+    def meancomputetime(self):
+        """Mean time taken by the function (None until it has been called)."""
+        return self.computetime / self.computes if self.computes else None
+
+    @property
+    def saved(self):
+        """Estimate of the seconds saved by memoization (negative if it cost time)."""
+        overhead = self.hashtime + sum(self.lookuptime) + self.writetime
+        return sum(self.hits) * (self.meancomputetime or 0.0) - overhead
+
+    def snapshot(self):
+        """The statistics as a dictionary (which is safe to keep, export as JSON etc.)."""
+        with self.lock:
+            tiers = [{'tier' : name, 'lookups' : self.lookups[i], 'hits' : self.hits[i],
+                      'lookuptime' : self.lookuptime[i], 'bytes' : self.hitbytes[i],
+                      'lookuphistogram' : list(self.lookuphistograms[i])}
+                     for i, name in enumerate(self.tiernames)]
+            return {'function' : self.name, 'calls' : self.calls, 'misses' : self.misses,
+                    'stalehits' : self.stalehits, 'computes' : self.computes, 'hashtime' : self.hashtime,
+                    'computetime' : self.computetime, 'writetime' : self.writetime,
+                    'computebytes' : self.computebytes, 'tiers' : tiers,
+                    'computehistogram' : list(self.computehistogram), 'buckets' : list(BUCKETS),
+                    'saved' : self.saved}
+
+    def __repr__(self):
+        return '<MemoizeStats %s: %d calls, %d misses>' % (self.name, self.calls, self.misses)
+
+
+def snapshot():
+    """Snapshots of the stats of every memoized function."""
+    return [stats.snapshot() for stats in list(registry)]
+
+def reset():
+    """Reset the stats of every memoized function."""
+    for stats in list(registry):
+        stats.reset()
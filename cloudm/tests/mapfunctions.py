@@ -0,0 +1,8 @@
+"""Memoized functions defined at the top level of a module, so they can be sent to worker processes."""
+import os
+from cloudm import memmemoize
+
+
+@memmemoize
+def square(x):
+    return x * x, os.getpid()
@@ -0,0 +1,149 @@
+import unittest
+import socket
+import time
+import urllib2
+from cloudm.keycache import KeyCache, connection_pool
+from cloudm.tests.test_keycache import TestServer
+try: # Only test asynchronous memoizing if trollius is installed.
+    import trollius as asyncio
+    from trollius import From, Return
+    from cloudm.asyncmemoize import AsyncKeyCache, AsyncClassMemoize, asyncmemmemoize, asynccloudmemoize
+    from cloudm.lrucache import LRUCache
+except ImportError:
+    asyncio = None
+
+
+@unittest.skipIf(asyncio is None, 'trollius is not installed')
+class TestAsyncMemoize(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = TestServer()
+        self.kc = AsyncKeyCache(self.server.url)
+
+    def tearDown(self):
+        self.kc.close()
+        self.loop.run_until_complete(asyncio.sleep(0.01)) # Let the transports close.
+        connection_pool(self.server.url).close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.loop.close()
+
+    def test_keycache(self):
+        self.assertEqual(self.loop.run_until_complete(self.kc.get('miss')), None)
+        self.loop.run_until_complete(self.kc.set('hit', [1, 2]))
+        self.assertEqual(self.loop.run_until_complete(self.kc.get('hit')), [1, 2])
+        # Shares the protocol with the synchronous client.
+        self.assertEqual(KeyCache(self.server.url).get('hit'), [1, 2])
+
+    def test_methods(self):
+        run = self.loop.run_until_complete
+        run(self.kc.set('key', 1, index='fn'))
+        run(self.kc.set_many({'other' : 2}, index='fn'))
+        self.assertEqual(run(self.kc.lookup_entry('key')), (True, 1, False, None))
+        self.assertEqual(run(self.kc.revalidate('key')), (True, True, 1, None))
+        self.assertEqual(run(self.kc.lookup('miss')), (False, None))
+        self.assertEqual(sorted(run(self.kc.index_keys('fn'))), ['key', 'other'])
+        self.assertTrue(run(self.kc.acquire_lease('key', 10)))
+        other = AsyncKeyCache(self.server.url)
+        self.assertFalse(run(other.acquire_lease('key', 10)))
+        other.close()
+        run(self.kc.release_lease('key'))
+
+    def test_budget(self):
+        self.server.delay = 0.5
+        kc = AsyncKeyCache(self.server.url, budget=0.05)
+        try:
+            start = time.time()
+            self.assertRaises(urllib2.URLError, self.loop.run_until_complete, kc.get('key'))
+            self.assertTrue(time.time() - start < 0.4)
+        finally:
+            kc.close()
+            self.server.delay = 0
+
+    def test_concurrent(self):
+        self.loop.run_until_complete(self.kc.set_many(dict((str(i), i) for i in range(20))))
+        values = self.loop.run_until_complete(asyncio.gather(*[self.kc.get(str(i)) for i in range(20)]))
+        self.assertEqual(values, range(20))
+        self.assertEqual(self.loop.run_until_complete(self.kc.get_many(['1', 'miss'])), {'1' : 1})
+
+    def test_memoize(self):
+        calls = []
+        @asyncio.coroutine
+        def double(x):
+            calls.append(x)
+            yield From(asyncio.sleep(0))
+            raise Return(2 * x)
+        memoized = AsyncClassMemoize(double, caches=[LRUCache(), self.kc])
+        self.assertEqual(self.loop.run_until_complete(memoized(3)), 6)
+        self.assertEqual(self.loop.run_until_complete(memoized(3)), 6)
+        self.assertEqual(calls, [3])
+        # Keys are the same as for the synchronous decorators so a fresh memory cache hits the server.
+        memoized = AsyncClassMemoize(double, caches=[LRUCache(), KeyCache(self.server.url)])
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(self.loop.run_until_complete(memoized(3)), 6)
+        self.assertEqual(calls, [3])
+
+    def test_decorator(self):
+        @asyncmemmemoize
+        @asyncio.coroutine
+        def foo(x):
+            raise Return(x)
+        self.assertEqual(self.loop.run_until_complete(foo(4)), 4)
+
+    def test_corrupt(self):
+        self.server.store['corrupt'] = 'garbage'
+        self.assertRaises(urllib2.URLError, self.loop.run_until_complete, self.kc.get('corrupt'))
+        self.assertEqual(self.loop.run_until_complete(self.kc.get_many(['corrupt'])), {})
+
+    def test_server_down(self):
+        calls = []
+        @asyncio.coroutine
+        def double(x):
+            calls.append(x)
+            raise Return(2 * x)
+        kc = AsyncKeyCache('http://127.0.0.1:1/', failures=2) # Nothing listens on port 1.
+        memoized = AsyncClassMemoize(double, caches=[LRUCache(), kc])
+        self.assertEqual([self.loop.run_until_complete(memoized(x)) for x in (1, 2, 3)], [2, 4, 6])
+        self.loop.run_until_complete(asyncio.sleep(0.05)) # Let the writes fail.
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertEqual(kc.breaker.state, 'open')
+
+    def test_timeout(self):
+        listener = socket.socket() # Accepts connections but never replies.
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        kc = AsyncKeyCache('http://127.0.0.1:%d/' % listener.getsockname()[1], timeout=0.1)
+        try:
+            start = time.time()
+            self.assertRaises(urllib2.URLError, self.loop.run_until_complete, kc.get('key'))
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            kc.close()
+            listener.close()
+
+    def test_stale(self):
+        calls = []
+        @asyncmemmemoize(ttl=0.01, stale=10)
+        @asyncio.coroutine
+        def count(x):
+            calls.append(x)
+            raise Return(len(calls))
+        self.assertEqual(self.loop.run_until_complete(count(1)), 1)
+        time.sleep(0.02)
+        self.assertEqual(self.loop.run_until_complete(count(1)), 1) # Expired, refreshed in the background.
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(self.loop.run_until_complete(count(1)), 2)
+
+    def test_arguments(self):
+        class Model(object):
+            version = 2
+            @asynccloudmemoize(instancekey='version', policy=None, shared=False)
+            @asyncio.coroutine
+            def scale(self, x):
+                raise Return(self.version * x)
+        @asyncmemmemoize(instancekey='version')
+        @asyncio.coroutine
+        def scale(self, x):
+            raise Return(self.version * x)
+        self.assertEqual(self.loop.run_until_complete(scale(Model(), 3)), 6)
@@ -0,0 +1,14 @@
+import unittest
+import json
+from cloudm import benchmark
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        results = benchmark.run(['tiers', 'writes'], scale=0.01)
+        results = json.loads(json.dumps(results)) # Machine readable.
+        names = [result['name'] for result in results['results']['tiers']]
+        self.assertTrue('memory get hit' in names and 'server call miss' in names)
+        self.assertTrue(all(result['seconds'] > 0 for result in results['results']['writes']))
+        ratios = benchmark.compare(results, results)
+        self.assertEqual(len(ratios), len(names) + 3)
+        self.assertTrue(all(ratio == 1.0 for section, name, ratio in ratios))
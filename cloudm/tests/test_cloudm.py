@@ -1,8 +1,31 @@
 import unittest
-from cloudm import cloudmemoize,memmemoize
+from cloudm import cloudmemoize,memmemoize,diskmemoize
+from cloudm.diskcache import DiskCache
+from cloudm.lrucache import LRUCache
+from cloudm.keycache import KeyCache, ThreadWriteKeyCache, connection_pool
+from cloudm.memoize import BaseClassMemoize
+from cloudm import memoize
+from cloudm.policy import AdaptivePolicy, AdmissionPolicy
+from cloudm.tests import mapfunctions
+from cloudm.tests.test_keycache import TestServer
+from functools import partial
+from weakref import ref
 import inspect
+import hashlib
+import types
+import shutil
+import tempfile
+import threading
+import time
 import random
 import sys
+import os
+import cloudm.stats
+from cloudm.stats import MemoizeStats
+try:
+    import numpy
+except ImportError:
+    numpy = None
 try: # Test memoizing compiled cython modules if cython is installed.
     import cython
     import pyximport; pyximport.install()
@@ -75,3 +98,462 @@ class TestMemMemoizer(MemoizeDecorator, unittest.TestCase):
         super(TestMemMemoizer, self).setUp()
         self.decorator = memmemoize
         
+
+class TestDiskMemoizer(MemoizeDecorator, unittest.TestCase):
+    def setUp(self):
+        super(TestDiskMemoizer, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.decorator = partial(diskmemoize, disk=DiskCache(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_unwritable(self):
+        blocker = os.path.join(self.path, 'file')
+        open(blocker, 'w').close()
+        square = diskmemoize(disk=DiskCache(os.path.join(blocker, 'cache')))(lambda x: x * x)
+        self.assertEqual([square(3), square(3)], [9, 9])
+
+
+class TestHits(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+
+    def tearDown(self):
+        connection_pool(self.server.url).close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_none(self):
+        calls = []
+        def fn(x):
+            calls.append(x)
+            return None if x else []
+        memoizer = BaseClassMemoize(fn, caches=[LRUCache(), KeyCache(self.server.url)], policy=AdmissionPolicy())
+        self.assertEqual([memoizer(1), memoizer(0), memoizer(1), memoizer(0)], [None, [], None, []])
+        other = BaseClassMemoize(fn, caches=[LRUCache(), KeyCache(self.server.url)], policy=AdmissionPolicy())
+        self.assertEqual(list(other.map([1, 0])), [None, []]) # From the server.
+        self.assertEqual(calls, [1, 0])
+        self.assertEqual(memoizer.stats.hits, [2, 0])
+        self.assertEqual(other.stats.hits, [0, 2])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_array(self):
+        fn = BaseClassMemoize(lambda x: numpy.arange(x), caches=[LRUCache()])
+        self.assertEqual(fn(10).sum(), 45)
+        self.assertEqual(fn(10).sum(), 45)
+        self.assertEqual(fn.stats.hits, [1])
+
+
+class TestStale(unittest.TestCase):
+    def setUp(self):
+        from cloudm.server import KeyCacheServer
+        self.server = KeyCacheServer(('127.0.0.1', 0))
+        self.server.start()
+
+    def tearDown(self):
+        connection_pool(self.server.url).close()
+        self.server.stop()
+
+    def wait(self, memoizer):
+        for i in range(200):
+            if not memoizer.refreshing:
+                return
+            time.sleep(0.01)
+        self.fail('Refresh did not finish')
+
+    def test_revalidate(self):
+        calls = []
+        def fn(x):
+            calls.append(x)
+            return x * 2
+        memory = LRUCache(ttl=0.05, stale=None)
+        memoizer = BaseClassMemoize(fn, [memory, KeyCache(self.server.url)], policy=AdmissionPolicy())
+        key = memoizer.hashargs(((1,), {}))
+        self.assertEqual(memoizer(1), 2)
+        for i in range(2):
+            time.sleep(0.1)
+            self.assertEqual(memory.lookup_entry(key)[:3], (True, 2, True))
+            self.assertEqual(memoizer(1), 2) # Expired, so refreshed in the background.
+            self.wait(memoizer)
+            self.assertEqual(memory.lookup_entry(key), (True, 2, False, self.server.store.get(key)[2]))
+        # The first refresh fetches the value (and digest), the second is not modified.
+        self.assertEqual(self.server.counts['notmodified'], 1)
+        self.assertEqual(memoizer.stats.stalehits, 2)
+        self.assertEqual(calls, [1])
+
+    def test_recalculate(self):
+        calls = []
+        @memmemoize(ttl=0.05, stale=None)
+        def fn(x):
+            calls.append(x)
+            return len(calls)
+        self.assertEqual(fn(1), 1)
+        time.sleep(0.1)
+        self.assertEqual(fn(1), 1) # The expired result, while it is recalculated.
+        self.wait(fn.memoizer)
+        self.assertEqual(fn(1), 2)
+        self.assertEqual(calls, [1, 1])
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def slowfn(self, x):
+        self.calls.append(x)
+        self.release.wait()
+        if x < 0:
+            raise ValueError(x)
+        return x
+
+    def run_threads(self, fns, x):
+        """Call each of fns(x) in a thread, returning the results (or exceptions)."""
+        results = [None] * len(fns)
+        def run(i):
+            try:
+                results[i] = fns[i](x)
+            except Exception, e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(fns))]
+        for t in threads:
+            t.start()
+        time.sleep(0.2)
+        self.release.set()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_calls(self):
+        fn = BaseClassMemoize(self.slowfn, caches=[LRUCache()])
+        self.assertEqual(self.run_threads([fn] * 5, 3), [3] * 5)
+        self.assertEqual(self.calls, [3])
+        self.assertEqual(fn.inflight, {})
+
+    def test_exception(self):
+        fn = BaseClassMemoize(self.slowfn, caches=[LRUCache()])
+        results = self.run_threads([fn] * 3, -1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(self.calls, [-1])
+
+    def test_slow_server(self):
+        """Calls calculate the result if the server takes longer than the latency budget."""
+        server = TestServer()
+        server.delay = 1
+        try:
+            fn = BaseClassMemoize(lambda x: x, caches=[LRUCache(), KeyCache(server.url, budget=0.05)])
+            start = time.time()
+            self.assertEqual(fn(3), 3)
+            self.assertTrue(time.time() - start < 0.5)
+        finally:
+            connection_pool(server.url).close()
+            server.shutdown()
+            server.server_close()
+
+    def test_lease(self):
+        """Memoizers with separate memory caches (like separate processes) share a lease on the server."""
+        server = TestServer()
+        try:
+            fns = [BaseClassMemoize(self.slowfn, caches=[LRUCache(), KeyCache(server.url)], lease=60,
+                                    leasepoll=0.05) for i in range(3)]
+            self.assertEqual(self.run_threads(fns, 5), [5] * 3)
+            self.assertEqual(self.calls, [5])
+            self.assertEqual([key for key in server.store if key.startswith('lease:')], []) # Released.
+        finally:
+            connection_pool(server.url).close()
+            server.shutdown()
+            server.server_close()
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        events = []
+        @memmemoize
+        def slowfn(x):
+            time.sleep(0.01)
+            return 'x' * x
+        stats = slowfn.memoizer.stats
+        stats.hooks.append(lambda stats, event, tier, seconds, nbytes: events.append((event, tier)))
+        slowfn(10)
+        for i in range(3):
+            slowfn(10)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['calls'], 4)
+        self.assertEqual(snapshot['misses'], 1)
+        self.assertEqual(snapshot['tiers'][0]['tier'], 'LRUCache')
+        self.assertEqual(snapshot['tiers'][0]['hits'], 3)
+        self.assertEqual(snapshot['tiers'][0]['lookups'], 4)
+        self.assertTrue(snapshot['computetime'] >= 0.01)
+        self.assertTrue(snapshot['saved'] > 0.02)
+        self.assertEqual(events, [('miss', None), ('compute', None)] + [('hit', 0)] * 3)
+        self.assertTrue(snapshot in cloudm.stats.snapshot())
+        cloudm.stats.reset()
+        self.assertEqual(stats.snapshot()['calls'], 0)
+        self.assertEqual(stats.snapshot()['computehistogram'], [0] * (len(cloudm.stats.BUCKETS) + 1))
+
+    def test_histograms(self):
+        stats = MemoizeStats('fn', [LRUCache(), LRUCache()])
+        stats.compute(0.005, 10)
+        stats.compute(0.05, 10)
+        stats.compute(100.0, 10)
+        stats.record(0.0, [(0, 2e-6), (1, 1e-3)], 1, 10)
+        stats.record(0.0, [(0, None)], 0, 10)
+        stats.lookup(1, 0.5, count=5)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['buckets'], list(cloudm.stats.BUCKETS))
+        self.assertEqual(snapshot['computehistogram'], [0, 0, 0, 1, 1, 0, 0, 1])
+        self.assertEqual(snapshot['tiers'][0]['lookuphistogram'], [1, 0, 0, 0, 0, 0, 0, 0]) # Untimed isn't.
+        self.assertEqual(snapshot['tiers'][1]['lookuphistogram'], [0, 0, 1, 0, 0, 1, 0, 0])
+        self.assertEqual([tier['lookups'] for tier in snapshot['tiers']], [2, 6])
+        stats.reset()
+        self.assertEqual(sum(stats.snapshot()['tiers'][1]['lookuphistogram']), 0)
+
+    def test_hit_sizes(self):
+        path = tempfile.mkdtemp()
+        try:
+            fn = BaseClassMemoize(lambda x: range(200000), [LRUCache(), DiskCache(path)], policy=AdmissionPolicy())
+            fn(1)
+            fn(1) # Memory hits aren't sized, so don't depend on the size of the result.
+            other = BaseClassMemoize(fn.func, [LRUCache(), DiskCache(path)], policy=AdmissionPolicy())
+            other(1)
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual(fn.stats.hitbytes, [0, 0])
+        self.assertEqual(fn.stats.lookups, [2, 1])
+        self.assertTrue(other.stats.hitbytes[1] > 200000) # Read from disk.
+
+
+class SlowCache(dict):
+    """Dictionary which takes delay seconds for each lookup (like a distant server)."""
+    delay = 0.02
+
+    def __getitem__(self, key):
+        time.sleep(self.delay)
+        return self.get(key)
+
+
+class TestPolicy(unittest.TestCase):
+    def test_static(self):
+        fn = BaseClassMemoize(lambda x: x, caches=[LRUCache()])
+        self.assertTrue(fn.policy.static(fn)) # Memory only, the quick path needn't ask the policy.
+        self.assertEqual([fn(1), fn(1)], [1, 1])
+        self.assertEqual((fn.stats.lookups, fn.stats.hits), ([2], [1]))
+        self.assertFalse(fn.policy.static(BaseClassMemoize(fn.func, caches=[LRUCache(), SlowCache()])))
+        self.assertTrue(AdmissionPolicy().static(BaseClassMemoize(fn.func, caches=[LRUCache(), SlowCache()])))
+        fn.overrides[0] = False
+        self.assertFalse(fn.policy.static(fn))
+        self.assertEqual(fn(1), 1)
+        self.assertEqual(fn.stats.lookups, [2]) # The override is applied.
+
+    def test_adaptive(self):
+        slow = SlowCache()
+        fn = BaseClassMemoize(lambda x: x, caches=[LRUCache(), slow], policy=AdaptivePolicy(probeevery=None))
+        for i in range(5):
+            fn(i)
+        # Calculating is quicker than the slow cache so it is only used until that's measured.
+        self.assertEqual(fn.stats.lookups, [5, 3])
+        self.assertEqual(len(slow), 2) # The third result is calculated once it's clear it isn't worth saving.
+        decisions = fn.policy.explain(fn)
+        self.assertEqual([d['use'] for d in decisions], [True, False])
+        self.assertTrue(decisions[1]['fetchtime'] > decisions[1]['computetime'])
+        fn.overrides['SlowCache'] = True
+        fn(10)
+        self.assertEqual(fn.stats.lookups, [6, 4])
+        self.assertEqual(fn.policy.explain(fn)[1]['reason'], 'override')
+
+    def test_slow_function(self):
+        slow = SlowCache()
+        fn = BaseClassMemoize(lambda x: time.sleep(0.05) or x, caches=[LRUCache(), slow])
+        for i in range(5):
+            fn(i)
+        self.assertEqual(fn.stats.lookups, [5, 5])
+        self.assertEqual(len(slow), 5)
+
+
+class TestMap(unittest.TestCase):
+    def test_map(self):
+        calls = []
+        slow = SlowCache()
+        fn = BaseClassMemoize(lambda x: calls.append(x) or x * 2, caches=[LRUCache(), slow],
+                              policy=AdmissionPolicy())
+        fn(1)
+        slow['unused'] = 0
+        self.assertEqual(list(fn.map([3, 1, 2, 3, 4], workers=3)), [6, 2, 4, 6, 8])
+        self.assertEqual(sorted(calls), [1, 2, 3, 4])
+        self.assertEqual(fn.stats.lookups, [5, 4]) # Each distinct key is looked up once.
+        self.assertEqual(len(slow), 5)
+        self.assertEqual(list(fn.map(range(5), workers=1)), [0, 2, 4, 6, 8])
+        self.assertEqual(sorted(calls), [0, 1, 2, 3, 4])
+
+    def test_streaming(self):
+        """Results are yielded as they are calculated."""
+        @memmemoize
+        def fn(x):
+            return x
+        results = fn.map(xrange(1000), workers=2, batchsize=10)
+        self.assertEqual(next(results), 0)
+        results.close()
+
+    def test_processes(self):
+        results = list(mapfunctions.square.map(range(4), workers=2, processes=True))
+        self.assertEqual([r[0] for r in results], [0, 1, 4, 9])
+        self.assertTrue(all(pid != os.getpid() for _, pid in results))
+        self.assertEqual(mapfunctions.square(3), results[3]) # Now cached in this process.
+
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+
+    def tearDown(self):
+        connection_pool(self.server.url).close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def memoizer(self, fn):
+        """Memoizer of fn with its own memory cache (as if in another process) and the test server."""
+        return BaseClassMemoize(fn, caches=[LRUCache(), KeyCache(self.server.url)], policy=AdmissionPolicy(),
+                                index=True)
+
+    def test_prefetch(self):
+        double = lambda x: x * 2
+        for i in range(5):
+            self.memoizer(double)(i)
+        fn = self.memoizer(double)
+        fn.prefetch([1, 2], wait=True)
+        self.assertEqual(len(fn.caches[0]), 2)
+        fn.prefetch(wait=True) # Everything on the server.
+        self.assertEqual(len(fn.caches[0]), 5)
+        self.assertEqual(fn(3), 6)
+        self.assertEqual(fn.stats.hits, [1, 0])
+
+    def test_background(self):
+        fn = self.memoizer(lambda x: x)
+        fn(1)
+        other = self.memoizer(lambda x: x + 1) # A different function with a different index.
+        thread = other.prefetch()
+        thread.join()
+        self.assertEqual(len(other.caches[0]), 0)
+
+
+class Model(object):
+    pickles = 0
+
+    def __init__(self, version):
+        self.version = version
+        self.lock = threading.Lock() # Can't be pickled.
+
+    def __getstate__(self):
+        Model.pickles += 1
+        return {'version' : self.version}
+
+
+class Pickled(Model):
+    predict = BaseClassMemoize(lambda self, x: x * self.version, caches=[LRUCache()])
+
+
+class TestInstanceKey(unittest.TestCase):
+    def test_fingerprint(self):
+        calls = []
+        class Predictor(Model):
+            @memmemoize(instancekey='version')
+            def predict(self, x):
+                calls.append(x)
+                return x * self.version
+        model = Predictor(2)
+        self.assertEqual([model.predict(3), model.predict(3), Predictor(2).predict(3)], [6, 6, 6])
+        model.version = 3
+        self.assertEqual(model.predict(3), 9)
+        self.assertEqual(calls, [3, 3])
+
+    def test_weak(self):
+        fn = BaseClassMemoize(lambda self, x: x * self.version, caches=[LRUCache()], instancekey='weak')
+        model = Model(2)
+        Model.pickles = 0
+        self.assertEqual([fn(model, 1), fn(model, 2), fn(model, 1)], [2, 4, 2])
+        self.assertEqual(Model.pickles, 1)
+        self.assertEqual(fn.hashargs(((model, 1), {})), fn.hashargs(((Model(2), 1), {})))
+        del model
+        self.assertEqual(fn.instancehashes, {})
+
+    def test_bound(self):
+        class Predictor(Model):
+            predict = BaseClassMemoize(lambda self, x: x * self.version, caches=[LRUCache()],
+                                       instancekey='version')
+        model = Predictor(2)
+        self.assertEqual(model.predict(3), 6)
+        self.assertEqual(sorted(vars(model)), ['lock', 'version']) # Nothing is saved on the instance.
+        pickled = Pickled(2) # The default instancekey pickles self for the key.
+        self.assertEqual([pickled.predict(3), pickled.predict(3)], [6, 6])
+        self.assertEqual(sorted(vars(pickled)), ['lock', 'version'])
+        self.assertTrue(isinstance(Predictor.predict, BaseClassMemoize))
+        self.assertTrue(model.predict is model.predict)
+        predict = model.predict
+        self.assertTrue(model.predict is predict) # Reused while it exists.
+        self.assertFalse(Predictor(2).predict is predict) # Each instance has its own.
+        self.assertEqual(Predictor(3).predict(3), 9) # Held until it's called.
+        instance = ref(model)
+        del model, predict
+        self.assertEqual((instance(), len(Predictor.predict.bound)), (None, 0))
+
+
+class CompiledFunction(object):
+    """Callable without func_code, like a compiled function."""
+    __name__ = 'compiled'
+
+    def __call__(self, x):
+        return x
+
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.digests = memoize.default_moduledigests
+
+    def tearDown(self):
+        memoize.default_moduledigests = self.digests
+        shutil.rmtree(self.path)
+
+    def compiled(self, contents):
+        """A function which appears to come from a compiled module containing contents."""
+        filename = os.path.join(self.path, 'compiled.so')
+        with open(filename, 'wb') as f:
+            f.write(contents)
+        os.utime(filename, (1000000000, 1000000000))
+        module = types.ModuleType('cloudm_test_compiled')
+        module.__file__ = filename
+        sys.modules[module.__name__] = module
+        self.addCleanup(sys.modules.pop, module.__name__)
+        fn = CompiledFunction()
+        fn.__module__ = module.__name__
+        return fn, filename
+
+    def test_lazy(self):
+        fn = BaseClassMemoize(lambda x: x, caches=[LRUCache()])
+        self.assertEqual(fn._fnhash, None)
+        self.assertEqual(fn(1), 1)
+        self.assertEqual(len(fn.fnhash), 64)
+
+    def test_compiled(self):
+        memoize.default_moduledigests = memoize.ModuleDigests(os.path.join(self.path, 'digests.json'))
+        fn, filename = self.compiled('compiled code')
+        expected = hashlib.sha512('version 1' + BaseClassMemoize.extrahash + 'compiled code').digest()
+        self.assertEqual(BaseClassMemoize(fn, caches=[LRUCache()]).fnhash, expected) # The same as before.
+        # Later functions use the saved digest (as long as the file's time and size don't change).
+        with open(filename, 'wb') as f:
+            f.write('compiled CODE')
+        os.utime(filename, (1000000000, 1000000000))
+        memoize.default_moduledigests = memoize.ModuleDigests(os.path.join(self.path, 'digests.json'))
+        self.assertEqual(BaseClassMemoize(fn, caches=[LRUCache()]).fnhash, expected)
+        os.utime(filename, (1000000010, 1000000010))
+        self.assertNotEqual(BaseClassMemoize(fn, caches=[LRUCache()]).fnhash, expected)
+
+    def test_default_keycache(self):
+        default_keycache, memoize.default_keycache = memoize.default_keycache, None
+        try:
+            fn = cloudmemoize(lambda x: x)
+            self.assertTrue(fn.memoizer.caches[-1] is memoize.default_keycache)
+            self.assertTrue(isinstance(memoize.default_keycache, ThreadWriteKeyCache))
+        finally:
+            memoize.default_keycache = default_keycache
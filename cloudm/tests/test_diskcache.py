@@ -0,0 +1,72 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from cloudm.diskcache import DiskCache
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_miss(self):
+        self.assertEqual(DiskCache(self.path)['missing'], None)
+        self.assertEqual(DiskCache(self.path).lookup('missing'), (False, None))
+        DiskCache(self.path)['none'] = None
+        self.assertEqual(DiskCache(self.path).lookup('none'), (True, None))
+
+    def test_persistent(self):
+        DiskCache(self.path)['key'] = {'a' : [1, 2, 3]}
+        self.assertEqual(DiskCache(self.path)['key'], {'a' : [1, 2, 3]})
+
+    def test_stale(self):
+        cache = DiskCache(self.path, ttl=0.01, stale=0.05)
+        cache.set('a', 1, digest='ab' * 64)
+        self.assertEqual(cache.lookup_entry('a'), (True, 1, False, 'ab' * 64))
+        time.sleep(0.02)
+        self.assertEqual(DiskCache(self.path, stale=0.05).lookup_entry('a'), (True, 1, True, 'ab' * 64))
+        time.sleep(0.05)
+        self.assertEqual(cache.lookup_entry('a'), (False, None, False, None))
+        cache = DiskCache(self.path, mmapthreshold=10)
+        cache.set('b', 'x' * 1000, digest='cd' * 64)
+        self.assertEqual(cache.lookup_entry('b'), (True, 'x' * 1000, False, 'cd' * 64))
+
+    def test_mmap(self):
+        cache = DiskCache(self.path, mmapthreshold=10)
+        cache['key'] = 'x' * 1000
+        self.assertEqual(cache['key'], 'x' * 1000)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_mmap_numpy(self):
+        cache = DiskCache(self.path, mmapthreshold=10)
+        cache['key'] = numpy.arange(100000.0)
+        self.assertEqual(cache['key'].sum(), numpy.arange(100000.0).sum())
+
+    def test_no_temporary_files(self):
+        cache = DiskCache(self.path)
+        cache['key'] = 1
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            self.assertFalse([f for f in filenames if f.startswith('.tmp')])
+
+    def test_corrupt(self):
+        cache = DiskCache(self.path)
+        cache['key'] = 1
+        with open(cache.filename('key'), 'wb') as f:
+            f.write('garbage')
+        self.assertEqual(cache['key'], None)
+
+    def test_eviction(self):
+        cache = DiskCache(self.path, maxbytes=3000)
+        for i in range(10):
+            cache[str(i)] = 'x' * 1000
+            os.utime(cache.filename(str(i)), (i, i))
+        self.assertTrue(cache.nbytes <= 3000)
+        self.assertEqual(cache['0'], None)
+        self.assertEqual(cache['9'], 'x' * 1000)
@@ -0,0 +1,481 @@
+import unittest
+import sys
+import socket
+import json
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import pickle
+import zlib
+import urllib2
+import multiprocessing
+from StringIO import StringIO
+from cloudm.memoize import hitsize
+from cloudm.keycache import KeyCache, ThreadWriteKeyCache, Serializer, DecompressReader, ServerUnavailable, \
+     connection_pool, joinpieces, HashRing, ShardedKeyCache
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Minimal keycache server (see appengine/keycacheserver.py) using keep-alive connections."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        url = urlparse.urlsplit(self.path)
+        if url.path == '/keys':
+            index = urlparse.parse_qs(url.query)['index'][0]
+            self.reply(json.dumps({'index' : index, 'keys' : self.server.indexes.get(index, [])}) + '\n\n')
+            return
+        key = urlparse.parse_qs(url.query)['key'][0]
+        value = self.server.store.get(key)
+        result = {'key' : key, 'hit' : value is not None}
+        if key in self.server.codecs:
+            result['codec'] = self.server.codecs[key]
+        self.reply(json.dumps(result) + '\n\n' + (value or ''))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        header, value = body.split('\n\n', 1)
+        header = json.loads(header)
+        store, codecs = self.server.store, self.server.codecs
+        if header.get('index'):
+            keys = self.server.indexes.setdefault(header['index'], [])
+            keys.extend(key for key in header.get('keys', [header.get('key')]) if key not in keys)
+        if self.path == '/set':
+            store[header['key']] = value
+            if header.get('codec'):
+                codecs[header['key']] = header['codec']
+            self.reply(json.dumps({'key' : header['key'], 'cached' : True}) + '\n\n')
+        elif self.path == '/getmulti':
+            values = [store.get(key, '') for key in header['keys']]
+            self.reply(json.dumps({'keys' : header['keys'], 'hits' : [key in store for key in header['keys']],
+                                   'sizes' : [len(v) for v in values],
+                                   'codecs' : [codecs.get(key) for key in header['keys']]}) +
+                       '\n\n' + ''.join(values))
+        elif self.path == '/setmulti':
+            self.server.requests += 1
+            offset = 0
+            for key, size, codec in zip(header['keys'], header['sizes'],
+                                        header.get('codecs') or [None] * len(header['keys'])):
+                store[key] = value[offset:offset + size]
+                if codec:
+                    codecs[key] = codec
+                offset += size
+            self.reply(json.dumps({'keys' : header['keys'], 'cached' : [True] * len(header['keys'])}) + '\n\n')
+        elif self.path == '/lease':
+            acquired = store.setdefault('lease:' + header['key'], header['owner']) == header['owner']
+            self.reply(json.dumps({'key' : header['key'], 'acquired' : acquired}) + '\n\n')
+        elif self.path == '/release':
+            released = store.get('lease:' + header['key']) == header['owner']
+            if released:
+                del store['lease:' + header['key']]
+            self.reply(json.dumps({'key' : header['key'], 'released' : released}) + '\n\n')
+
+    def reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error): # Clients which time out close the connection.
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), TestHandler)
+        self.store = {}
+        self.codecs = {}
+        self.indexes = {}
+        self.connections = 0
+        self.requests = 0
+        self.delay = 0 # Seconds to wait before answering a get.
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def childget(url):
+    """Exit status 0 if a forked process gets 'key' without using its parent's connections."""
+    sys.exit(0 if connection_pool(url).idle.qsize() == 0 and KeyCache(url).get('key') == 1 else 1)
+
+
+class TestKeyCache(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+        self.kc = KeyCache(self.server.url)
+
+    def tearDown(self):
+        connection_pool(self.server.url).close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_cachemiss(self):
+        self.assertEqual(self.kc.get('cachemiss'), None)
+
+    def test_cachehit(self):
+        self.kc.set('cachehit', 'value')
+        self.assertEqual(self.kc.get('cachehit'), 'value')
+
+    def test_falsy(self):
+        self.kc.set_many({'none' : None, 'zero' : 0})
+        self.assertEqual(self.kc.lookup('none'), (True, None))
+        self.assertEqual(self.kc.lookup('miss'), (False, None))
+        self.assertEqual(self.kc.get_many(['none', 'zero', 'miss']), {'none' : None, 'zero' : 0})
+        kc = ThreadWriteKeyCache(self.server.url)
+        kc['pending'] = None
+        self.assertEqual(kc.lookup('pending'), (True, None))
+        kc.flush()
+
+    def test_compression(self):
+        kc = KeyCache(self.server.url, compression='zlib', compressthreshold=100)
+        kc['small'] = 'x'
+        kc['large'] = 'x' * 10000
+        kc.set_many({'many' : 'y' * 10000})
+        self.assertEqual(self.server.codecs, {'large' : 'zlib', 'many' : 'zlib'})
+        self.assertTrue(len(self.server.store['large']) < 1000)
+        # Clients without compression can read compressed values.
+        self.assertEqual(self.kc['large'], 'x' * 10000)
+        self.assertEqual(self.kc.get_many(['small', 'many']), {'small' : 'x', 'many' : 'y' * 10000})
+
+    def test_poolsize(self):
+        KeyCache(self.server.url, poolsize=8).set('key', 1)
+        self.assertEqual(connection_pool(self.server.url).size, 8)
+
+    def test_fork(self):
+        self.kc.set('key', 1) # Leaves an idle connection in the pool.
+        process = multiprocessing.Process(target=childget, args=(self.server.url,))
+        process.start()
+        process.join(5)
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(self.kc.get('key'), 1)
+
+    def test_corrupt(self):
+        self.kc.set('truncated', range(1000))
+        self.server.store['truncated'] = self.server.store['truncated'][:-100]
+        self.server.store['garbage'] = 'garbage'
+        self.server.store['compressed'] = 'not zlib'
+        self.server.codecs['compressed'] = 'zlib'
+        self.kc.set('good', 1)
+        for key in ('truncated', 'garbage', 'compressed'):
+            self.assertRaises(urllib2.URLError, self.kc.get, key)
+            self.assertEqual(self.kc.get_many([key, 'good']), {'good' : 1}) # Corrupt values are misses.
+        self.assertEqual(self.kc.breaker.state, 'closed') # The server is working.
+        self.assertEqual(self.kc.get('good'), 1)
+
+    def test_keepalive(self):
+        for i in range(10):
+            self.kc[str(i)] = i
+            self.assertEqual(self.kc[str(i)], i)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_multi(self):
+        self.kc.batchsize = 3
+        values = dict((str(i), i) for i in range(10))
+        self.kc.set_many(values)
+        self.assertEqual(self.server.requests, 4)
+        self.assertEqual(self.kc.get_many(['miss'] + values.keys()), values)
+        self.assertEqual(self.kc.get('5'), 5)
+
+    def test_lease(self):
+        other = KeyCache(self.server.url)
+        self.assertTrue(self.kc.acquire_lease('key', 60))
+        self.assertFalse(other.acquire_lease('key', 60))
+        self.kc.release_lease('key')
+        self.assertTrue(other.acquire_lease('key', 60))
+
+    def test_timeout(self):
+        self.server.delay = 0.5
+        for kc in [KeyCache(self.server.url, timeout=0.05), KeyCache(self.server.url, budget=0.05)]:
+            start = time.time()
+            self.assertRaises(urllib2.URLError, kc.get, 'key')
+            self.assertTrue(time.time() - start < 0.4)
+            self.assertEqual(kc.latencies.snapshot()['get']['errors'], 1)
+
+    def test_breaker(self):
+        kc = KeyCache(self.server.url, failures=2, cooldown=0.2)
+        kc['a'] = 1
+        url, self.server.url = self.server.url, 'http://127.0.0.1:1/' # Nothing listening.
+        kc.server = self.server.url
+        self.assertRaises(urllib2.URLError, kc.get, 'a')
+        self.assertRaises(urllib2.URLError, kc.get, 'a')
+        self.assertEqual(kc.breaker.state, 'open')
+        self.assertRaises(ServerUnavailable, kc.get, 'a')
+        time.sleep(0.2)
+        kc.server = url # The server is back after the cool-down.
+        self.assertEqual(kc.get('a'), 1)
+        self.assertEqual(kc.breaker.state, 'closed')
+        latencies = kc.latencies.snapshot()
+        self.assertEqual((latencies['get']['count'], latencies['get']['errors']), (3, 2))
+        self.assertTrue(latencies['get']['p99'] <= latencies['get']['max'])
+        connection_pool(url).close()
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_stream(self):
+        value = [numpy.arange(1000000.0), numpy.ones((300, 300), dtype=numpy.int8), 'x' * 100000]
+        kc = KeyCache(self.server.url, compression='zlib')
+        for cache in (self.kc, kc):
+            cache['large'] = value
+            out = cache['large']
+            self.assertTrue((out[0] == value[0]).all())
+            self.assertTrue((out[1] == value[1]).all())
+            self.assertTrue(out[0].flags.writeable)
+            self.assertEqual(out[2], value[2])
+            self.assertEqual(cache.get_many(['large'])['large'][2], value[2])
+        # Streamed responses are read completely so the connection is reused.
+        self.assertEqual(self.server.connections, 1)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        value = {'a' : numpy.arange(100000.0).reshape(1000, 100), 'b' : 1}
+        self.kc.set('array', value)
+        out = self.kc.get('array')
+        self.assertEqual(out['b'], 1)
+        self.assertTrue((out['a'] == value['a']).all())
+
+
+class CountingReader(StringIO):
+    """StringIO counting calls of read."""
+    reads = 0
+
+    def read(self, n=-1):
+        self.reads += 1
+        return StringIO.read(self, n)
+
+
+class TestSerializer(unittest.TestCase):
+    def roundtrip(self, value, serializer=Serializer()):
+        return serializer.loads(joinpieces(serializer.dumps(value)))
+
+    def test_pickle(self):
+        self.assertEqual(self.roundtrip([1, 'a', {'b' : None}]), [1, 'a', {'b' : None}])
+        # Small values are plain pickles which earlier versions can read.
+        self.assertEqual(pickle.loads(joinpieces(Serializer().dumps((1, 2)))), (1, 2))
+
+    def test_legacy(self):
+        self.assertEqual(Serializer().loads(pickle.dumps({'a' : 1})), {'a' : 1})
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, Serializer().loads, '\x00cmz')
+
+    def test_load(self):
+        serializer = Serializer()
+        self.assertEqual(serializer.load(StringIO('')), None)
+        self.assertEqual(serializer.load(StringIO(pickle.dumps({'a' : 1}))), {'a' : 1})
+        self.assertEqual(serializer.load(DecompressReader(StringIO(zlib.compress(pickle.dumps('x' * 1000))), 'zlib')),
+                         'x' * 1000)
+        f = CountingReader(pickle.dumps([(i, str(i)) for i in range(10000)], 2))
+        self.assertEqual(serializer.load(f), [(i, str(i)) for i in range(10000)])
+        self.assertTrue(f.reads <= 3) # Not a read per pickle opcode.
+
+    def test_decompressreader(self):
+        data = ''.join('line %d\n' % i for i in range(10000))
+        f = DecompressReader(StringIO(zlib.compress(data)), 'zlib', chunksize=100)
+        self.assertEqual(f.readline(), 'line 0\n')
+        self.assertEqual(f.read(7), 'line 1\n')
+        self.assertEqual(f.read(), data[14:])
+        self.assertEqual(f.read(), '')
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_buffers(self):
+        a = numpy.arange(20000, dtype=numpy.int32).reshape(100, 200)
+        value = [a, a.T, numpy.zeros(3), 'x']
+        pieces = Serializer().dumps(value)
+        self.assertTrue(pieces[0].startswith('\x00cmb'))
+        self.assertEqual(len([p for p in pieces if isinstance(p, memoryview)]), 2)
+        out = Serializer().loads(joinpieces(pieces))
+        self.assertTrue((out[0] == a).all())
+        self.assertTrue((out[1] == a.T).all())
+        self.assertEqual(out[1].dtype, numpy.int32)
+        self.assertFalse(out[0].flags.writeable)
+        self.assertTrue(Serializer(writable=True).loads(joinpieces(pieces))[0].flags.writeable)
+        self.assertEqual(out[3], 'x')
+        out = Serializer().load(StringIO(joinpieces(pieces)))
+        self.assertTrue((out[1] == a.T).all())
+        self.assertTrue(out[0].flags.writeable)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_builtins_skip_hook(self):
+        seen = []
+        class Recording(Serializer):
+            def persistent_id(self, buffers, obj):
+                seen.append(type(obj))
+                return Serializer.persistent_id(self, buffers, obj)
+        Recording().dumps([(1, 'x', 2.0, None, {'a' : [u'b']})] * 10 + [numpy.zeros(3)])
+        # Only the array (and its dtype, as it's too small to be out-of-band) are passed to the hook.
+        self.assertEqual(seen, [numpy.ndarray, numpy.dtype])
+
+
+class BlockingWriteKeyCache(ThreadWriteKeyCache):
+    """ThreadWriteKeyCache whose writes wait for self.release to be set."""
+    def __init__(self, *args, **kwargs):
+        ThreadWriteKeyCache.__init__(self, *args, **kwargs)
+        self.release = threading.Event()
+        self.batches = []
+
+    def write(self, batch, index=None):
+        self.release.wait()
+        self.batches.append(dict(batch))
+        ThreadWriteKeyCache.write(self, batch, index)
+
+
+class TestThreadWriteKeyCache(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+
+    def tearDown(self):
+        connection_pool(self.server.url).close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_inflight(self, kc):
+        while not kc.inflight:
+            time.sleep(0.001)
+
+    def test_flush(self):
+        kc = ThreadWriteKeyCache(self.server.url)
+        for i in range(50):
+            kc[str(i)] = i
+        self.assertTrue(kc.flush(10))
+        self.assertEqual(len(self.server.store), 50)
+        self.assertEqual(KeyCache(self.server.url).get('7'), 7)
+        self.assertEqual(len(kc.threads), 2)
+
+    def test_release_after_write(self):
+        kc = BlockingWriteKeyCache(self.server.url, workers=1)
+        other = KeyCache(self.server.url)
+        self.assertTrue(kc.acquire_lease('key', 60))
+        kc['key'] = 1
+        kc.release_lease('key')
+        self.assertFalse(other.acquire_lease('key', 60)) # Held until the value is on the server.
+        kc.release.set()
+        self.assertTrue(kc.flush(10))
+        self.assertTrue(other.acquire_lease('key', 60))
+        self.assertEqual(other.get('key'), 1)
+
+    def test_coalesce(self):
+        kc = BlockingWriteKeyCache(self.server.url, workers=1)
+        kc['first'] = 0
+        self.wait_inflight(kc)
+        kc['a'] = 1
+        kc['b'] = 2
+        kc['a'] = 3
+        self.assertEqual(kc['a'], 3) # Pending values are visible before being written.
+        kc.release.set()
+        kc.flush()
+        self.assertEqual(kc.batches, [{'first' : 0}, {'a' : 3, 'b' : 2}])
+        self.assertEqual(KeyCache(self.server.url).get('a'), 3)
+
+    def test_full(self):
+        for onfull, expected in [('drop', None), ('inline', 2)]:
+            kc = BlockingWriteKeyCache(self.server.url, workers=1, queuesize=1, onfull=onfull)
+            kc['first' + onfull] = 0
+            self.wait_inflight(kc)
+            kc['a' + onfull] = 1
+            kc['b' + onfull] = 2
+            kc.release.set()
+            kc.flush()
+            self.assertEqual(KeyCache(self.server.url).get('a' + onfull), 1)
+            self.assertEqual(KeyCache(self.server.url).get('b' + onfull), expected)
+
+
+class TestShardedKeyCache(unittest.TestCase):
+    def setUp(self):
+        self.servers = [TestServer() for i in range(3)]
+        self.kc = ShardedKeyCache([server.url for server in self.servers], replicas=2)
+
+    def tearDown(self):
+        for server in self.servers:
+            connection_pool(server.url).close()
+            server.shutdown()
+            server.server_close()
+
+    def test_ring(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        keys = [str(i) for i in range(2000)]
+        before = dict((key, ring.nodes(key)[0]) for key in keys)
+        self.assertTrue(all(250 < before.values().count(node) < 750 for node in 'abcd'))
+        ring.add('e')
+        moved = [key for key in keys if ring.nodes(key)[0] != before[key]]
+        self.assertTrue(200 < len(moved) < 600)
+        self.assertTrue(all(ring.nodes(key)[0] == 'e' for key in moved)) # Only keys for the new node move.
+        self.assertEqual(len(set(ring.nodes('key', 3))), 3)
+
+    def test_empty(self):
+        kc = ShardedKeyCache([])
+        self.assertRaises(ServerUnavailable, kc.get, 'key')
+        self.assertRaises(ServerUnavailable, kc.get_many, ['key'])
+        self.assertRaises(ServerUnavailable, kc.acquire_lease, 'key', 60)
+
+    def test_hitsize(self):
+        self.assertTrue(hitsize(self.kc, 'x' * 1000) >= 1000) # Hits are sized as for a KeyCache.
+
+    def test_replicas(self):
+        values = dict((str(i), i) for i in range(20))
+        self.kc.set_many(values)
+        self.kc['single'] = 'value'
+        self.assertEqual(sum(len(server.store) for server in self.servers), 2 * 21)
+        self.assertEqual(self.kc.get_many(values.keys() + ['miss']), values)
+        self.assertEqual(self.kc['single'], 'value')
+        self.assertEqual(self.kc['miss'], None)
+
+    def test_fallback(self):
+        values = dict((str(i), i) for i in range(20))
+        self.kc.set_many(values)
+        down = self.servers[0]
+        down.shutdown()
+        down.server_close()
+        connection_pool(down.url).close()
+        self.assertEqual(self.kc.get_many(values.keys()), values)
+        self.assertEqual([self.kc[key] for key in sorted(values)], [values[key] for key in sorted(values)])
+        self.assertEqual(self.kc.health()[down.url], 'open')
+        self.kc['new'] = 1 # Written to the replica which is up.
+        self.assertEqual(self.kc['new'], 1)
+        self.servers.remove(down)
+
+    def test_index_and_lease(self):
+        self.kc.set_many(dict((str(i), i) for i in range(10)), index='fn')
+        self.assertEqual(sorted(self.kc.index_keys('fn')), sorted(str(i) for i in range(10)))
+        other = ShardedKeyCache([server.url for server in self.servers], replicas=2)
+        self.assertTrue(self.kc.acquire_lease('key', 60))
+        self.assertFalse(other.acquire_lease('key', 60))
+        self.kc.release_lease('key')
+        self.assertTrue(other.acquire_lease('key', 60))
+
+    def test_threadwrite(self):
+        kc = ShardedKeyCache([server.url for server in self.servers], cache=ThreadWriteKeyCache)
+        kc.set_many(dict((str(i), i) for i in range(10)))
+        self.assertTrue(kc.flush())
+        self.assertEqual(sum(len(server.store) for server in self.servers), 10)
+
+    def test_memoize(self):
+        from cloudm import memoize
+        calls = []
+        def square(x):
+            calls.append(x)
+            return x * x
+        default_keycache, memoize.default_keycache = memoize.default_keycache, self.kc
+        try:
+            self.assertEqual(memoize.cloudmemoize(square)(3), 9)
+            self.assertEqual(memoize.cloudmemoize(square)(3), 9) # Read from the servers.
+            self.assertEqual(list(memoize.cloudmemoize(square).map([3, 4])), [9, 16])
+        finally:
+            memoize.default_keycache = default_keycache
+        self.assertEqual(calls, [3, 4])
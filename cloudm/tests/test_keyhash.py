@@ -0,0 +1,52 @@
+import unittest
+import array
+import hashlib
+import pickle
+from cloudm.keyhash import KeyHasher, PickleKeyHasher, blake2b
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class TestKeyHasher(unittest.TestCase):
+    def setUp(self):
+        self.hasher = KeyHasher()
+
+    def key(self, *args, **xargs):
+        return self.hasher.hashargs('fnhash', (args, xargs))
+
+    def test_distinct(self):
+        keys = [self.key(), self.key(1), self.key(1L), self.key(1.0), self.key('1'), self.key(u'1'),
+                self.key([1]), self.key((1,)), self.key('a', 'b'), self.key('ab'), self.key(x=1),
+                self.key(None), self.key(array.array('i', [1])), self.key(bytearray('1'))]
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_stable(self):
+        self.assertEqual(self.key(1, [2, 'x'], y={'a' : 1, 'b' : 2}),
+                         self.key(1, [2, 'x'], y={'b' : 2, 'a' : 1}))
+        self.assertEqual(len(self.key()), 128)
+
+    def test_pickle_fallback(self):
+        self.assertEqual(self.key(set([1, 2])), self.key(set([1, 2])))
+        self.assertNotEqual(self.key(set([1, 2])), self.key(set([1, 3])))
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        a = numpy.arange(12.0)
+        self.assertEqual(self.key(a), self.key(a.copy()))
+        self.assertNotEqual(self.key(a), self.key(a.reshape(3, 4)))
+        self.assertNotEqual(self.key(a), self.key(a.astype(numpy.float32)))
+        b = a.reshape(3, 4)
+        self.assertEqual(self.key(b.T), self.key(b.T.copy()))
+
+    def test_digestsize(self):
+        self.assertEqual(len(KeyHasher('sha1', digestsize=10).hashargs('fnhash', ((1,), {}))), 20)
+
+    @unittest.skipIf(blake2b is None, 'blake2b is not available')
+    def test_blake2b(self):
+        self.assertEqual(len(KeyHasher('blake2b', digestsize=20).hashargs('fnhash', ((1,), {}))), 40)
+
+    def test_legacy(self):
+        args = ((1, 'x'), {'y' : 2})
+        self.assertEqual(PickleKeyHasher().hashargs('fnhash', args),
+                         hashlib.sha512('fnhash' + pickle.dumps(args)).hexdigest())
@@ -0,0 +1,83 @@
+import unittest
+import sys
+import time
+from cloudm.lrucache import LRUCache, approxsize
+from cloudm import memmemoize
+
+class TestLRUCache(unittest.TestCase):
+    def test_miss(self):
+        cache = LRUCache()
+        self.assertEqual(cache['missing'], None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.lookup('missing'), (False, None))
+        cache['none'] = None
+        self.assertEqual(cache.lookup('none'), (True, None))
+
+    def test_approxsize(self):
+        self.assertEqual(approxsize('x' * 1000), sys.getsizeof('x' * 1000))
+        values = [str(i % 10) for i in range(100000)]
+        self.assertEqual(approxsize(values), sys.getsizeof(values) + 100000 * sys.getsizeof('0'))
+        start = time.time()
+        approxsize([range(1000)] * 1000) # Only a sample is looked at.
+        self.assertTrue(time.time() - start < 0.01)
+
+    def test_maxentries(self):
+        cache = LRUCache(maxentries=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a'] # a is now more recently used than b
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache['b'], None)
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(cache['c'], 3)
+
+    def test_maxbytes(self):
+        cache = LRUCache(maxentries=None, maxbytes=100, sizeof=len)
+        cache['a'] = 'x' * 60
+        cache['b'] = 'y' * 30
+        self.assertEqual(cache.nbytes, 90)
+        cache['c'] = 'z' * 30
+        self.assertEqual(cache['a'], None)
+        self.assertEqual(cache.nbytes, 60)
+        cache['d'] = 'w' * 200 # Larger than the whole cache so never stored.
+        self.assertEqual(cache['d'], None)
+        self.assertEqual(cache.nbytes, 60)
+
+    def test_replace(self):
+        cache = LRUCache(sizeof=len)
+        cache['a'] = 'xx'
+        cache['a'] = 'xxxx'
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, 4)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache['a'] = 1
+        self.assertEqual(cache['a'], 1)
+        time.sleep(0.02)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache['a'], None)
+        self.assertEqual(len(cache), 0)
+
+    def test_stale(self):
+        cache = LRUCache(ttl=0.01, stale=0.05)
+        cache.set('a', 1, digest='ab' * 64)
+        self.assertEqual(cache.lookup_entry('a'), (True, 1, False, 'ab' * 64))
+        time.sleep(0.02)
+        self.assertEqual(cache.lookup_entry('a'), (True, 1, True, 'ab' * 64))
+        self.assertEqual(cache['a'], 1)
+        time.sleep(0.05)
+        self.assertEqual(cache.lookup_entry('a'), (False, None, False, None))
+
+    def test_decorator_limits(self):
+        calls = []
+        @memmemoize(maxentries=1)
+        def foo(x):
+            calls.append(x)
+            return x
+        foo(1)
+        foo(2)
+        foo(1)
+        self.assertEqual(calls, [1, 2, 1])
+        self.assertEqual(len(foo.memoizer.caches[0]), 1)
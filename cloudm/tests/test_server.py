@@ -0,0 +1,101 @@
+import unittest
+import json
+import shutil
+import tempfile
+import urllib2
+from cloudm.keycache import KeyCache, connection_pool
+from cloudm.server import KeyCacheServer, Store, LEASEPURGE
+from cloudm import loadtest
+
+
+class TestKeyCacheServer(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.servers = []
+        self.server = self.start(maxbytes=100000)
+        self.kc = KeyCache(self.server.url)
+
+    def start(self, **storeargs):
+        server = KeyCacheServer(('127.0.0.1', 0), **storeargs)
+        server.start()
+        self.servers.append(server)
+        return server
+
+    def tearDown(self):
+        for server in self.servers:
+            connection_pool(server.url).close()
+            server.stop()
+        shutil.rmtree(self.path)
+
+    def fetch(self, server, path):
+        return json.loads(urllib2.urlopen(server.url + path).readline())
+
+    def test_keycache(self):
+        self.assertEqual(self.kc.get('miss'), None)
+        self.kc['a'] = [1, 2]
+        self.assertEqual(self.kc['a'], [1, 2])
+        self.kc.set_many({'b' : 'b', 'c' : None}, index='fn')
+        self.assertEqual(self.kc.get_many(['a', 'b', 'miss']), {'a' : [1, 2], 'b' : 'b'})
+        self.assertEqual(sorted(self.kc.index_keys('fn')), ['b', 'c'])
+        self.assertTrue(self.kc.acquire_lease('a', 60))
+        self.assertFalse(KeyCache(self.server.url).acquire_lease('a', 60))
+        self.kc.release_lease('a')
+        self.assertTrue(KeyCache(self.server.url).acquire_lease('a', 60))
+
+    def test_compression(self):
+        kc = KeyCache(self.server.url, compression='zlib')
+        kc['x'] = 'x' * 50000
+        self.assertEqual(self.kc['x'], 'x' * 50000)
+        self.assertTrue(self.server.store.memory.nbytes < 10000)
+
+    def test_eviction(self):
+        for i in range(20):
+            self.kc[str(i)] = 'x' * 10000
+        self.assertTrue(self.server.store.memory.nbytes <= 100000)
+        self.assertEqual(self.kc['0'], None)
+        self.assertEqual(self.kc['19'], 'x' * 10000)
+
+    def test_persistence(self):
+        server = self.start(path=self.path)
+        KeyCache(server.url)['a'] = 'persisted'
+        server = self.start(path=self.path) # As if restarted.
+        self.assertEqual(KeyCache(server.url)['a'], 'persisted')
+
+    def test_stats(self):
+        self.assertEqual(self.fetch(self.server, 'health'), {'status' : 'ok'})
+        self.kc['a'] = 1
+        self.kc['a']
+        self.kc['miss']
+        stats = self.fetch(self.server, 'stats')
+        self.assertEqual((stats['hits'], stats['misses'], stats['sets'], stats['entries']), (1, 1, 1, 1))
+
+    def test_notmodified(self):
+        self.kc['a'] = 'value'
+        hit, modified, value, digest = self.kc.revalidate('a')
+        self.assertEqual((hit, modified, value), (True, True, 'value'))
+        self.assertEqual(self.kc.revalidate('a', digest), (True, False, None, digest))
+        self.assertEqual(self.kc.lookup_entry('a'), (True, 'value', False, digest))
+        response = urllib2.urlopen(self.server.url + 'get?key=a')
+        self.assertEqual(response.info()['ETag'], '"%s"' % digest)
+        self.assertTrue('stale-while-revalidate' in response.info()['Cache-Control'])
+        with self.assertRaises(urllib2.HTTPError) as e:
+            urllib2.urlopen(urllib2.Request(self.server.url + 'get?key=a', headers={'If-None-Match' : '"%s"' % digest}))
+        self.assertEqual(e.exception.code, 304)
+        self.assertEqual(self.fetch(self.server, 'stats')['notmodified'], 2)
+        self.kc['a'] = 'new'
+        self.assertEqual(self.kc.revalidate('a', digest)[:3], (True, True, 'new'))
+        self.assertEqual(self.kc.revalidate('miss', digest), (False, False, None, None))
+
+    def test_lease_purge(self):
+        store = Store()
+        for i in range(3 * LEASEPURGE):
+            store.acquire_lease(str(i), -1, 'owner') # Already expired.
+        self.assertTrue(len(store.leases) <= LEASEPURGE)
+        self.assertTrue(store.acquire_lease('held', 60, 'owner'))
+        self.assertFalse(store.acquire_lease('held', 60, 'other'))
+
+    def test_loadtest(self):
+        results = loadtest.run(self.server.url, clients=4, requests=20, size=100, keys=10)
+        self.assertEqual(results['requests'], 80)
+        self.assertEqual(results['errors'], 0)
+        self.assertEqual(sum(latency['count'] for latency in results['latency'].values()), 80)
@@ -0,0 +1,117 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import multiprocessing
+from cloudm.sharedcache import SharedCache
+from cloudm.memoize import memmemoize
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def fill(path, start):
+    cache = SharedCache(path)
+    for i in range(start, start + 50):
+        cache[str(i)] = i * i
+
+def setkey(cache, key, value):
+    cache[key] = value
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'shared')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_miss(self):
+        self.assertEqual(SharedCache(self.path)['missing'], None)
+        self.assertFalse('missing' in SharedCache(self.path))
+        self.assertEqual(SharedCache(self.path).lookup('missing'), (False, None))
+        SharedCache(self.path)['none'] = None
+        self.assertEqual(SharedCache(self.path).lookup('none'), (True, None))
+
+    def test_stale(self):
+        cache = SharedCache(self.path, size=1024 * 1024, ttl=0.01, stale=0.05)
+        cache.set('a', 1, digest='ab' * 64)
+        cache['b'] = 2
+        self.assertEqual(cache.lookup_entry('a'), (True, 1, False, 'ab' * 64))
+        time.sleep(0.02)
+        self.assertEqual(cache.lookup_entry('a'), (True, 1, True, 'ab' * 64))
+        time.sleep(0.05)
+        self.assertEqual(cache.lookup_entry('a'), (False, None, False, None))
+        self.assertEqual(SharedCache(self.path).lookup_entry('b'), (False, None, False, None))
+
+    def test_shared(self):
+        SharedCache(self.path, size=1024 * 1024)['key'] = {'a' : [1, 2, 3]}
+        cache = SharedCache(self.path)
+        self.assertEqual(cache['key'], {'a' : [1, 2, 3]})
+        self.assertEqual(cache.datasize, 1024 * 1024 - 64 - 256 * 32) # Sizes are read from the file.
+
+    def test_replace(self):
+        cache = SharedCache(self.path, size=1024 * 1024)
+        cache['key'] = 1
+        cache['key'] = 2
+        self.assertEqual(cache['key'], 2)
+        self.assertEqual(len(cache), 1)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        cache = SharedCache(self.path, size=4 * 1024 * 1024)
+        cache['key'] = numpy.arange(100000.0)
+        self.assertEqual(cache['key'].sum(), numpy.arange(100000.0).sum())
+
+    def test_eviction(self):
+        cache = SharedCache(self.path, size=64 * 1024, nslots=64)
+        for i in range(200):
+            cache[str(i)] = 'x' * 1000
+        self.assertEqual(cache['0'], None)
+        self.assertEqual(cache['199'], 'x' * 1000)
+        self.assertTrue(0 < len(cache) < 64)
+        self.assertTrue(cache.nbytes <= cache.datasize)
+
+    def test_too_large(self):
+        cache = SharedCache(self.path, size=64 * 1024, nslots=64)
+        cache['key'] = 'x' * 100000
+        self.assertEqual(cache['key'], None)
+
+    def test_clear(self):
+        cache = SharedCache(self.path, size=1024 * 1024)
+        cache['key'] = 1
+        cache.clear()
+        self.assertEqual(cache['key'], None)
+        self.assertEqual(len(cache), 0)
+
+    def test_processes(self):
+        processes = [multiprocessing.Process(target=fill, args=(self.path, start)) for start in (0, 50, 100)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        cache = SharedCache(self.path)
+        self.assertEqual([cache[str(i)] for i in range(150)], [i * i for i in range(150)])
+
+    def test_fork(self):
+        cache = SharedCache(self.path, size=1024 * 1024)
+        cache['parent'] = 1
+        process = multiprocessing.Process(target=setkey, args=(cache, 'child', 2)) # Forked after use.
+        with cache.locked():
+            process.start()
+            process.join(0.2)
+            self.assertTrue(process.is_alive()) # Waiting for the parent's lock.
+        process.join(5)
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual([cache['parent'], cache['child']], [1, 2])
+
+    def test_memoize(self):
+        cache = SharedCache(self.path, size=1024 * 1024)
+        calls = []
+        def square(x):
+            calls.append(x)
+            return x * x
+        self.assertEqual(memmemoize(shared=cache)(square)(3), 9)
+        self.assertEqual(memmemoize(shared=cache)(square)(3), 9) # A new memory cache, as in another process.
+        self.assertEqual(calls, [3])